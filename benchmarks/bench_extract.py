@@ -0,0 +1,156 @@
+"""提取器微基准测试
+
+用 extract_corpus 的语料（真实响应形态 + 对抗性输入）测量 image_ops 两个扫描器：
+先在小尺寸上与旧版正则逐条对照结果，再在大尺寸上计时，报告每条语料的吞吐（MB/s）
+和单次最坏耗时。任何语料的最坏耗时超过 --max-ms、1MB 以上的真实/录制语料吞吐低于 --min-mbps、
+或结果不对时退出码为 1（对抗性语料只要求最坏耗时，它们的意义是不能退化成平方级）。
+
+用法（在插件目录下）:
+    python benchmarks/bench_extract.py
+    python benchmarks/bench_extract.py --size 32m --rounds 3 --max-ms 500
+    python benchmarks/bench_extract.py --size 16k --legacy          # 同时计时旧版正则（只适合小尺寸）
+    python benchmarks/bench_extract.py --cassette data/cassette.jsonl.gz
+"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import argparse
+import importlib
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from harness import PACKAGE_NAME, install_host_stubs, load_plugin, print_table, parse_size  # noqa: E402
+from extract_corpus import Case, LEGACY_SCANNERS, SCANNERS, build_corpus, cassette_cases  # noqa: E402
+
+COLUMNS = ("case", "kind", "scanner", "bytes", "strategy", "median_ms", "worst_ms", "mbps", "legacy_ms", "result")
+MB = 1024 * 1024
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="麦麦自拍插件提取器微基准测试")
+    parser.add_argument("--size", default="8m", help="计时语料的大小（支持 k/m）")
+    parser.add_argument("--check-size", default="4k", help="与旧版正则对照结果时的语料大小")
+    parser.add_argument("--rounds", type=int, default=5, help="每条语料的计时轮数")
+    parser.add_argument("--max-ms", type=float, default=500.0, help="单次扫描的最坏耗时上限（毫秒）")
+    parser.add_argument("--min-mbps", type=float, default=80.0, help="1MB 以上的真实/录制语料的吞吐下限（MB/s）")
+    parser.add_argument("--legacy", action="store_true", help="同时计时旧版正则（对抗性语料是平方级，只用于小尺寸）")
+    parser.add_argument("--cassette", default="", help="把磁带里录下的响应加入语料")
+    parser.add_argument("--json", dest="json_path", default="", help="结果另存为 JSON")
+    parser.add_argument("--verbose", action="store_true", help="输出插件日志")
+    return parser.parse_args()
+
+
+def run_scanner(scanner: Callable, case: Case, default_limit: int):
+    limit = default_limit if case.max_scan_bytes is None else case.max_scan_bytes
+    return scanner(case.content, limit)
+
+
+def check_results(cases: List[Case], scanners: Dict[str, Callable], default_limit: int) -> List[str]:
+    """与期望策略和旧版正则逐条对照"""
+    failures = []
+    for case in cases:
+        for index, name in enumerate(SCANNERS):
+            result = run_scanner(scanners[name], case, default_limit)
+            if case.expect is not None and result[0] != case.expect[index]:
+                failures.append(f"{case.name}/{name}: 期望 {case.expect[index]}，实际 {result[0]}")
+            if case.max_scan_bytes is None and len(case.content) <= default_limit:
+                legacy = LEGACY_SCANNERS[name](case.content)
+                if result != legacy:
+                    failures.append(f"{case.name}/{name}: 与旧版结果不一致 ({result[0]} != {legacy[0]})")
+    return failures
+
+
+def time_case(case: Case, name: str, scanner: Callable, args: argparse.Namespace, default_limit: int) -> Dict[str, Any]:
+    samples = []
+    result = None
+    for _ in range(max(1, args.rounds)):
+        started = time.perf_counter()
+        result = run_scanner(scanner, case, default_limit)
+        samples.append(time.perf_counter() - started)
+
+    limit = default_limit if case.max_scan_bytes is None else case.max_scan_bytes
+    scanned = min(len(case.content), limit) if limit > 0 else len(case.content)
+    median = statistics.median(samples)
+    row: Dict[str, Any] = {
+        "case": case.name,
+        "kind": case.kind,
+        "scanner": name,
+        "bytes": scanned,
+        "strategy": result[0],
+        "median_ms": median * 1000,
+        "worst_ms": max(samples) * 1000,
+        "mbps": scanned / median / MB if median > 0 else float("inf"),
+        "legacy_ms": "",
+        "result": "ok",
+    }
+    if args.legacy and case.max_scan_bytes is None:
+        started = time.perf_counter()
+        LEGACY_SCANNERS[name](case.content)
+        row["legacy_ms"] = (time.perf_counter() - started) * 1000
+
+    problems = []
+    if case.expect is not None and result[0] != case.expect[SCANNERS.index(name)]:
+        problems.append("strategy")
+    if row["worst_ms"] > args.max_ms:
+        problems.append("slow")
+    if case.kind != "adversarial" and scanned >= MB and row["mbps"] < args.min_mbps:
+        problems.append("mbps")
+    if problems:
+        row["result"] = ",".join(problems)
+    return row
+
+
+def main() -> int:
+    args = parse_args()
+    install_host_stubs(verbose=args.verbose)
+    load_plugin()
+    image_ops = importlib.import_module(f"{PACKAGE_NAME}.core.image_ops")
+    scanners = {"3x": image_ops.scan_content, "25": image_ops.scan_content_gemini_25}
+    default_limit = image_ops.DEFAULT_MAX_SCAN_BYTES
+
+    recorded: List[Case] = []
+    if args.cassette:
+        cassette = importlib.import_module(f"{PACKAGE_NAME}.core.cassette")
+        recorded = cassette_cases(Path(args.cassette), cassette.load_cassette)
+        print(f"磁带语料 {len(recorded)} 条")
+
+    failures = check_results(build_corpus(parse_size(args.check_size)) + recorded, scanners, default_limit)
+
+    rows = []
+    for case in build_corpus(parse_size(args.size)) + recorded:
+        for name in SCANNERS:
+            row = time_case(case, name, scanners[name], args, default_limit)
+            rows.append(row)
+            if row["result"] != "ok":
+                failures.append(f"{case.name}/{name}: {row['result']} ({row['worst_ms']:.1f}ms, {row['mbps']:.0f}MB/s)")
+
+    print_table(rows, COLUMNS)
+    total_bytes = sum(row["bytes"] for row in rows)
+    total_seconds = sum(row["median_ms"] for row in rows) / 1000
+    worst = max(rows, key=lambda row: row["worst_ms"])
+    print(
+        f"\n合计 {total_bytes / MB:.1f}MB，吞吐 {total_bytes / total_seconds / MB:.0f}MB/s，"
+        f"最坏 {worst['worst_ms']:.1f}ms（{worst['case']}/{worst['scanner']}）"
+    )
+
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(rows, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    if failures:
+        print(f"\n{len(failures)} 项未通过:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""自拍流水线基准测试
+
+对本地假 API 驱动提取器、SelfieGenerator 与完整工具路径，
+报告不同响应形态/图片大小/并发下的吞吐、p50/p99 延迟、峰值 RSS 与事件循环延迟。
+
+用法（在插件目录下）:
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --mode tool --sizes 256k,2m --concurrency 16
+    python benchmarks/bench_pipeline.py --shapes data_url --latency 0.5 --jitter 0.3 --error-rate 0.05
+    python benchmarks/bench_pipeline.py --mode tool --shapes data_url,markdown_url --corrupt-rate 0.2
+    python benchmarks/bench_pipeline.py --shapes markdown_url,bare_url --sizes 8m --drop-rate 0.3
+    python benchmarks/bench_pipeline.py --mode generator --sizes 8m --offload inline,thread,process
+    python benchmarks/bench_pipeline.py --mode generator --sizes 64k --slow-rate 0.03 --slow-latency 2 --hedge off,on
+    python benchmarks/bench_pipeline.py --mode tool --sizes 8m --worker off,on
+    python benchmarks/bench_pipeline.py --shapes markdown_url --record-cassette /tmp/selfie.jsonl.gz
+    python benchmarks/bench_pipeline.py --cassette /tmp/selfie.jsonl.gz --replay-speed 0
+"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import shutil
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from harness import (  # noqa: E402
+    install_host_stubs, load_plugin, use_bench_config, run_concurrently, print_table, parse_size,
+)
+from fake_api import FakeImageAPI, SHAPES  # noqa: E402
+
+MODES = ("extractor", "generator", "tool")
+COLUMNS = (
+    "mode", "shape", "size", "conc", "requests", "failures",
+    "throughput", "p50_ms", "p99_ms", "peak_rss_mb", "rss_delta_mb", "offload", "hedge", "worker", "api_calls",
+    "lag_p99_ms", "lag_max_ms",
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="麦麦自拍插件流水线基准测试")
+    parser.add_argument("--mode", default="all", choices=MODES + ("all",))
+    parser.add_argument("--shapes", default=",".join(SHAPES), help="响应形态，逗号分隔")
+    parser.add_argument("--sizes", default="64k,512k,2m", help="图片大小，逗号分隔（支持 k/m）")
+    parser.add_argument("--requests", type=int, default=50, help="每个场景的请求数")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="假 API 平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="假 API 延迟标准差（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--corrupt-rate", type=float, default=0.0, help="返回截断图片/HTML 错误页的比例")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="图片下载中途断开连接的比例（测试续传）")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="生图请求进入长尾的比例")
+    parser.add_argument("--slow-latency", type=float, default=2.0, help="长尾请求额外延迟（秒）")
+    parser.add_argument("--hedge", default="off", help="请求对冲，逗号分隔对比: off,on")
+    parser.add_argument("--worker", default="off", help="生图子进程，逗号分隔对比: off,on")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="模拟平台上传延迟（秒）")
+    parser.add_argument("--model", default="", help="覆盖模型名（决定走哪套提取逻辑）")
+    parser.add_argument("--offload", default="thread", help="CPU 任务执行方式，逗号分隔对比: inline,thread,process")
+    parser.add_argument("--record-cassette", default="", help="把假 API 的响应录到这个磁带文件")
+    parser.add_argument("--cassette", default="", help="不启动假 API，回放这个磁带文件（录下的真实响应）")
+    parser.add_argument("--replay-speed", type=float, default=0.0, help="回放速度：1 = 录制时的延迟，0 = 立即返回")
+    parser.add_argument("--json", dest="json_path", default="", help="结果另存为 JSON")
+    parser.add_argument("--verbose", action="store_true", help="输出插件日志")
+    return parser.parse_args()
+
+
+async def run_scenario(
+    plugin, mode: str, api: Optional[FakeImageAPI], args: argparse.Namespace, responses: Optional[List[Any]] = None,
+) -> Dict[str, Any]:
+    from selfie_plugin.core import get_runtime, SelfieStyle, PhotoPerspective
+    from selfie_plugin.core.worker import get_worker_client
+    from selfie_plugin.tools import TakeSelfiePhotoTool
+
+    runtime = get_runtime()
+    generator = runtime.generator
+    worker = get_worker_client()
+    if worker is not None and mode != "extractor":
+        # 子进程启动（导入 aiohttp 等）不计入测量
+        await worker.ensure_started()
+
+    if mode == "extractor":
+        extract = generator._extract_image_gemini_25 if generator._is_gemini_25() else generator._extract_image
+        if responses:
+            # 磁带里录下的真实响应，依次轮换
+            recorded = itertools.cycle(responses)
+
+            async def call():
+                return await extract(next(recorded))
+        else:
+            content = api.make_content()
+            response = {"choices": [{"message": {"content": content}}]}
+
+            async def call():
+                return await extract(response)
+
+    elif mode == "generator":
+        prompt = runtime.prompt_builder.build_prompt("跑基准", SelfieStyle.CASUAL, PhotoPerspective.SELFIE)
+
+        async def call():
+            image, error = await generator.generate_selfie(prompt)
+            return image is not None
+
+    else:
+        tool = TakeSelfiePhotoTool()
+        tool.chat_id = "bench_stream"
+
+        async def call():
+            result = await tool.execute({"activity": "跑基准"})
+            return str(result.get("content", "")).startswith("照片已发送")
+
+    return await run_concurrently(call, args.requests, args.concurrency)
+
+
+async def main() -> int:
+    args = parse_args()
+    install_host_stubs(send_latency=args.send_latency, verbose=args.verbose)
+    plugin = load_plugin()
+
+    modes = MODES if args.mode == "all" else (args.mode,)
+    shapes = [s.strip() for s in args.shapes.split(",") if s.strip()]
+    sizes = [parse_size(s) for s in args.sizes.split(",") if s.strip()]
+    offloads = [o.strip() for o in args.offload.split(",") if o.strip()]
+    hedges = [h.strip() for h in args.hedge.split(",") if h.strip()]
+    workers = [w.strip() for w in args.worker.split(",") if w.strip()]
+
+    rows: List[Dict[str, Any]] = []
+
+    async def run_matrix(
+        api: Optional[FakeImageAPI], shape: str, size: int, api_base: str,
+        extra: Dict[str, Dict[str, Any]], responses: Optional[List[Any]] = None,
+    ):
+        for offload, hedge, worker in itertools.product(offloads, hedges, workers):
+            overrides = {"selfie.offload": {"executor": offload}, **extra}
+            if args.model:
+                overrides["selfie.api"] = {"model": args.model}
+            if hedge == "on":
+                # 基准的延迟远低于线上：对冲延迟下限按假 API 延迟缩放，样本够 10 个就开始对冲
+                overrides["selfie.hedge"] = {
+                    "enabled": True, "min_delay": args.latency * 2, "min_samples": 10,
+                }
+            if worker == "on":
+                overrides["selfie.worker"] = {"enabled": True}
+            config_dir = use_bench_config(api_base, overrides)
+            try:
+                for mode in modes:
+                    calls_before = api.requests if api else 0
+                    result = await run_scenario(plugin, mode, api, args, responses)
+                    result.update(
+                        mode=mode, shape=shape, size=size, conc=args.concurrency, offload=offload,
+                        hedge=hedge, worker=worker, api_calls=api.requests - calls_before if api else "",
+                    )
+                    rows.append(result)
+                    print(
+                        f"  {mode:<9} {shape:<12} {size:>9}B {offload:<7} hedge={hedge:<3} worker={worker:<3}  "
+                        f"{result['throughput']:.1f} req/s",
+                        file=sys.stderr,
+                    )
+            finally:
+                # 先关闭运行时（任务日志写线程可能还在落盘图片），再删除临时目录
+                from selfie_plugin.core.runtime import reset_runtime
+                reset_runtime()
+                shutil.rmtree(config_dir, ignore_errors=True)
+
+    if args.cassette:
+        from selfie_plugin.core.cassette import load_cassette
+
+        cassette = Path(args.cassette).resolve()
+        posts = [i for i in load_cassette(cassette) if i.method == "POST" and i.status == 200]
+        if not posts:
+            print(f"磁带 {cassette} 中没有成功的生图响应", file=sys.stderr)
+            return 1
+        replay = {"selfie.cassette": {"mode": "replay", "path": str(cassette), "speed": args.replay_speed}}
+        await run_matrix(
+            None, "cassette", sum(len(i.body) for i in posts) // len(posts),
+            "http://cassette.invalid/v1/chat/completions", replay, [i.json() for i in posts],
+        )
+    else:
+        record = {}
+        if args.record_cassette:
+            record["selfie.cassette"] = {"mode": "record", "path": str(Path(args.record_cassette).resolve())}
+        for shape in shapes:
+            for size in sizes:
+                api = FakeImageAPI(
+                    shape=shape,
+                    payload_bytes=size,
+                    latency=args.latency,
+                    jitter=args.jitter,
+                    error_rate=args.error_rate,
+                    corrupt_rate=args.corrupt_rate,
+                    download_drop_rate=args.drop_rate,
+                    slow_rate=args.slow_rate,
+                    slow_latency=args.slow_latency,
+                )
+                async with api:
+                    await run_matrix(api, shape, size, api.chat_url, record)
+        if args.record_cassette:
+            from selfie_plugin.core.cassette import get_recorder
+
+            recorder = get_recorder()
+            if recorder is not None:
+                recorder.flush()
+                print(f"已录制 {recorder.recorded} 条请求到 {recorder.path}", file=sys.stderr)
+
+    from selfie_plugin.core.http_client import close_http_session
+    await close_http_session()
+
+    print()
+    print_table(rows, COLUMNS)
+
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(rows, indent=2), encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,181 @@
+"""插件启动耗时基准测试
+
+每轮在全新子进程中测量：导入插件包、构造插件对象、获取组件列表的耗时，
+此时已加载的重依赖，以及后台预热各阶段（配置合并、运行时构建、参考图编码、连接池）的耗时。
+
+用法（在插件目录下）:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 20 --ref-images 5 --ref-size 2m
+    python benchmarks/bench_startup.py --importtime
+"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import argparse
+import asyncio
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from harness import print_table, percentile, parse_size  # noqa: E402
+
+# 插件加载阶段不应出现的重依赖
+HEAVY_MODULES = ("aiohttp", "sqlite3", "concurrent.futures.process", "PIL")
+PHASES = ("config", "runtime", "reference_images", "http_session")
+METRICS = ("import_ms", "init_ms", "components_ms", "startup_ms", "warmup_ms") + tuple(f"{p}_ms" for p in PHASES)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="麦麦自拍插件启动耗时基准测试")
+    parser.add_argument("--runs", type=int, default=10, help="子进程轮数")
+    parser.add_argument("--ref-images", type=int, default=3, help="临时人设参考图数量")
+    parser.add_argument("--ref-size", default="512k", help="每张参考图大小（支持 k/m）")
+    parser.add_argument("--importtime", action="store_true", help="额外跑一轮 -X importtime，列出最慢的导入")
+    parser.add_argument("--json", dest="json_path", default="", help="结果另存为 JSON")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+# =============================================================================
+# 子进程：单次冷启动
+# =============================================================================
+
+def prepare_config(directory: Path, ref_images: int, ref_size: int) -> Dict[str, Dict[str, Any]]:
+    """临时配置：参考图目录、历史库/状态文件都放在临时目录"""
+    from harness import make_png
+
+    image_dir = directory / "refs"
+    image_dir.mkdir()
+    for i in range(ref_images):
+        (image_dir / f"ref_{i}.png").write_bytes(make_png(ref_size))
+    return {
+        "selfie.api": {"api_base": "http://127.0.0.1:9/v1/chat/completions", "api_key": "bench-key"},
+        "selfie.character": {"image_folder": str(image_dir)},
+        "selfie.history": {"db_path": str(directory / "selfie_history.db")},
+        "selfie.rate_limit": {"state_path": str(directory / "rate_limits.json")},
+        "selfie.budget": {"state_path": str(directory / "usage.json")},
+        "selfie.journal": {"path": str(directory / "jobs.db")},
+        "selfie.offload": {"lag_monitor_interval": 0},
+    }
+
+
+def run_child(args: argparse.Namespace) -> Dict[str, Any]:
+    from harness import install_host_stubs, load_plugin, write_bench_config, PACKAGE_NAME
+
+    install_host_stubs()
+
+    started = time.perf_counter()
+    load_plugin()
+    plugin_module = sys.modules[f"{PACKAGE_NAME}.plugin"]
+    imported = time.perf_counter()
+
+    directory = Path(tempfile.mkdtemp(prefix="selfie_startup_"))
+    try:
+        # 指向临时配置目录，但不加载（配置合并是预热的一部分）
+        config_snapshot = sys.modules[f"{PACKAGE_NAME}.core.config_snapshot"]
+        write_bench_config(directory, prepare_config(directory, args.ref_images, parse_size(args.ref_size)))
+        config_snapshot.set_config_store(config_snapshot.ConfigStore(directory))
+
+        before_init = time.perf_counter()
+        plugin = plugin_module.SelfiePlugin()
+        initialized = time.perf_counter()
+        plugin.get_plugin_components()
+        components = time.perf_counter()
+        heavy = [name for name in HEAVY_MODULES if name in sys.modules]
+
+        result: Dict[str, Any] = {
+            "import_ms": (imported - started) * 1000,
+            "init_ms": (initialized - before_init) * 1000,
+            "components_ms": (components - initialized) * 1000,
+            "startup_ms": (imported - started + components - before_init) * 1000,
+            "heavy_at_startup": ",".join(heavy) or "-",
+        }
+
+        async def warm():
+            from selfie_plugin.core import warmup
+            from selfie_plugin.core.http_client import close_http_session
+
+            timings = await warmup.warm_up()
+            result["warmup_ms"] = timings["total"] * 1000
+            for phase in PHASES:
+                result[f"{phase}_ms"] = timings.get(phase, float("nan")) * 1000
+            await close_http_session()
+
+        asyncio.run(warm())
+
+        from selfie_plugin.core import runtime
+        runtime.reset_runtime()
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# =============================================================================
+# 父进程：汇总
+# =============================================================================
+
+def spawn(extra: List[str], args: argparse.Namespace) -> subprocess.CompletedProcess:
+    command = [sys.executable, *extra, str(Path(__file__).resolve()), "--child",
+               "--ref-images", str(args.ref_images), "--ref-size", args.ref_size]
+    return subprocess.run(command, capture_output=True, text=True, check=True)
+
+
+def print_importtime(args: argparse.Namespace, top: int = 15):
+    """-X importtime 输出中累计耗时最长的插件相关导入"""
+    stderr = spawn(["-X", "importtime"], args).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        if self_us.isdigit() and name.lstrip().split(".")[0] in ("selfie_plugin", *HEAVY_MODULES):
+            rows.append({"module": name, "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+    rows.sort(key=lambda r: r["cumulative_ms"], reverse=True)
+    print()
+    print_table(rows[:top], ("module", "self_ms", "cumulative_ms"))
+
+
+def main() -> int:
+    args = parse_args()
+    if args.child:
+        print(json.dumps(run_child(args)))
+        return 0
+
+    samples = []
+    for i in range(args.runs):
+        samples.append(json.loads(spawn([], args).stdout.strip().splitlines()[-1]))
+        print(f"  run {i + 1}/{args.runs}: startup {samples[-1]['startup_ms']:.1f}ms", file=sys.stderr)
+
+    rows = []
+    for metric in METRICS:
+        values = [s[metric] for s in samples if metric in s]
+        rows.append({
+            "metric": metric,
+            "min": min(values),
+            "p50": percentile(values, 0.5),
+            "p99": percentile(values, 0.99),
+            "max": max(values),
+        })
+    print()
+    print(f"启动时已加载的重依赖: {samples[-1]['heavy_at_startup']}")
+    print_table(rows, ("metric", "min", "p50", "p99", "max"))
+
+    if args.importtime:
+        print_importtime(args)
+
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps({"samples": samples, "summary": rows}, indent=2), encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
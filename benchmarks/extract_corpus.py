@@ -0,0 +1,173 @@
+"""提取器语料 - 真实响应形态与对抗性输入，附旧版正则实现作为对照"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import base64
+import json
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from harness import make_png
+
+# 扫描器名称（与 image_ops 的函数对应）
+SCANNERS = ("3x", "25")
+
+ScanResult = Tuple[str, Optional[str]]
+
+
+@dataclass
+class Case:
+    """
+    一条语料
+
+    expect 是两个扫描器（3x, 25）应命中的策略；为 None 时只与旧版正则的结果对照（录制的真实响应）。
+    max_scan_bytes 为 None 时使用插件默认的扫描上限。
+    """
+    name: str
+    kind: str  # real / adversarial / recorded
+    content: str
+    expect: Optional[Tuple[str, str]] = None
+    max_scan_bytes: Optional[int] = None
+
+
+# =============================================================================
+# 旧版提取（回溯正则），只用于结果对照和对比耗时
+# =============================================================================
+
+_MARKDOWN_URL_RE = re.compile(r'!\[.*?\]\((https?://[^\)]+)\)')
+_DATA_URL_B64_RE = re.compile(r'base64,([A-Za-z0-9+/=]+)')
+_B64_PREFIX_RE = re.compile(r'^[A-Za-z0-9+/=]+')
+_B64_FULL_RE = re.compile(r'^[A-Za-z0-9+/=]+$')
+_IMAGE_URL_RE = re.compile(r'(https?://[^\s\)\"\']+\.(?:png|jpg|jpeg|webp|gif))', re.IGNORECASE)
+_ANY_URL_RE = re.compile(r'(https?://[^\s\)\"\']+)')
+
+
+def legacy_scan_content(content: str) -> ScanResult:
+    url_match = _MARKDOWN_URL_RE.search(content)
+    if url_match:
+        return "markdown_url", url_match.group(1)
+    if "data:image" in content:
+        b64_match = _DATA_URL_B64_RE.search(content)
+        if b64_match:
+            return "data_url", b64_match.group(1)
+    content_stripped = content.strip()
+    if len(content_stripped) > 100 and _B64_FULL_RE.match(content_stripped):
+        return "raw_base64", content_stripped
+    return "none", None
+
+
+def legacy_scan_content_gemini_25(content: str) -> ScanResult:
+    url_match = _MARKDOWN_URL_RE.search(content)
+    if url_match:
+        return "markdown_url", url_match.group(1)
+    if "data:image" in content and "base64," in content:
+        img_data = _B64_PREFIX_RE.match(content.split("base64,")[1])
+        if img_data:
+            return "data_url", img_data.group(0)
+    if content.startswith("/9j/") or content.startswith("iVBOR"):
+        return "raw_base64", content.strip()
+    if "http" in content:
+        url_match = _IMAGE_URL_RE.search(content)
+        if url_match:
+            return "bare_url", url_match.group(1)
+        url_match = _ANY_URL_RE.search(content)
+        if url_match:
+            return "any_url", url_match.group(1)
+    content_stripped = content.strip()
+    if len(content_stripped) > 100 and _B64_FULL_RE.match(content_stripped):
+        return "raw_base64", content_stripped
+    return "none", None
+
+
+LEGACY_SCANNERS = {"3x": legacy_scan_content, "25": legacy_scan_content_gemini_25}
+
+
+# =============================================================================
+# 语料
+# =============================================================================
+
+def _repeat(unit: str, size: int) -> str:
+    """重复 unit 直到约 size 个字符"""
+    return unit * max(1, size // len(unit))
+
+
+def _b64_image(size: int) -> str:
+    return base64.b64encode(make_png(max(size * 3 // 4, 256))).decode("ascii")
+
+
+def build_corpus(size: int) -> List[Case]:
+    """
+    生成约 size 字符的语料
+
+    同一组语料在小尺寸下用来与旧版正则对照结果（旧实现在对抗性输入上是平方级，
+    只能跑小尺寸），在大尺寸下用来计时。
+    """
+    b64 = _b64_image(size)
+    chat = _repeat("今天天气不错，我们去公园散步吧。", size)
+    cdn = "https://cdn.example.com/u/7f3a9c"
+    return [
+        # 真实响应形态
+        Case("markdown_url", "real", f"给你拍好啦！\n\n![selfie]({cdn}/selfie.png)", ("markdown_url", "markdown_url")),
+        Case("markdown_signed", "real",
+             f"![image]({cdn}/a.png?X-Amz-Signature=3f9a&X-Amz-Expires=3600)", ("markdown_url", "markdown_url")),
+        Case("markdown_after_chat", "real", f"{chat}\n![selfie]({cdn}/b.webp)", ("markdown_url", "markdown_url")),
+        Case("markdown_two_images", "real", f"![a]({cdn}/1.png) 和 ![b]({cdn}/2.png)", ("markdown_url", "markdown_url")),
+        Case("data_url", "real", f"![selfie](data:image/png;base64,{b64})", ("data_url", "data_url")),
+        Case("data_url_json", "real", json.dumps({"image": f"data:image/jpeg;base64,{b64}"}), ("data_url", "data_url")),
+        Case("raw_base64", "real", b64, ("raw_base64", "raw_base64")),
+        Case("raw_base64_newline", "real", f"\n{b64}\n", ("raw_base64", "raw_base64")),
+        Case("bare_url", "real", f"照片在这里 {cdn}/selfie.webp 喜欢吗", ("none", "bare_url")),
+        Case("bare_url_uppercase_ext", "real", f"{cdn}/IMG_0001.JPG", ("none", "bare_url")),
+        Case("cdn_url_no_ext", "real", f"图片链接: {cdn}/file/9d2e", ("none", "any_url")),
+        Case("refusal", "real", "抱歉，我无法生成这张图片，它可能违反了内容政策。", ("none", "none")),
+        Case("chat_answer", "real", chat, ("none", "none")),
+        Case("data_url_mention", "real", f"{chat} 可以用 data:image 链接展示图片。", ("none", "none")),
+
+        # 对抗性输入：旧版正则在这些输入上回溯成平方级
+        Case("bang_flood", "adversarial", _repeat("![", size), ("none", "none")),
+        Case("bang_newline_flood", "adversarial", _repeat("![\n", size), ("none", "none")),
+        Case("alt_unclosed", "adversarial", _repeat("![a](", size), ("none", "none")),
+        Case("url_unclosed", "adversarial", "![x](http://" + "a" * size, ("none", "any_url")),
+        Case("markdown_url_flood", "adversarial", _repeat("![x](http://a", size), ("none", "any_url")),
+        Case("target_flood", "adversarial", _repeat("](http://", size), ("none", "any_url")),
+        Case("http_flood", "adversarial", _repeat("http://", size), ("none", "any_url")),
+        Case("http_space_flood", "adversarial", _repeat("http://a ", size), ("none", "any_url")),
+        Case("dot_flood", "adversarial", "http://a" + _repeat(".x", size), ("none", "any_url")),
+        Case("extension_near_miss", "adversarial", "http://a" + _repeat(".pn", size), ("none", "any_url")),
+        Case("dot_flood_then_url", "adversarial",
+             "http://a" + _repeat(".x", size) + f" {cdn}/d.png", ("none", "bare_url")),
+        Case("url_space_flood_then_url", "adversarial",
+             _repeat("http://a ", size) + f"{cdn}/e.png", ("none", "bare_url")),
+        Case("base64_marker_flood", "adversarial", "data:image" + _repeat("base64,", size), ("data_url", "none")),
+        Case("base64_bad_tail", "adversarial", f"data:image/png;base64,{b64}!" + "a" * 64, ("data_url", "data_url")),
+        Case("paren_flood", "adversarial", "![](" + "(" * size, ("none", "none")),
+        Case("unicode_flood", "adversarial", _repeat("自拍![照片](", size), ("none", "none")),
+
+        # 扫描上限：超出上限的部分不看，被上限截断的数据不算命中
+        Case("markdown_then_junk_over_limit", "adversarial",
+             f"![selfie]({cdn}/c.png)" + "a" * size, ("markdown_url", "markdown_url"), max_scan_bytes=1024),
+        Case("data_url_over_limit", "adversarial",
+             f"![selfie](data:image/png;base64,{b64})", ("none", "none"), max_scan_bytes=1024),
+        Case("raw_base64_over_limit", "adversarial", b64, ("none", "none"), max_scan_bytes=1024),
+        Case("url_over_limit", "adversarial", "http://a" + "b" * size, ("none", "none"), max_scan_bytes=1024),
+    ]
+
+
+def cassette_cases(path: Path, load_cassette: Callable) -> List[Case]:
+    """磁带里录下的生图响应（只与旧版正则对照结果）"""
+    cases = []
+    for index, interaction in enumerate(load_cassette(path)):
+        if interaction.method != "POST" or interaction.status != 200:
+            continue
+        try:
+            response = json.loads(interaction.body)
+            content = response["choices"][0]["message"]["content"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            continue
+        if isinstance(content, str) and content:
+            cases.append(Case(f"cassette_{index}", "recorded", content))
+    return cases
@@ -0,0 +1,206 @@
+"""本地假生图 API - OpenAI 兼容的 chat/completions 服务"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+import base64
+import json
+import random
+from typing import Dict, Optional
+
+from aiohttp import web
+
+from harness import make_png
+
+# 支持的响应形态
+SHAPES = ("markdown_url", "data_url", "raw_base64", "bare_url")
+
+# 损坏响应使用的 HTML 错误页（CDN 返回 200 但内容不是图片）
+_ERROR_PAGE = b"<!DOCTYPE html><html><body><h1>502 Bad Gateway</h1></body></html>"
+
+
+class FakeImageAPI:
+    """
+    可配置延迟、错误率与响应形态的假生图服务
+
+    POST /v1/chat/completions  返回 choices[0].message.content
+    GET  /images/<size>.png    返回对应大小的图片（URL 形态使用）
+    GET  /images/broken.png    返回 HTML 错误页（corrupt_rate 命中时的 URL 形态）
+
+    图片接口支持 Range 续传；download_drop_rate 命中时只发一半就断开连接。
+    slow_rate 命中的生图请求额外等待 slow_latency 秒（模拟长尾延迟）。
+    """
+
+    def __init__(
+        self,
+        shape: str = "data_url",
+        payload_bytes: int = 256 * 1024,
+        latency: float = 0.05,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 500,
+        download_latency: float = 0.0,
+        corrupt_rate: float = 0.0,
+        download_drop_rate: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_latency: float = 0.0,
+        seed: int = 0,
+    ):
+        if shape not in SHAPES:
+            raise ValueError(f"未知响应形态 {shape}，可选 {SHAPES}")
+        self.shape = shape
+        self.payload_bytes = payload_bytes
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.download_latency = download_latency
+        self.corrupt_rate = corrupt_rate
+        self.download_drop_rate = download_drop_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self._rng = random.Random(seed)
+        self._images: Dict[int, bytes] = {}
+        self._chat_body: Optional[bytes] = None
+        self._corrupt_body: Optional[bytes] = None
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url = ""
+        self.requests = 0
+        self.errors = 0
+        self.downloads = 0
+        self.corrupted = 0
+        self.dropped = 0
+        self.slow = 0
+
+    @property
+    def chat_url(self) -> str:
+        return f"{self.base_url}/v1/chat/completions"
+
+    def image_bytes(self, size: int) -> bytes:
+        if size not in self._images:
+            self._images[size] = make_png(size)
+        return self._images[size]
+
+    def make_content(self, corrupt: bool = False) -> str:
+        """按当前形态生成 message.content（corrupt=True 时图片被截断或换成错误页）"""
+        name = "broken" if corrupt else str(self.payload_bytes)
+        image_url = f"{self.base_url}/images/{name}.png"
+        if self.shape == "markdown_url":
+            return f"给你拍好啦！\n\n![selfie]({image_url})"
+        if self.shape == "bare_url":
+            return f"照片在这里 {image_url} 喜欢吗"
+        image = self.image_bytes(self.payload_bytes)
+        if corrupt:
+            image = image[:len(image) // 2]
+        b64 = base64.b64encode(image).decode("ascii")
+        if self.shape == "data_url":
+            return f"![selfie](data:image/png;base64,{b64})"
+        return b64
+
+    def _delay(self) -> float:
+        delay = self.latency if not self.jitter else max(0.0, self._rng.gauss(self.latency, self.jitter))
+        if self.slow_rate and self._rng.random() < self.slow_rate:
+            self.slow += 1
+            delay += self.slow_latency
+        return delay
+
+    async def _chat(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await request.read()
+        await asyncio.sleep(self._delay())
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"error": {"message": "fake upstream error"}}, status=self.error_status)
+        corrupt = bool(self.corrupt_rate) and self._rng.random() < self.corrupt_rate
+        if corrupt:
+            self.corrupted += 1
+        return web.Response(body=self._chat_response_body(corrupt), content_type="application/json")
+
+    def _chat_response_body(self, corrupt: bool = False) -> bytes:
+        """
+        响应体只序列化一次（正常/损坏各一份）
+
+        假服务和被测插件跑在同一个事件循环上，每次都编码几 MB 的 JSON
+        会把服务端自己的开销算进插件的事件循环延迟里。
+        """
+        if corrupt:
+            if self._corrupt_body is None:
+                self._corrupt_body = self._encode_chat(self.make_content(corrupt=True))
+            return self._corrupt_body
+        if self._chat_body is None:
+            self._chat_body = self._encode_chat(self.make_content())
+        return self._chat_body
+
+    @staticmethod
+    def _encode_chat(content: str) -> bytes:
+        return json.dumps({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "choices": [{
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content},
+                }],
+                "usage": {"prompt_tokens": 1200, "completion_tokens": 1290, "total_tokens": 2490},
+            }).encode("utf-8")
+
+    async def _image(self, request: web.Request) -> web.Response:
+        self.downloads += 1
+        if self.download_latency:
+            await asyncio.sleep(self.download_latency)
+        name = request.match_info["size"]
+        if name == "broken":
+            return web.Response(body=_ERROR_PAGE, content_type="text/html")
+
+        image = self.image_bytes(int(name))
+        start = 0
+        range_header = request.headers.get("Range", "")
+        if range_header.startswith("bytes=") and range_header.endswith("-"):
+            start = int(range_header[6:-1])
+        headers = {"Accept-Ranges": "bytes", "ETag": f'"{len(image)}"'}
+        status = 200
+        if start:
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{len(image) - 1}/{len(image)}"
+
+        body = image[start:]
+        resp = web.StreamResponse(status=status, headers=headers)
+        resp.content_type = "image/png"
+        resp.content_length = len(body)
+        await resp.prepare(request)
+        if self.download_drop_rate and self._rng.random() < self.download_drop_rate:
+            # 发一半后直接断开，客户端应带 Range 续传
+            self.dropped += 1
+            await resp.write(body[:len(body) // 2])
+            request.transport.close()
+            return resp
+        await resp.write(body)
+        await resp.write_eof()
+        return resp
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """启动服务，返回 base_url"""
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post("/v1/chat/completions", self._chat)
+        app.router.add_get("/images/{size:(\\d+|broken)}.png", self._image)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_host, bound_port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{bound_host}:{bound_port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self) -> "FakeImageAPI":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
@@ -0,0 +1,396 @@
+"""基准测试公共设施 - 加载插件包、桩化宿主 API、临时配置与统计"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+import enum
+import importlib.util
+import logging
+import os
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import types
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+PACKAGE_NAME = "selfie_plugin"
+
+
+# =============================================================================
+# 宿主 API 桩（仅在没有真实 MaiBot 环境时安装）
+# =============================================================================
+
+class SendRecorder:
+    """记录桩 send_api 的调用，可模拟平台上传延迟"""
+
+    def __init__(self, send_latency: float = 0.0):
+        self.send_latency = send_latency
+        self.images = 0
+        self.image_bytes = 0
+        self.texts = 0
+
+    async def image_to_stream(self, image_base64: str, stream_id: str, *args, **kwargs) -> bool:
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self.images += 1
+        self.image_bytes += len(image_base64)
+        return True
+
+    async def text_to_stream(self, text: str, stream_id: str, *args, **kwargs) -> bool:
+        self.texts += 1
+        return True
+
+
+def install_host_stubs(send_latency: float = 0.0, verbose: bool = False) -> SendRecorder:
+    """
+    安装 src.common.logger / src.plugin_system 的最小桩
+
+    Returns:
+        send_api 调用记录器
+    """
+    recorder = SendRecorder(send_latency)
+    logging.basicConfig(
+        level=logging.DEBUG if verbose else logging.WARNING,
+        format="%(asctime)s %(name)s %(levelname)s %(message)s",
+    )
+
+    if "src.plugin_system" in sys.modules and not getattr(sys.modules["src"], "__selfie_stub__", False):
+        # 真实宿主环境：只替换 send_api 的发送函数
+        apis = sys.modules["src.plugin_system.apis"]
+        apis.send_api.image_to_stream = recorder.image_to_stream
+        apis.send_api.text_to_stream = recorder.text_to_stream
+        return recorder
+
+    src = types.ModuleType("src")
+    src.__selfie_stub__ = True
+    src.__path__ = []
+    common = types.ModuleType("src.common")
+    common.__path__ = []
+    logger_mod = types.ModuleType("src.common.logger")
+    logger_mod.get_logger = logging.getLogger
+
+    plugin_system = types.ModuleType("src.plugin_system")
+    plugin_system.__path__ = []
+
+    class _Component:
+        def __init__(self, *args, **kwargs):
+            self.plugin_config = kwargs.get("plugin_config", {})
+
+        def get_config(self, key: str, default: Any = None) -> Any:
+            return default
+
+    class BasePlugin(_Component):
+        pass
+
+    class BaseTool(_Component):
+        chat_id: Optional[str] = None
+
+        @classmethod
+        def get_tool_info(cls):
+            return {"name": cls.name}
+
+    class BaseEventHandler(_Component):
+        @classmethod
+        def get_handler_info(cls):
+            return {"name": cls.handler_name}
+
+    class BaseCommand(_Component):
+        matched_groups: Dict[str, Any] = {}
+
+        @classmethod
+        def get_command_info(cls):
+            return {"name": cls.command_name}
+
+        async def send_text(self, text: str) -> bool:
+            return await recorder.text_to_stream(text, "")
+
+        async def send_image(self, image_base64: str) -> bool:
+            return await recorder.image_to_stream(image_base64, "")
+
+    class ConfigField:
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    class ToolParamType(enum.Enum):
+        STRING = "string"
+
+    class EventType(enum.Enum):
+        ON_START = "on_start"
+
+    plugin_system.BasePlugin = BasePlugin
+    plugin_system.BaseTool = BaseTool
+    plugin_system.BaseEventHandler = BaseEventHandler
+    plugin_system.BaseCommand = BaseCommand
+    plugin_system.ConfigField = ConfigField
+    plugin_system.ToolParamType = ToolParamType
+    plugin_system.EventType = EventType
+    plugin_system.register_plugin = lambda cls: cls
+
+    apis = types.ModuleType("src.plugin_system.apis")
+    apis.send_api = types.SimpleNamespace(
+        image_to_stream=recorder.image_to_stream,
+        text_to_stream=recorder.text_to_stream,
+    )
+    apis.chat_api = types.SimpleNamespace(get_group_streams=lambda: [])
+    apis.config_api = types.SimpleNamespace(get_global_config=lambda key, default=None: default)
+    plugin_system.apis = apis
+
+    sys.modules.update({
+        "src": src,
+        "src.common": common,
+        "src.common.logger": logger_mod,
+        "src.plugin_system": plugin_system,
+        "src.plugin_system.apis": apis,
+    })
+    return recorder
+
+
+def load_plugin() -> types.ModuleType:
+    """以包的形式加载插件目录（目录名不必是合法模块名）"""
+    if PACKAGE_NAME in sys.modules:
+        return sys.modules[PACKAGE_NAME]
+    spec = importlib.util.spec_from_file_location(
+        PACKAGE_NAME,
+        PLUGIN_DIR / "__init__.py",
+        submodule_search_locations=[str(PLUGIN_DIR)],
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE_NAME] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# =============================================================================
+# 临时配置
+# =============================================================================
+
+def _toml_value(value: Any) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_toml_value(v) for v in value) + "]"
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def write_bench_config(directory: Path, sections: Dict[str, Dict[str, Any]]):
+    """在临时目录写入默认配置副本和覆盖项（sections 键为 TOML 表名）"""
+    shutil.copy(PLUGIN_DIR / "config.default.toml", directory / "config.default.toml")
+    lines = ["config_version = 1", ""]
+    for table, values in sections.items():
+        lines.append(f"[{table}]")
+        lines.extend(f"{key} = {_toml_value(value)}" for key, value in values.items())
+        lines.append("")
+    (directory / "config.toml").write_text("\n".join(lines), encoding="utf-8")
+
+
+def use_bench_config(api_base: str, overrides: Optional[Dict[str, Dict[str, Any]]] = None) -> Path:
+    """
+    生成无冷却、无上限、放行所有群的临时配置（历史库也放在临时目录）并让插件使用它
+
+    Returns:
+        临时配置目录
+    """
+    from selfie_plugin.core import config_snapshot, runtime
+
+    directory = Path(tempfile.mkdtemp(prefix="selfie_bench_"))
+    sections: Dict[str, Dict[str, Any]] = {
+        "plugin": {"enabled": True, "debug_mode": False},
+        "selfie": {"cooldown_seconds": 0, "max_daily_selfies": 10 ** 9},
+        "selfie.api": {"api_base": api_base, "api_key": "bench-key", "max_retries": 0},
+        "selfie.permission": {"allow_all": True},
+        "selfie.history": {"db_path": str(directory / "selfie_history.db")},
+        "selfie.rate_limit": {"enabled": False, "state_path": str(directory / "rate_limits.json")},
+        "selfie.budget": {"state_path": str(directory / "usage.json")},
+        "selfie.scheduler": {"max_concurrent": 0, "interactive_concurrency": 0},
+        "selfie.journal": {"path": str(directory / "jobs.db")},
+    }
+    for table, values in (overrides or {}).items():
+        sections.setdefault(table, {}).update(values)
+
+    write_bench_config(directory, sections)
+    store = config_snapshot.ConfigStore(directory)
+    store.load()
+    config_snapshot.set_config_store(store)
+    runtime.reset_runtime()
+    return directory
+
+
+# =============================================================================
+# 统计
+# =============================================================================
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """线性插值分位数（q 取 0~1）"""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q
+    lower = int(pos)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (pos - lower)
+
+
+def current_rss() -> int:
+    """当前 RSS（字节）；非 Linux 平台退回到进程峰值"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RssSampler:
+    """后台采样 RSS，记录场景期间的峰值"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "RssSampler":
+        self.baseline = self.peak = current_rss()
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self.peak = max(self.peak, current_rss())
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, current_rss())
+            await asyncio.sleep(self.interval)
+
+
+class LagSampler:
+    """后台测量事件循环调度延迟（唤醒时间比预期晚多少）"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "LagSampler":
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+
+async def run_concurrently(func, total: int, concurrency: int) -> Dict[str, Any]:
+    """
+    以固定并发执行 total 次 func()，返回延迟、吞吐、峰值 RSS 与事件循环延迟
+
+    func 返回真值视为成功。
+    """
+    latencies: List[float] = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                ok = await func()
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            if not ok:
+                failures += 1
+
+    async with RssSampler() as rss, LagSampler() as lag:
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        wall = time.perf_counter() - wall_start
+
+    return {
+        "requests": total,
+        "failures": failures,
+        "wall_s": wall,
+        "throughput": total / wall if wall else float("inf"),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_rss_mb": rss.peak / 2 ** 20,
+        "rss_delta_mb": (rss.peak - rss.baseline) / 2 ** 20,
+        "lag_p99_ms": percentile(lag.samples, 0.99) * 1000,
+        "lag_max_ms": max(lag.samples, default=0.0) * 1000,
+    }
+
+
+def print_table(rows: List[Dict[str, Any]], columns: Sequence[str]):
+    """打印对齐的结果表"""
+    def fmt(value: Any) -> str:
+        if isinstance(value, float):
+            return f"{value:.2f}"
+        return str(value)
+
+    cells = [[fmt(row.get(col, "")) for col in columns] for row in rows]
+    widths = [max(len(col), *(len(c[i]) for c in cells)) if cells else len(col) for i, col in enumerate(columns)]
+    print("  ".join(col.ljust(w) for col, w in zip(columns, widths)))
+    print("  ".join("-" * w for w in widths))
+    for c in cells:
+        print("  ".join(v.ljust(w) for v, w in zip(c, widths)))
+
+
+# =============================================================================
+# 测试数据
+# =============================================================================
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def make_png(size: int, width: int = 512) -> bytes:
+    """
+    生成约 size 字节的合法 PNG
+
+    随机 RGB 像素 + 不压缩的 zlib 流：体积可控、能通过插件的图片校验，
+    也不可再压缩，接近真实照片。
+    """
+    row = 1 + width * 3
+    height = max(1, size // row)
+    raw = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + _png_chunk(b"IDAT", zlib.compress(raw, 0))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def parse_size(text: str) -> int:
+    """解析 64k / 1m / 4096 这样的尺寸"""
+    text = text.strip().lower()
+    units = {"k": 1024, "m": 1024 ** 2}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
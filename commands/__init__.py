@@ -9,10 +9,13 @@ from typing import Tuple, Optional
 from src.plugin_system import BaseCommand
 from src.common.logger import get_logger
 
-from ..core import (
-    SelfieGenerator, SelfiePromptBuilder, TargetSelector, SelfieStyle, PhotoPerspective,
-    set_debug_mode, debug_log, is_stream_in_list, get_stream_id_info, get_current_activity,
-)
+# 生成器/运行时（及 aiohttp 等依赖）在首次执行时才导入，见 _execute()
+from ..core.utils import debug_log, get_stream_id_info, get_current_activity, get_trigger_user_id
+from ..core.metrics import REGISTRY, SEND_SECONDS, record_outcome
+from ..core.tracing import Trace, span, start_trace
+from ..core.deadline import PhaseTimeout, deadline_scope, run_phase
+from ..core.scheduler import PRIORITY_DEBUG
+from ..core.warmup import ensure_warm
 
 logger = get_logger("selfie_plugin.command")
 
@@ -26,6 +29,8 @@ class SelfieCommand(BaseCommand):
         /selfie 吃饭                - 指定活动
         /selfie 吃饭 selfie         - 指定活动和视角
         /selfie 吃饭 pov casual     - 指定活动、视角和质量
+        /selfie stats               - 查看运行指标摘要
+        /selfie stats raw           - 输出 Prometheus 文本格式指标
     """
 
     command_name = "selfie_command"
@@ -36,21 +41,50 @@ class SelfieCommand(BaseCommand):
         """从自主规划插件获取当前活动（使用详细信息）"""
         return get_current_activity()
 
+    async def _send_stats(self, raw: bool = False):
+        """发送指标（raw=True 时为 Prometheus 文本格式）"""
+        if raw:
+            await self.send_text(REGISTRY.render())
+            return
+        from ..core.runtime import get_runtime
+
+        runtime = get_runtime()
+        sections = [REGISTRY.render_summary()]
+        if runtime.history:
+            sections.append(runtime.history.format_summary())
+        if runtime.budget:
+            sections.append(f"{runtime.budget.format_summary()}\n自动触发节奏系数: {runtime.pacing_factor():.2f}")
+        body = "\n━━━━━━━━━━━━━━━━━━━━\n".join(sections)
+        await self.send_text(f"""[DEBUG] 自拍指标
+━━━━━━━━━━━━━━━━━━━━
+{body}
+━━━━━━━━━━━━━━━━━━━━""")
+
     async def execute(self) -> Tuple[bool, Optional[str], int]:
+        """执行命令（整个请求在一个 trace 内）"""
+        from ..core.runtime import get_runtime
+
+        await ensure_warm()
+        with start_trace("command") as trace, deadline_scope(get_runtime().config.timeouts.total):
+            return await self._execute(trace)
+
+    async def _execute(self, trace: Trace) -> Tuple[bool, Optional[str], int]:
         """执行命令"""
+        from ..core.runtime import get_runtime
+        from ..core.selfie_generator import SelfieStyle, PhotoPerspective
+
+        runtime = get_runtime()
+        cfg = runtime.config
+
         # 检查插件是否启用
-        if not self.get_config("plugin.enabled", True):
+        if not cfg.plugin.enabled:
             return True, None, 2
 
+        rate_key = None
+        job = None
         try:
-            # 初始化调试模式
-            debug_mode = self.get_config("plugin.debug_mode", False)
-            set_debug_mode(debug_mode)
-
-            # 获取配置
-            selfie_config = self.get_config("selfie", {})
-            permission_cfg = selfie_config.get("permission", {})
-            debug_groups = permission_cfg.get("debug_groups", [])
+            debug_mode = cfg.plugin.debug_mode
+            permission_cfg = cfg.permission
 
             # 权限检查：只有调试群可以使用 /selfie 命令
             stream_id = None
@@ -58,9 +92,11 @@ class SelfieCommand(BaseCommand):
                 stream_id = getattr(self.message.chat_stream, 'stream_id', None)
 
             debug_log(f"/selfie 命令 - {get_stream_id_info(stream_id) if stream_id else 'stream_id=None'}")
-            debug_log(f"debug_groups 配置: {debug_groups}")
+            debug_log(f"debug_groups 配置: {list(permission_cfg.debug_groups)}")
 
-            if not stream_id or not is_stream_in_list(stream_id, debug_groups):
+            with span("permission_check"):
+                is_debug_group = permission_cfg.is_debug(stream_id)
+            if not is_debug_group:
                 # 非调试群静默忽略，只输出到 console
                 logger.info(f"[调试命令] 群 {stream_id} 不在调试群列表中，已忽略 (配置格式提示: 使用 qq:群号 或直接填 hash)")
                 return True, None, 2
@@ -69,9 +105,15 @@ class SelfieCommand(BaseCommand):
             args_str = self.matched_groups.get("args", "") or ""
             args = args_str.strip().split() if args_str.strip() else []
 
-            # 初始化组件
-            generator = SelfieGenerator(selfie_config)
-            prompt_builder = SelfiePromptBuilder(selfie_config)
+            # 指标查询
+            if args and args[0].lower() == "stats":
+                await self._send_stats(raw=len(args) > 1 and args[1].lower() == "raw")
+                return True, None, 2
+
+            # 该群人设的组件
+            persona = runtime.persona_for(stream_id)
+            generator = persona.generator
+            prompt_builder = persona.prompt_builder
 
             # 解析活动（第一个参数，或自动获取）
             activity = None
@@ -113,9 +155,16 @@ class SelfieCommand(BaseCommand):
             if style is None:
                 style = generator.select_style()
 
-            # 获取API配置用于调试输出
-            api_cfg = selfie_config.get("api", {})
-            model = api_cfg.get("model", "unknown")
+            # 令牌桶限流（调试命令同样计入全局/群/用户配额）
+            rate_key = (stream_id, get_trigger_user_id(self))
+            allowed, reason = await runtime.acquire_rate(*rate_key)
+            if not allowed:
+                rate_key = None
+                record_outcome("command", "limited")
+                await self.send_text(f"[DEBUG] 限流: {reason}")
+                return True, None, 2
+
+            model = generator.model
 
             # 发送详细调试信息
             perspective_name = "自拍" if perspective == PhotoPerspective.SELFIE else "POV"
@@ -127,6 +176,7 @@ stream_id: {stream_id}
 activity: {activity}
 perspective: {perspective.value} ({perspective_name})
 style: {style.value} ({style_name})
+persona: {persona.name or '(全局)'}
 model: {model}
 ━━━━━━━━━━━━━━━━━━━━
 正在生成..."""
@@ -136,6 +186,7 @@ model: {model}
 
             # 构建prompt并生成
             prompt = prompt_builder.build_prompt(activity, style, perspective)
+            job = runtime.open_job("command", stream_id, activity, prompt, style.value, perspective.value)
 
             # 输出 prompt 到 console
             logger.info(f"[调试命令] Prompt:\n{prompt}")
@@ -148,36 +199,60 @@ model: {model}
 ━━━━━━━━━━━━━━━━━━━━"""
                 await self.send_text(prompt_msg)
 
-            image_base64, error = await generator.generate_selfie(prompt)
+            image_base64, error = await generator.generate_selfie(prompt, PRIORITY_DEBUG, enforce_limits=False)
 
             if error:
                 error_msg = f"""[DEBUG] 生成失败
 ━━━━━━━━━━━━━━━━━━━━
 error: {error}
-━━━━━━━━━━━━━━━━━━━━"""
+━━━━━━━━━━━━━━━━━━━━
+{trace.format_breakdown()}"""
                 await self.send_text(error_msg)
                 logger.error(f"[调试命令] 生成失败: {error}")
+                await runtime.refund_rate(*rate_key)
+                job.fail(error)
+                record_outcome("command", "generate_failed")
                 return True, None, 2
 
+            job.generated(image_base64)
+
             # 发送图片
-            success = await self.send_image(image_base64)
+            with SEND_SECONDS.time(source="command"), span("send", bytes=len(image_base64)):
+                try:
+                    success = await run_phase("send", self.send_image(image_base64), cfg.timeouts.send)
+                except PhaseTimeout as e:
+                    logger.warning(f"[调试命令] 发送图片超时: {e}")
+                    success = False
+            record_outcome("command", "success" if success else "send_failed")
+            runtime.record_send(
+                "command", "success" if success else "send_failed", stream_id, activity,
+                style=style.value, perspective=perspective.value, image_base64=image_base64,
+            )
+            job.finish(success)
 
             # 发送结果
             result_msg = f"""[DEBUG] 生成完成
 ━━━━━━━━━━━━━━━━━━━━
 success: {success}
 image_size: {len(image_base64) if image_base64 else 0} bytes (base64)
-━━━━━━━━━━━━━━━━━━━━"""
+━━━━━━━━━━━━━━━━━━━━
+{trace.format_breakdown()}"""
             await self.send_text(result_msg)
 
             if success:
                 logger.info(f"[调试命令] 照片发送成功")
             else:
                 logger.error(f"[调试命令] 照片发送失败")
+                await runtime.refund_rate(*rate_key)
 
             return True, None, 2
 
         except Exception as e:
             logger.error(f"[调试命令] 执行失败: {e}", exc_info=True)
+            if rate_key:
+                await runtime.refund_rate(*rate_key)
+            if job:
+                job.fail(str(e))
+            record_outcome("command", "error")
             await self.send_text(f"[DEBUG] Exception: {str(e)}")
             return True, None, 2
@@ -4,30 +4,46 @@
 // "We shape the void."
 """
 
-from .selfie_generator import SelfieGenerator, SelfieStyle, PhotoPerspective
-from .prompt_builder import SelfiePromptBuilder
-from .target_selector import TargetSelector
-from .utils import (
-    set_debug_mode,
-    is_debug_mode,
-    debug_log,
-    is_stream_in_list,
-    get_stream_id_info,
-    get_current_activity,
-    get_current_activity_detailed,
-)
+import importlib
+from typing import Any
 
-__all__ = [
-    "SelfieGenerator",
-    "SelfieStyle",
-    "PhotoPerspective",
-    "SelfiePromptBuilder",
-    "TargetSelector",
-    "set_debug_mode",
-    "is_debug_mode",
-    "debug_log",
-    "is_stream_in_list",
-    "get_stream_id_info",
-    "get_current_activity",
-    "get_current_activity_detailed",
-]
+# 导出名 -> 所在子模块（首次访问时才导入，避免插件加载时就拉起 aiohttp/sqlite3 等重依赖）
+_EXPORTS = {
+    "SelfieGenerator": "selfie_generator",
+    "SelfieStyle": "selfie_generator",
+    "PhotoPerspective": "selfie_generator",
+    "SelfiePromptBuilder": "prompt_builder",
+    "TargetSelector": "target_selector",
+    "SelfieConfig": "config_snapshot",
+    "ConfigStore": "config_snapshot",
+    "get_config_store": "config_snapshot",
+    "SelfieRuntime": "runtime",
+    "get_runtime": "runtime",
+    "DebugReporter": "debug_reporter",
+    "get_debug_dispatcher": "debug_reporter",
+    "schedule_warmup": "warmup",
+    "ensure_warm": "warmup",
+    "set_debug_mode": "utils",
+    "is_debug_mode": "utils",
+    "debug_log": "utils",
+    "is_stream_in_list": "utils",
+    "get_stream_id_info": "utils",
+    "get_trigger_user_id": "utils",
+    "get_current_activity": "utils",
+    "get_current_activity_detailed": "utils",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str) -> Any:
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module_name}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
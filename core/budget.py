@@ -0,0 +1,348 @@
+"""用量与预算 - 按接口/按天记账，按预算剩余比例调节触发节奏"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import json
+import sqlite3
+import time
+from dataclasses import asdict, dataclass, fields
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from src.common.logger import get_logger
+from .config_snapshot import BudgetSection
+from .metrics import REGISTRY
+from .utils import DebouncedJsonState
+
+if TYPE_CHECKING:
+    from .shared_state import SharedState, UsageDays
+
+logger = get_logger("selfie_plugin.budget")
+
+API_BYTES_TOTAL = REGISTRY.counter(
+    "selfie_api_bytes_total", "生图接口收发字节数", ("endpoint", "direction"),
+)
+API_TOKENS_TOTAL = REGISTRY.counter(
+    "selfie_api_tokens_total", "接口返回的 token 用量", ("endpoint", "kind"),
+)
+BUDGET_REMAINING = REGISTRY.gauge(
+    "selfie_budget_remaining_ratio", "预算剩余比例（未配置预算时为 1）", ("period",),
+)
+
+# 保留的按天明细（覆盖当月 + 上月即可）
+_KEEP_DAYS = 62
+
+
+@dataclass
+class UsageTotals:
+    """一段时间内某个接口的累计用量"""
+    requests: int = 0
+    errors: int = 0
+    bytes_out: int = 0
+    bytes_in: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+
+    def add(self, other: "UsageTotals"):
+        for f in fields(self):
+            setattr(self, f.name, getattr(self, f.name) + getattr(other, f.name))
+
+
+def estimate_cost(limits: BudgetSection, usage: UsageTotals) -> float:
+    """按配置的单价估算花费（单价为 0 的部分不计）"""
+    return (
+        usage.requests * limits.cost_per_request
+        + usage.prompt_tokens / 1000 * limits.cost_per_1k_prompt_tokens
+        + usage.completion_tokens / 1000 * limits.cost_per_1k_completion_tokens
+    )
+
+
+def _remaining(used: float, limit: float) -> Optional[float]:
+    """剩余比例（limit <= 0 表示不限，返回 None）"""
+    if limit <= 0:
+        return None
+    return max(0.0, 1.0 - used / limit)
+
+
+class BudgetTracker(DebouncedJsonState):
+    """
+    用量记账 + 预算调度策略
+
+    - record() 在每次生图 HTTP 请求后调用，按 (日期, 接口) 累加请求数、收发字节和 token
+    - check() 任一预算耗尽时拒绝生图
+    - pacing_factor() 比较 "预算剩余比例" 与 "时间剩余比例"：
+      花得比时间快时按比例降低触发概率，而不是上午就撞上硬上限
+
+    明细按防抖间隔写入 JSON（原子替换），在默认线程池执行。
+
+    开启共享状态（shared）时不写 JSON：按同样的防抖间隔把本进程新增的用量累加进共享库并读回所有进程的合计，
+    预算按合计判断（其他进程的花费最多滞后一个保存间隔）；check() 发现合计过期时安排一次同步，事件循环上不读库。
+    """
+
+    state_name = "用量记录"
+
+    def __init__(
+        self,
+        state_path: Path,
+        limits: BudgetSection,
+        save_interval: float = 10.0,
+        shared: Optional["SharedState"] = None,
+    ):
+        self._init_persistence(state_path, save_interval)
+        self.limits = limits
+        self.shared = shared
+        self._days: Dict[str, Dict[str, UsageTotals]] = {}
+        # 共享模式下尚未同步进共享库的用量，和上次同步的时间（monotonic）
+        self._pending: Dict[str, Dict[str, UsageTotals]] = {}
+        self._synced = 0.0
+        if shared is not None:
+            self.save()
+        else:
+            self._load()
+
+        BUDGET_REMAINING.set_function(lambda: self._remaining_ratio("day"), period="day")
+        BUDGET_REMAINING.set_function(lambda: self._remaining_ratio("month"), period="month")
+
+    def configure(self, limits: BudgetSection):
+        self.limits = limits
+
+    # =========================================================================
+    # 记账
+    # =========================================================================
+
+    def record(
+        self,
+        endpoint: str,
+        bytes_out: int,
+        bytes_in: int,
+        ok: bool,
+        usage: Optional[Dict[str, Any]] = None,
+    ):
+        """
+        记录一次接口请求（失败的请求也计数，多数服务商照样计费）
+
+        Args:
+            endpoint: 接口标签（host）
+            bytes_out: 请求体字节数
+            bytes_in: 响应体字节数
+            ok: 是否成功拿到图片
+            usage: 响应中的 usage 字段（OpenAI 兼容格式）
+        """
+        delta = UsageTotals(requests=1, errors=0 if ok else 1, bytes_out=bytes_out, bytes_in=bytes_in)
+        if isinstance(usage, dict):
+            for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+                value = usage.get(key)
+                if isinstance(value, (int, float)):
+                    setattr(delta, key, int(value))
+            if not delta.total_tokens:
+                delta.total_tokens = delta.prompt_tokens + delta.completion_tokens
+
+        API_BYTES_TOTAL.inc(bytes_out, endpoint=endpoint, direction="out")
+        API_BYTES_TOTAL.inc(bytes_in, endpoint=endpoint, direction="in")
+        if delta.prompt_tokens:
+            API_TOKENS_TOTAL.inc(delta.prompt_tokens, endpoint=endpoint, kind="prompt")
+        if delta.completion_tokens:
+            API_TOKENS_TOTAL.inc(delta.completion_tokens, endpoint=endpoint, kind="completion")
+
+        day = datetime.now().strftime("%Y-%m-%d")
+        with self._lock:
+            per_endpoint = self._days.setdefault(day, {})
+            per_endpoint.setdefault(endpoint, UsageTotals()).add(delta)
+            if self.shared is not None:
+                self._pending.setdefault(day, {}).setdefault(endpoint, UsageTotals()).add(delta)
+            self._mark_dirty()
+
+    def totals(self, prefix: str) -> UsageTotals:
+        """日期前缀（"2025-01-02" 为一天，"2025-01" 为一月）内所有接口的合计"""
+        result = UsageTotals()
+        with self._lock:
+            for day, per_endpoint in self._days.items():
+                if day.startswith(prefix):
+                    for usage in per_endpoint.values():
+                        result.add(usage)
+        return result
+
+    def by_endpoint(self, prefix: str) -> Dict[str, UsageTotals]:
+        """日期前缀内按接口的合计"""
+        result: Dict[str, UsageTotals] = {}
+        with self._lock:
+            for day, per_endpoint in self._days.items():
+                if day.startswith(prefix):
+                    for endpoint, usage in per_endpoint.items():
+                        result.setdefault(endpoint, UsageTotals()).add(usage)
+        return result
+
+    # =========================================================================
+    # 预算策略
+    # =========================================================================
+
+    def _period_remaining(self, period: str, now: Optional[datetime] = None) -> List[float]:
+        """某个周期内各项已配置预算的剩余比例"""
+        now = now or datetime.now()
+        limits = self.limits
+        if period == "day":
+            usage = self.totals(now.strftime("%Y-%m-%d"))
+            pairs = ((usage.requests, limits.daily_requests), (estimate_cost(limits, usage), limits.daily_cost))
+        else:
+            usage = self.totals(now.strftime("%Y-%m"))
+            pairs = ((usage.requests, limits.monthly_requests), (estimate_cost(limits, usage), limits.monthly_cost))
+        return [r for r in (_remaining(used, limit) for used, limit in pairs) if r is not None]
+
+    def _remaining_ratio(self, period: str) -> float:
+        return min(self._period_remaining(period), default=1.0)
+
+    def check(self) -> Tuple[bool, Optional[str]]:
+        """任一预算耗尽时拒绝"""
+        if self.shared is not None:
+            with self._lock:
+                if time.monotonic() - self._synced >= self._save_interval:
+                    # 读回其他进程的花费（在线程池里，下一次 check 生效）
+                    self._mark_dirty()
+        if self._remaining_ratio("day") <= 0:
+            return False, "今日预算已用完"
+        if self._remaining_ratio("month") <= 0:
+            return False, "本月预算已用完"
+        return True, None
+
+    def _time_remaining(self, period: str, now: datetime) -> float:
+        """周期内剩余时间比例（日预算只在 pacing 时段内计时）"""
+        if period == "day":
+            start = self.limits.pacing_start_hour
+            end = max(self.limits.pacing_end_hour, start + 1)
+            hour = now.hour + now.minute / 60 + now.second / 3600
+            if hour <= start:
+                return 1.0
+            return max(0.0, (end - min(hour, end)) / (end - start))
+
+        # 月：按天数线性
+        if now.month == 12:
+            next_month = now.replace(year=now.year + 1, month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+        else:
+            next_month = now.replace(month=now.month + 1, day=1, hour=0, minute=0, second=0, microsecond=0)
+        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        total = (next_month - month_start).total_seconds()
+        return max(0.0, (next_month - now).total_seconds() / total)
+
+    def pacing_factor(self, extra_daily: Optional[Tuple[int, int]] = None, now: Optional[datetime] = None) -> float:
+        """
+        触发概率的缩放系数（0~1）
+
+        对每项预算计算 剩余比例 / 剩余时间比例，取最小值并截断到 [0, 1]：
+        按时间均匀花费时为 1，花得越超前系数越小，耗尽时为 0。
+
+        Args:
+            extra_daily: 额外参与节奏计算的 (今日已用, 今日上限)，如每日自拍张数
+        """
+        now = now or datetime.now()
+        factor = 1.0
+        for period in ("day", "month"):
+            remaining = self._period_remaining(period, now)
+            if period == "day" and extra_daily and extra_daily[1] > 0:
+                remaining.append(_remaining(extra_daily[0], extra_daily[1]))
+            if not remaining:
+                continue
+            time_left = self._time_remaining(period, now)
+            budget_left = min(remaining)
+            if budget_left <= 0:
+                return 0.0
+            if time_left > 0:
+                factor = min(factor, budget_left / time_left)
+        return max(0.0, min(1.0, factor))
+
+    def format_summary(self) -> str:
+        """今日/本月用量摘要（用于 /selfie stats）"""
+        now = datetime.now()
+        lines = []
+        for label, prefix in (("今日", now.strftime("%Y-%m-%d")), ("本月", now.strftime("%Y-%m"))):
+            usage = self.totals(prefix)
+            cost = estimate_cost(self.limits, usage)
+            line = (
+                f"{label}用量: {usage.requests} 次请求 ({usage.errors} 失败), "
+                f"上行 {usage.bytes_out / 2 ** 20:.1f}MB / 下行 {usage.bytes_in / 2 ** 20:.1f}MB, "
+                f"{usage.total_tokens} tokens"
+            )
+            if cost:
+                line += f", 约 {cost:.2f}"
+            lines.append(line)
+        lines.append(f"预算剩余: 日 {self._remaining_ratio('day'):.0%} / 月 {self._remaining_ratio('month'):.0%}")
+        return "\n".join(lines)
+
+    # =========================================================================
+    # 持久化
+    # =========================================================================
+
+    def _load(self):
+        try:
+            raw = json.loads(self.state_path.read_bytes())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"用量记录读取失败，从零开始: {e}")
+            return
+
+        names = {f.name for f in fields(UsageTotals)}
+        for day, per_endpoint in (raw.get("days") or {}).items():
+            if not isinstance(per_endpoint, dict):
+                continue
+            for endpoint, values in per_endpoint.items():
+                if isinstance(values, dict):
+                    usage = UsageTotals(**{k: int(v) for k, v in values.items() if k in names})
+                    self._days.setdefault(str(day), {})[str(endpoint)] = usage
+
+    def save(self):
+        """写入状态文件；共享模式下改为与共享库同步"""
+        if self.shared is None:
+            super().save()
+            return
+        with self._lock:
+            pending = {
+                day: {endpoint: asdict(usage) for endpoint, usage in per_endpoint.items()}
+                for day, per_endpoint in self._pending.items()
+            }
+            self._pending = {}
+            self._dirty = False
+        keep_since = (datetime.now() - timedelta(days=_KEEP_DAYS)).strftime("%Y-%m-%d")
+        try:
+            merged = self.shared.sync_usage(pending, keep_since)
+        except sqlite3.Error as e:
+            logger.warning(f"同步共享用量失败，下次再试: {e}")
+            with self._lock:
+                for day, per_endpoint in pending.items():
+                    for endpoint, values in per_endpoint.items():
+                        self._pending.setdefault(day, {}).setdefault(endpoint, UsageTotals()).add(UsageTotals(**values))
+                self._dirty = True
+            return
+        with self._lock:
+            self._days = self._from_shared(merged)
+            # 同步期间新记的用量还没进共享库，叠加在合计上
+            for day, per_endpoint in self._pending.items():
+                for endpoint, usage in per_endpoint.items():
+                    self._days.setdefault(day, {}).setdefault(endpoint, UsageTotals()).add(usage)
+            self._synced = time.monotonic()
+
+    @staticmethod
+    def _from_shared(days: "UsageDays") -> Dict[str, Dict[str, UsageTotals]]:
+        names = {f.name for f in fields(UsageTotals)}
+        return {
+            day: {
+                endpoint: UsageTotals(**{k: int(v) for k, v in values.items() if k in names})
+                for endpoint, values in per_endpoint.items()
+            }
+            for day, per_endpoint in days.items()
+        }
+
+    def _snapshot(self) -> Dict[str, Any]:
+        """用量明细（只保留最近 _KEEP_DAYS 天）"""
+        for day in sorted(self._days)[:-_KEEP_DAYS]:
+            del self._days[day]
+        return {
+            "version": 1,
+            "days": {
+                day: {endpoint: asdict(usage) for endpoint, usage in per_endpoint.items()}
+                for day, per_endpoint in self._days.items()
+            },
+        }
@@ -0,0 +1,547 @@
+"""请求录制/回放 - 把生图接口和图片下载的真实响应（去掉密钥）录成压缩的磁带文件，离线按录制时的节奏或加速回放"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+import atexit
+import base64
+import gzip
+import hashlib
+import json
+import queue
+import re
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+import aiohttp
+from multidict import CIMultiDict
+
+from src.common.logger import get_logger
+from .config_snapshot import PLUGIN_DIR, CassetteSection
+from .metrics import REGISTRY
+
+logger = get_logger("selfie_plugin.cassette")
+
+CASSETTE_MODES = ("off", "record", "replay")
+
+CASSETTE_INTERACTIONS_TOTAL = REGISTRY.counter(
+    "selfie_cassette_interactions_total", "录制/回放的请求（recorded 已录制 / replayed 已回放 / missed 磁带里没有）", ("result",),
+)
+
+# 不写入磁带的请求头
+_SECRET_HEADERS = frozenset({
+    "authorization", "proxy-authorization", "cookie", "x-api-key", "api-key", "x-goog-api-key",
+})
+# 回放需要的响应头
+_KEPT_RESPONSE_HEADERS = ("Content-Type", "Content-Length", "Content-Range", "ETag", "Last-Modified")
+# URL 里的凭据：查询参数中的密钥/签名、user:pass@
+_SECRET_PARAM_RE = re.compile(
+    r"([?&](?:key|api_key|apikey|token|access_token|sig|signature|"
+    r"x-amz-signature|x-amz-credential|x-amz-security-token|x-goog-signature|x-goog-credential)=)"
+    r"[^&#\s\"'<>()\[\]\\]+",
+    re.IGNORECASE,
+)
+_USERINFO_RE = re.compile(r"(https?://)[^/@\s\"'<>]+@")
+
+REDACTED = "REDACTED"
+
+
+def redact(text: str, secrets: Iterable[str] = ()) -> str:
+    """去掉文本中的 API 密钥、URL 查询参数里的签名和 user:pass@（录制和回放按同样的规则处理 URL）"""
+    for secret in secrets:
+        if secret and secret in text:
+            text = text.replace(secret, REDACTED)
+    text = _USERINFO_RE.sub(r"\1", text)
+    return _SECRET_PARAM_RE.sub(r"\1" + REDACTED, text)
+
+
+def default_cassette_path() -> Path:
+    return PLUGIN_DIR / "data" / "cassette.jsonl.gz"
+
+
+def cassette_path(section: CassetteSection) -> Path:
+    return Path(section.path) if section.path else default_cassette_path()
+
+
+@dataclass
+class Interaction:
+    """一次录下的请求和响应（body 为完整响应体）"""
+    method: str
+    url: str
+    status: int
+    latency: float
+    body: bytes = field(repr=False)
+    headers: Dict[str, str] = field(default_factory=dict)
+    request: Dict[str, Any] = field(default_factory=dict)
+    recorded_at: float = 0.0
+
+    def to_json(self) -> str:
+        record: Dict[str, Any] = {
+            "method": self.method,
+            "url": self.url,
+            "status": self.status,
+            "latency": round(self.latency, 4),
+            "headers": self.headers,
+            "request": self.request,
+            "recorded_at": self.recorded_at,
+        }
+        try:
+            record["text"] = self.body.decode("utf-8")
+        except UnicodeDecodeError:
+            record["body_b64"] = base64.b64encode(self.body).decode("ascii")
+        return json.dumps(record, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, line: str) -> "Interaction":
+        record = json.loads(line)
+        if "text" in record:
+            body = record["text"].encode("utf-8")
+        else:
+            body = base64.b64decode(record.get("body_b64", ""))
+        return cls(
+            method=record["method"],
+            url=record["url"],
+            status=int(record["status"]),
+            latency=float(record.get("latency", 0.0)),
+            body=body,
+            headers=dict(record.get("headers") or {}),
+            request=dict(record.get("request") or {}),
+            recorded_at=float(record.get("recorded_at", 0.0)),
+        )
+
+    def json(self) -> Any:
+        """响应体按 JSON 解析（生图接口的响应）"""
+        return json.loads(self.body)
+
+
+def load_cassette(path: Path) -> List[Interaction]:
+    """读出磁带里的全部请求（文件由多个 gzip 成员拼接而成，最后一条写了一半时丢弃它）"""
+    interactions: List[Interaction] = []
+    if not Path(path).is_file():
+        logger.error(f"磁带文件不存在: {path}")
+        return interactions
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    interactions.append(Interaction.from_json(line))
+    except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+        logger.warning(f"磁带 {path} 末尾不完整，已读出 {len(interactions)} 条: {e}")
+    return interactions
+
+
+def _summarize_part(part: Any) -> Any:
+    """多模态消息里的参考图只留大小和摘要"""
+    if isinstance(part, dict) and part.get("type") == "image_url":
+        url = str((part.get("image_url") or {}).get("url", ""))
+        return {
+            "type": "image_url",
+            "bytes": len(url),
+            "sha1": hashlib.sha1(url.encode("utf-8", "replace")).hexdigest()[:12],
+        }
+    return part
+
+
+def summarize_request(data: Optional[bytes], headers: Optional[Mapping[str, str]]) -> Dict[str, Any]:
+    """请求的元数据：非敏感请求头、模型、消息（参考图替换为大小和摘要）"""
+    summary: Dict[str, Any] = {
+        "headers": {k: v for k, v in (headers or {}).items() if k.lower() not in _SECRET_HEADERS},
+    }
+    if not data:
+        return summary
+    summary["bytes"] = len(data)
+    try:
+        payload = json.loads(data)
+    except (ValueError, UnicodeDecodeError):
+        return summary
+    if isinstance(payload, dict):
+        summary["model"] = payload.get("model")
+        messages = []
+        for message in payload.get("messages") or []:
+            if not isinstance(message, dict):
+                continue
+            content = message.get("content")
+            if isinstance(content, list):
+                content = [_summarize_part(part) for part in content]
+            messages.append({"role": message.get("role"), "content": content})
+        summary["messages"] = messages
+    return summary
+
+
+# =============================================================================
+# 录制
+# =============================================================================
+
+@dataclass
+class _Capture:
+    """事件循环上收集的原始数据，脱敏、摘要和压缩都在写线程里做"""
+    method: str
+    url: str
+    status: int
+    latency: float
+    body: bytes = field(repr=False)
+    headers: Dict[str, str]
+    request_data: Optional[bytes] = field(repr=False)
+    request_headers: Dict[str, str]
+    recorded_at: float
+
+
+class CassetteRecorder:
+    """
+    录制器
+
+    - 每条请求压缩成一个 gzip 成员，单次 write 追加到磁带文件（多个进程/子进程可以录到同一个文件）
+    - 脱敏（API 密钥、URL 签名）、请求摘要和压缩在写线程完成，事件循环上只做入队
+    - 中途断开、带 Range 的续传请求不录（回放时没有意义）
+    """
+
+    def __init__(self, path: Path, secrets: Iterable[str] = ()):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.secrets: Set[str] = {s for s in secrets if s}
+        self.recorded = 0
+        self._queue: "queue.Queue[Optional[_Capture]]" = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer, name="selfie-cassette", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, capture: _Capture):
+        if not self._closed:
+            self._queue.put(capture)
+
+    def _writer(self):
+        while True:
+            capture = self._queue.get()
+            try:
+                if capture is None:
+                    return
+                self._write(capture)
+            except Exception as e:
+                logger.error(f"写入磁带失败: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, capture: _Capture):
+        secrets = tuple(self.secrets)
+        body = capture.body
+        content_type = capture.headers.get("Content-Type", "")
+        if not content_type.startswith("image/"):
+            try:
+                body = redact(body.decode("utf-8"), secrets).encode("utf-8")
+            except UnicodeDecodeError:
+                pass
+        request = summarize_request(capture.request_data, capture.request_headers)
+        interaction = Interaction(
+            method=capture.method,
+            url=redact(capture.url, secrets),
+            status=capture.status,
+            latency=capture.latency,
+            body=body,
+            headers=capture.headers,
+            request=json.loads(redact(json.dumps(request, ensure_ascii=False), secrets)),
+            recorded_at=capture.recorded_at,
+        )
+        blob = gzip.compress(interaction.to_json().encode("utf-8") + b"\n")
+        with open(self.path, "ab") as f:
+            f.write(blob)
+        self.recorded += 1
+        CASSETTE_INTERACTIONS_TOTAL.inc(result="recorded")
+
+    def flush(self):
+        """等待已排队的请求写完（测试和基准用，会阻塞调用线程）"""
+        if not self._closed:
+            self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+        try:
+            atexit.unregister(self.close)
+        except Exception:
+            pass
+
+
+class _RecordingContent:
+    def __init__(self, response: "_RecordingResponse"):
+        self._response = response
+
+    def iter_chunked(self, n: int):
+        return self._iter(n)
+
+    async def _iter(self, n: int):
+        async for chunk in self._response.raw.content.iter_chunked(n):
+            self._response.chunks.append(chunk)
+            yield chunk
+        self._response.complete = True
+
+
+class _RecordingResponse:
+    """透传真实响应，同时留下读到的响应体"""
+
+    def __init__(self, raw: aiohttp.ClientResponse):
+        self.raw = raw
+        self.chunks: List[bytes] = []
+        self.complete = False
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.raw, name)
+
+    async def read(self) -> bytes:
+        body = await self.raw.read()
+        self.chunks = [body]
+        self.complete = True
+        return body
+
+    @property
+    def content(self) -> _RecordingContent:
+        return _RecordingContent(self)
+
+
+class _RecordingRequest:
+    def __init__(self, recorder: CassetteRecorder, method: str, url: str, data: Any, headers: Any, request: Any):
+        self._recorder = recorder
+        self._method = method
+        self._url = url
+        self._data = data if isinstance(data, (bytes, bytearray)) else None
+        self._headers = dict(headers or {})
+        self._request = request
+        self._response: Optional[_RecordingResponse] = None
+        self._started = 0.0
+
+    async def __aenter__(self) -> _RecordingResponse:
+        self._started = time.monotonic()
+        self._response = _RecordingResponse(await self._request.__aenter__())
+        return self._response
+
+    async def __aexit__(self, exc_type, exc, tb) -> Optional[bool]:
+        try:
+            return await self._request.__aexit__(exc_type, exc, tb)
+        finally:
+            response = self._response
+            if exc_type is None and response is not None and response.complete and "Range" not in self._headers:
+                self._recorder.record(_Capture(
+                    method=self._method,
+                    url=str(self._url),
+                    status=response.raw.status,
+                    latency=time.monotonic() - self._started,
+                    body=b"".join(response.chunks),
+                    headers={k: response.raw.headers[k] for k in _KEPT_RESPONSE_HEADERS if k in response.raw.headers},
+                    request_data=bytes(self._data) if self._data is not None else None,
+                    request_headers=self._headers,
+                    recorded_at=time.time(),
+                ))
+
+
+class RecordingSession:
+    """录制模式下代替共享会话：请求照常发出，完整读完的响应写入磁带"""
+
+    def __init__(self, session: aiohttp.ClientSession, recorder: CassetteRecorder):
+        self.session = session
+        self._recorder = recorder
+
+    @property
+    def closed(self) -> bool:
+        return self.session.closed
+
+    def post(self, url: str, *, data: Any = None, headers: Any = None, **kwargs: Any) -> _RecordingRequest:
+        return _RecordingRequest(
+            self._recorder, "POST", url, data, headers, self.session.post(url, data=data, headers=headers, **kwargs),
+        )
+
+    def get(self, url: str, *, headers: Any = None, **kwargs: Any) -> _RecordingRequest:
+        return _RecordingRequest(self._recorder, "GET", url, None, headers, self.session.get(url, headers=headers, **kwargs))
+
+    async def close(self):
+        await self.session.close()
+
+
+# =============================================================================
+# 回放
+# =============================================================================
+
+class _ReplayContent:
+    def __init__(self, body: bytes):
+        self._body = body
+
+    def iter_chunked(self, n: int):
+        return self._iter(max(1, n))
+
+    async def _iter(self, n: int):
+        for start in range(0, len(self._body), n):
+            yield self._body[start:start + n]
+
+
+class _ReplayResponse:
+    """只实现生成器和下载器用到的那部分 aiohttp.ClientResponse"""
+
+    def __init__(self, interaction: Interaction):
+        self.status = interaction.status
+        self.headers = CIMultiDict(interaction.headers)
+        self.content_length = len(interaction.body)
+        self.content = _ReplayContent(interaction.body)
+        self._body = interaction.body
+
+    async def read(self) -> bytes:
+        return self._body
+
+
+class _ReplayRequest:
+    def __init__(self, player: "CassettePlayer", method: str, url: str, timeout: Optional[aiohttp.ClientTimeout]):
+        self._player = player
+        self._method = method
+        self._url = url
+        self._timeout = timeout
+
+    async def __aenter__(self) -> _ReplayResponse:
+        interaction = self._player.next(self._method, self._url)
+        delay = self._player.delay(interaction)
+        total = self._timeout.total if self._timeout is not None else None
+        if total is not None and delay > total:
+            # 录下的延迟超过本次请求的超时：和真实请求一样等到超时
+            await asyncio.sleep(total)
+            raise asyncio.TimeoutError()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return _ReplayResponse(interaction)
+
+    async def __aexit__(self, exc_type, exc, tb) -> Optional[bool]:
+        return None
+
+
+class CassettePlayer:
+    """
+    回放器
+
+    - 生图请求（POST）按录制顺序依次返回；URL 对不上（换了接口地址）时仍按顺序取 POST 记录
+    - 图片下载（GET）按脱敏后的 URL 查找，同一 URL 录了多次时依次返回
+    - 延迟 = 录制时的延迟 / speed（speed 为 0 时立即返回）；超过请求超时的按超时处理
+    - cycle 开启时磁带用完从头再来，否则返回 404
+    """
+
+    def __init__(self, interactions: List[Interaction], speed: float = 1.0, cycle: bool = True):
+        self.speed = speed
+        self.cycle = cycle
+        self.interactions = interactions
+        self._by_key: Dict[Tuple[str, str], List[Interaction]] = defaultdict(list)
+        self._posts: List[Interaction] = []
+        for interaction in interactions:
+            self._by_key[(interaction.method, interaction.url)].append(interaction)
+            if interaction.method == "POST":
+                self._posts.append(interaction)
+        self._positions: Dict[Any, int] = defaultdict(int)
+
+    @classmethod
+    def from_file(cls, path: Path, speed: float = 1.0, cycle: bool = True) -> "CassettePlayer":
+        return cls(load_cassette(path), speed, cycle)
+
+    def _take(self, key: Any, records: List[Interaction]) -> Optional[Interaction]:
+        position = self._positions[key]
+        if position >= len(records):
+            if not self.cycle or not records:
+                return None
+            position = 0
+        self._positions[key] = position + 1
+        return records[position]
+
+    def next(self, method: str, url: str) -> Interaction:
+        key = (method, redact(str(url)))
+        records = self._by_key.get(key)
+        interaction = None
+        if records:
+            interaction = self._take(key, records)
+        elif method == "POST":
+            interaction = self._take("POST", self._posts)
+        if interaction is None:
+            CASSETTE_INTERACTIONS_TOTAL.inc(result="missed")
+            return Interaction(method, key[1], 404, 0.0, "磁带中没有匹配的请求".encode("utf-8"))
+        CASSETTE_INTERACTIONS_TOTAL.inc(result="replayed")
+        return interaction
+
+    def delay(self, interaction: Interaction) -> float:
+        if self.speed <= 0:
+            return 0.0
+        return interaction.latency / self.speed
+
+
+class ReplaySession:
+    """回放模式下代替共享会话：不发出任何网络请求"""
+
+    closed = False
+
+    def __init__(self, player: CassettePlayer):
+        self.player = player
+
+    def post(self, url: str, *, timeout: Optional[aiohttp.ClientTimeout] = None, **kwargs: Any) -> _ReplayRequest:
+        return _ReplayRequest(self.player, "POST", url, timeout)
+
+    def get(self, url: str, *, timeout: Optional[aiohttp.ClientTimeout] = None, **kwargs: Any) -> _ReplayRequest:
+        return _ReplayRequest(self.player, "GET", url, timeout)
+
+    async def close(self):
+        pass
+
+
+# =============================================================================
+# 全局状态
+# =============================================================================
+
+_section = CassetteSection()
+_recorder: Optional[CassetteRecorder] = None
+_replay: Optional[ReplaySession] = None
+_recording_sessions: Dict[int, RecordingSession] = {}
+
+
+def wrap_session(session: aiohttp.ClientSession) -> Any:
+    """按当前模式包装共享会话（off 时原样返回）"""
+    if _replay is not None:
+        return _replay
+    if _recorder is not None:
+        wrapped = _recording_sessions.get(id(session))
+        if wrapped is None or wrapped.session is not session:
+            _recording_sessions.clear()
+            wrapped = _recording_sessions[id(session)] = RecordingSession(session, _recorder)
+        return wrapped
+    return session
+
+
+def get_recorder() -> Optional[CassetteRecorder]:
+    return _recorder
+
+
+def configure_cassette(section: CassetteSection, secrets: Iterable[str] = ()):
+    """应用 [selfie.cassette] 配置（模式、路径不变时只更新回放速度和脱敏用的密钥）"""
+    global _section, _recorder, _replay
+    mode = section.mode if section.mode in CASSETTE_MODES else "off"
+    if mode != section.mode:
+        logger.warning(f"未知的磁带模式 {section.mode}，可选 {CASSETTE_MODES}")
+    path = cassette_path(section)
+    unchanged = (_section.mode, cassette_path(_section), _section.cycle) == (mode, path, section.cycle)
+    _section = section
+    if unchanged and (_recorder is not None or _replay is not None or mode == "off"):
+        if _recorder is not None:
+            _recorder.secrets.update(s for s in secrets if s)
+        if _replay is not None:
+            _replay.player.speed = section.speed
+        return
+
+    if _recorder is not None:
+        _recorder.close()
+    _recorder, _replay = None, None
+    _recording_sessions.clear()
+    if mode == "record":
+        _recorder = CassetteRecorder(path, secrets)
+        logger.warning(f"正在录制生图请求到 {path}（API 密钥和 URL 签名已去除，提示词和响应原样保存）")
+    elif mode == "replay":
+        player = CassettePlayer.from_file(path, section.speed, section.cycle)
+        _replay = ReplaySession(player)
+        logger.warning(f"回放模式：生图请求由磁带 {path} 提供（{len(player.interactions)} 条），不会访问接口")
@@ -5,9 +5,12 @@
 """
 
 import os
-import shutil
+import hashlib
+import tempfile
+import threading
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 
 try:
     import tomllib  # Python 3.11+
@@ -32,7 +35,7 @@ def deep_merge(base: Dict[str, Any], override: Dict[str, Any]) -> Dict[str, Any]
     - base 中有但 override 中没有的键会保留
     """
     result = base.copy()
-    
+
     for key, value in override.items():
         if key in result and isinstance(result[key], dict) and isinstance(value, dict):
             # 递归合并嵌套字典
@@ -40,15 +43,87 @@ def deep_merge(base: Dict[str, Any], override: Dict[str, Any]) -> Dict[str, Any]
         else:
             # 直接覆盖
             result[key] = value
-    
+
     return result
 
 
+def diff_missing(default: Dict[str, Any], user: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    结构化差异：返回默认配置中有、用户配置中缺失的部分
+
+    结果只包含缺失的子树（保持嵌套结构），用户已有的值不会出现。
+    类型冲突（默认是表、用户是标量）以用户为准，不视为缺失。
+    """
+    missing = {}
+    for key, value in default.items():
+        if key not in user:
+            missing[key] = value
+        elif isinstance(value, dict) and isinstance(user[key], dict):
+            sub = diff_missing(value, user[key])
+            if sub:
+                missing[key] = sub
+    return missing
+
+
+def apply_missing(user: Dict[str, Any], missing: Dict[str, Any]) -> Dict[str, Any]:
+    """把 diff_missing 的结果就地补进用户配置（只触及缺失的键，不复制整棵树）"""
+    for key, value in missing.items():
+        if key in user and isinstance(user[key], dict) and isinstance(value, dict):
+            apply_missing(user[key], value)
+        else:
+            user[key] = value
+    return user
+
+
+def flatten_keys(tree: Dict[str, Any], prefix: str = "") -> list:
+    """把嵌套字典展开为点分路径列表（用于日志）"""
+    keys = []
+    for key, value in tree.items():
+        full_key = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict) and value:
+            keys.extend(flatten_keys(value, full_key))
+        else:
+            keys.append(full_key)
+    return keys
+
+
+def atomic_write_bytes(file_path: Path, data: bytes):
+    """
+    原子写文件：同目录临时文件 + fsync + rename
+
+    读者要么看到旧文件，要么看到完整的新文件，不会读到写了一半的内容。
+    """
+    file_path = Path(file_path)
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{file_path.name}.", suffix=".tmp", dir=str(file_path.parent))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+
+    # 目录项也落盘（部分平台不支持对目录 fsync，忽略即可）
+    try:
+        dir_fd = os.open(str(file_path.parent), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
 def load_toml(file_path: Path) -> Optional[Dict[str, Any]]:
     """加载 TOML 文件"""
     if not file_path.exists():
         return None
-    
+
     try:
         with open(file_path, "rb") as f:
             return tomllib.load(f)
@@ -58,118 +133,235 @@ def load_toml(file_path: Path) -> Optional[Dict[str, Any]]:
 
 
 def save_toml(file_path: Path, data: Dict[str, Any]) -> bool:
-    """保存 TOML 文件（需要 tomli_w）"""
+    """原子保存 TOML 文件（需要 tomli_w）"""
     if not HAS_TOMLI_W:
         logger.warning("tomli_w 未安装，无法保存配置文件")
         return False
-    
+
     try:
-        with open(file_path, "wb") as f:
-            tomli_w.dump(data, f)
+        atomic_write_bytes(file_path, tomli_w.dumps(data).encode("utf-8"))
         return True
     except Exception as e:
         logger.error(f"保存配置文件失败 {file_path}: {e}")
         return False
 
 
+# 文件戳：(mtime_ns, size, inode)，用于判断文件是否可能变化
+FileStamp = Optional[Tuple[int, int, int]]
+
+
+def _file_stamp(file_path: Path) -> FileStamp:
+    try:
+        st = file_path.stat()
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def _read_bytes(file_path: Path) -> Optional[bytes]:
+    try:
+        return file_path.read_bytes()
+    except OSError:
+        return None
+
+
+def _digest(data: Optional[bytes]) -> Optional[str]:
+    return hashlib.blake2b(data, digest_size=16).hexdigest() if data is not None else None
+
+
+@dataclass
+class _MergeCacheEntry:
+    """合并结果缓存：以两个文件的内容哈希为键，文件戳只用来跳过重新哈希"""
+    default_stamp: FileStamp
+    user_stamp: FileStamp
+    default_hash: Optional[str]
+    user_hash: Optional[str]
+    merged: Dict[str, Any]
+    dirty: bool = False  # 合并结果与磁盘内容不一致且尚未写回
+
+
+# 按插件目录缓存，进程内所有 ConfigManager 实例共享
+_merge_cache: Dict[Path, _MergeCacheEntry] = {}
+_merge_lock = threading.Lock()
+
+
 class ConfigManager:
     """配置管理器"""
-    
+
     def __init__(self, plugin_dir: Path):
         self.plugin_dir = Path(plugin_dir)
         self.default_config_path = self.plugin_dir / "config.default.toml"
         self.user_config_path = self.plugin_dir / "config.toml"
-    
+
     def ensure_user_config(self) -> Dict[str, Any]:
         """
         确保用户配置存在并与默认配置合并
-        
-        返回合并后的配置字典
+
+        先做结构化差异，只有内容确实需要变化（缺字段或版本升级）时才原子写回。
+        两个文件都没变时直接返回缓存结果，只花两次 stat。
+
+        返回合并后的配置字典（缓存共享，调用方不要修改）
+        """
+        with _merge_lock:
+            return self._merge(write=True)
+
+    def load_merged(self) -> Optional[Dict[str, Any]]:
         """
-        # 1. 加载默认配置
-        default_config = load_toml(self.default_config_path)
+        只读合并：加载用户配置并补全默认值，不写回文件（用于热重载）
+
+        用户配置存在但解析失败时返回 None
+        """
+        with _merge_lock:
+            return self._merge(write=False)
+
+    def _merge(self, write: bool) -> Optional[Dict[str, Any]]:
+        default_stamp = _file_stamp(self.default_config_path)
+        user_stamp = _file_stamp(self.user_config_path)
+        cached = _merge_cache.get(self.plugin_dir)
+        if cached and write and cached.dirty:
+            cached = None
+
+        # 1. 文件戳都没变：直接命中
+        if cached and cached.default_stamp == default_stamp and cached.user_stamp == user_stamp:
+            return cached.merged
+
+        # 2. 文件戳变了，但内容哈希可能没变（touch、复制覆盖等）
+        default_bytes = _read_bytes(self.default_config_path)
+        user_bytes = _read_bytes(self.user_config_path)
+        default_hash = _digest(default_bytes)
+        user_hash = _digest(user_bytes)
+        if cached and cached.default_hash == default_hash and cached.user_hash == user_hash:
+            cached.default_stamp = default_stamp
+            cached.user_stamp = user_stamp
+            return cached.merged
+
+        # 3. 真正需要解析与合并
+        default_config = self._parse(default_bytes, self.default_config_path)
         if default_config is None:
-            logger.warning("默认配置文件不存在，使用空配置")
+            logger.warning("默认配置文件不存在或无法解析，使用空配置")
             default_config = {}
-        
-        default_version = default_config.get("config_version", 1)
-        
-        # 2. 检查用户配置是否存在
-        if not self.user_config_path.exists():
+
+        dirty = False
+        if user_bytes is None:
+            if not write:
+                return default_config
             logger.info("用户配置不存在，从默认配置创建")
-            self._create_user_config_from_default()
-            return default_config
-        
-        # 3. 加载用户配置
-        user_config = load_toml(self.user_config_path)
-        if user_config is None:
-            logger.warning("用户配置加载失败，使用默认配置")
-            return default_config
-        
+            self._create_user_config_from_default(default_bytes)
+            user_stamp = _file_stamp(self.user_config_path)
+            user_hash = default_hash if default_bytes is not None else None
+            merged = default_config
+        else:
+            user_config = self._parse(user_bytes, self.user_config_path)
+            if user_config is None:
+                if not write:
+                    return None
+                logger.warning("用户配置加载失败，使用默认配置")
+                # 不缓存：用户修好文件后应立即生效
+                return default_config
+
+            merged, new_bytes, dirty = self._merge_user(default_config, user_config, user_bytes, write)
+            if new_bytes is not None:
+                user_stamp = _file_stamp(self.user_config_path)
+                user_hash = _digest(new_bytes)
+
+        _merge_cache[self.plugin_dir] = _MergeCacheEntry(
+            default_stamp=default_stamp,
+            user_stamp=user_stamp,
+            default_hash=default_hash,
+            user_hash=user_hash,
+            merged=merged,
+            dirty=dirty,
+        )
+        return merged
+
+    def _merge_user(
+        self,
+        default_config: Dict[str, Any],
+        user_config: Dict[str, Any],
+        user_bytes: bytes,
+        write: bool,
+    ) -> Tuple[Dict[str, Any], Optional[bytes], bool]:
+        """
+        合并用户配置（用户值优先），必要时写回
+
+        Returns:
+            (合并后的配置, 写入的新文件内容或 None, 是否仍有未写回的差异)
+        """
+        default_version = default_config.get("config_version", 1)
         user_version = user_config.get("config_version", 0)
-        
-        # 4. 检查版本兼容性
-        if user_version < default_version:
+
+        missing = diff_missing(default_config, user_config)
+        version_bump = user_version < default_version
+        # user_config 是本次刚解析出来的独立对象，可以就地补全
+        merged = apply_missing(user_config, missing)
+
+        if not missing and not version_bump:
+            return merged, None, False
+
+        if version_bump:
             logger.info(f"配置版本升级: {user_version} -> {default_version}")
-            # 合并配置，用户值优先
-            merged_config = deep_merge(default_config, user_config)
-            # 更新版本号
-            merged_config["config_version"] = default_version
-            
-            # 尝试保存合并后的配置
-            if HAS_TOMLI_W:
-                # 备份旧配置
-                backup_path = self.user_config_path.with_suffix(".toml.bak")
-                shutil.copy(self.user_config_path, backup_path)
-                logger.info(f"已备份旧配置到 {backup_path}")
-                
-                # 保存合并后的配置
-                if save_toml(self.user_config_path, merged_config):
-                    logger.info("配置已自动合并并保存")
-            else:
-                logger.info("检测到新配置项，但 tomli_w 未安装，请手动更新 config.toml")
-            
-            return merged_config
-        
-        # 5. 版本相同，直接合并（补充新字段）
-        merged_config = deep_merge(default_config, user_config)
-        
-        # 检查是否有新字段
-        new_fields = self._find_new_fields(default_config, user_config)
-        if new_fields:
-            logger.info(f"发现新配置字段: {new_fields}")
-            if HAS_TOMLI_W:
-                save_toml(self.user_config_path, merged_config)
-                logger.info("新字段已自动添加到用户配置")
-        
-        return merged_config
-    
-    def _create_user_config_from_default(self):
+            merged["config_version"] = default_version
+        if missing:
+            logger.info(f"发现新配置字段: {flatten_keys(missing)}")
+
+        if not write:
+            return merged, None, True
+        if not HAS_TOMLI_W:
+            logger.info("检测到新配置项，但 tomli_w 未安装，请手动更新 config.toml")
+            return merged, None, True
+
+        new_bytes = tomli_w.dumps(merged).encode("utf-8")
+        if new_bytes == user_bytes:
+            return merged, None, False
+
+        if version_bump:
+            self._backup_user_config(user_bytes)
+        try:
+            atomic_write_bytes(self.user_config_path, new_bytes)
+        except Exception as e:
+            logger.error(f"保存配置文件失败 {self.user_config_path}: {e}")
+            return merged, None, True
+
+        logger.info("配置已自动合并并保存")
+        return merged, new_bytes, False
+
+    def _parse(self, data: Optional[bytes], file_path: Path) -> Optional[Dict[str, Any]]:
+        if data is None:
+            return None
+        try:
+            return tomllib.loads(data.decode("utf-8"))
+        except Exception as e:
+            logger.error(f"加载配置文件失败 {file_path}: {e}")
+            return None
+
+    def _backup_user_config(self, user_bytes: bytes):
+        """备份旧配置（内容与已有备份相同则跳过）"""
+        backup_path = self.user_config_path.with_suffix(".toml.bak")
+        if _read_bytes(backup_path) == user_bytes:
+            return
+        try:
+            atomic_write_bytes(backup_path, user_bytes)
+            logger.info(f"已备份旧配置到 {backup_path}")
+        except Exception as e:
+            logger.warning(f"备份旧配置失败: {e}")
+
+    def _create_user_config_from_default(self, default_bytes: Optional[bytes] = None):
         """从默认配置创建用户配置"""
-        if self.default_config_path.exists():
-            shutil.copy(self.default_config_path, self.user_config_path)
-            logger.info(f"已创建用户配置: {self.user_config_path}")
-    
+        if default_bytes is None:
+            if not self.default_config_path.exists():
+                return
+            default_bytes = self.default_config_path.read_bytes()
+        atomic_write_bytes(self.user_config_path, default_bytes)
+        logger.info(f"已创建用户配置: {self.user_config_path}")
+
     def _find_new_fields(
-        self, 
-        default: Dict[str, Any], 
-        user: Dict[str, Any], 
+        self,
+        default: Dict[str, Any],
+        user: Dict[str, Any],
         prefix: str = ""
     ) -> list:
         """找出默认配置中有但用户配置中没有的字段"""
-        new_fields = []
-        
-        for key, value in default.items():
-            full_key = f"{prefix}.{key}" if prefix else key
-            
-            if key not in user:
-                new_fields.append(full_key)
-            elif isinstance(value, dict) and isinstance(user.get(key), dict):
-                new_fields.extend(
-                    self._find_new_fields(value, user[key], full_key)
-                )
-        
-        return new_fields
+        return flatten_keys(diff_missing(default, user), prefix)
 
 
 def get_merged_config(plugin_dir: Path) -> Dict[str, Any]:
@@ -0,0 +1,681 @@
+"""配置快照 - 类型化只读配置，支持热重载与变更通知"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import threading
+import time
+from dataclasses import MISSING, dataclass, field, fields, replace
+from pathlib import Path
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple, get_args, get_origin
+
+from src.common.logger import get_logger
+from .config_manager import ConfigManager
+from .utils import normalize_stream_id, debug_log
+
+logger = get_logger("selfie_plugin.config")
+
+# 插件根目录（core 的上一级）
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+
+
+_TRUE_STRINGS = ("true", "yes", "on", "1")
+_FALSE_STRINGS = ("false", "no", "off", "0")
+
+
+def _coerce(value: Any, annotation: Any) -> Any:
+    """
+    把 TOML 值转换成字段标注的类型（bool / int / float / str / Tuple[X, ...]）
+
+    能无损转换的才转换（"60" -> 60、3 -> 3.0、单个值 -> 一元组），否则抛 ValueError；
+    其他标注原样返回。
+    """
+    if get_origin(annotation) is tuple:
+        args = get_args(annotation)
+        if len(args) != 2 or args[1] is not Ellipsis:
+            return tuple(value) if isinstance(value, list) else value
+        items = value if isinstance(value, (list, tuple)) else [value]
+        return tuple(_coerce(item, args[0]) for item in items)
+    if annotation is bool:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, int) and value in (0, 1):
+            return bool(value)
+        if isinstance(value, str) and value.strip().lower() in _TRUE_STRINGS + _FALSE_STRINGS:
+            return value.strip().lower() in _TRUE_STRINGS
+        raise ValueError(f"不是布尔值: {value!r}")
+    if annotation is int:
+        if isinstance(value, bool):
+            raise ValueError(f"不是整数: {value!r}")
+        if isinstance(value, int):
+            return value
+        number = float(value.strip()) if isinstance(value, str) else value
+        if isinstance(number, float) and number.is_integer():
+            return int(number)
+        raise ValueError(f"不是整数: {value!r}")
+    if annotation is float:
+        if isinstance(value, bool):
+            raise ValueError(f"不是数字: {value!r}")
+        if isinstance(value, (int, float)):
+            return float(value)
+        if isinstance(value, str):
+            return float(value.strip())
+        raise ValueError(f"不是数字: {value!r}")
+    if annotation is str:
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return str(value)
+        raise ValueError(f"不是字符串: {value!r}")
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _section_values(cls, data: Dict[str, Any], table: str) -> Dict[str, Any]:
+    """
+    取出配置段认识的键并按字段类型转换（忽略未知键）
+
+    类型不对又转换不了的值记录警告并丢弃（该字段使用默认值），不让字符串之类的值流进运行时。
+    """
+    values = {}
+    for f in fields(cls):
+        if not f.init or f.name not in data:
+            continue
+        try:
+            values[f.name] = _coerce(data[f.name], f.type)
+        except (TypeError, ValueError) as e:
+            default = "" if f.default is MISSING else f" {f.default!r}"
+            logger.warning(f"配置项 [{table}].{f.name} 无效，使用默认值{default}: {e}")
+    return values
+
+
+def _build_section(cls, data: Any, table: str = ""):
+    """按 dataclass 字段从字典构建配置段"""
+    if not isinstance(data, dict):
+        data = {}
+    return cls(**_section_values(cls, data, table or cls.__name__))
+
+
+def _normalize_ids(config_ids: Tuple[str, ...]) -> Tuple[str, ...]:
+    """批量标准化群 ID（去重，保持顺序）"""
+    seen = {}
+    for config_id in config_ids:
+        seen.setdefault(normalize_stream_id(str(config_id)), None)
+    return tuple(seen)
+
+
+@dataclass(frozen=True)
+class PluginSection:
+    """[plugin]"""
+    enabled: bool = True
+    debug_mode: bool = False
+
+
+@dataclass(frozen=True)
+class LimitSection:
+    """[selfie] 顶层的冷却与上限"""
+    cooldown_seconds: int = 3600
+    max_daily_selfies: int = 5
+
+
+@dataclass(frozen=True)
+class ApiSection:
+    """[selfie.api]"""
+    api_base: str = ""
+    api_key: str = field(default="", repr=False)
+    model: str = "gemini-3-pro-image"
+    timeout: int = 120
+    max_retries: int = 2
+    # 备用接口地址：与 api_base 组成接口池，重试时依次切换
+    endpoints: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class CharacterSection:
+    """[selfie.character]"""
+    image_folder: str = ""
+    use_random_image: bool = True
+    # 为空时使用麦麦全局配置的 bot.nickname / personality.personality
+    nickname: str = ""
+    personality: str = ""
+    supported_formats: Tuple[str, ...] = ("jpg", "jpeg", "png", "webp")
+
+
+@dataclass(frozen=True)
+class StyleSection:
+    """[selfie.style]"""
+    professional_ratio: float = 0.3
+    casual_ratio: float = 0.7
+    selfie_ratio: float = 0.5
+    pov_ratio: float = 0.5
+    professional_desc: str = "光线很好，画面清晰，像是精心拍摄的"
+    casual_desc: str = "照片有点糊但是很真实，像是随手用手机拍的"
+    selfie_desc: str = "自拍照，能看到人物的脸和表情"
+    pov_desc: str = "第一人称视角，像是自己眼睛看到的场景"
+
+
+@dataclass(frozen=True)
+class TriggerSection:
+    """[selfie.trigger]"""
+    enable_llm_tool: bool = True
+    enable_activity_trigger: bool = True
+    activity_trigger_probability: float = 0.1
+    check_interval_seconds: int = 60
+    # 触发评分：按新颖度/间隔/群活跃度/时段/预算加权，关闭时退回固定概率 × 预算系数
+    smart_scoring: bool = True
+    min_novelty: float = 0.3
+    score_gain: float = 2.0
+    recency_full_hours: float = 3.0
+    weight_novelty: float = 1.0
+    weight_recency: float = 1.0
+    weight_audience: float = 0.5
+    weight_time_of_day: float = 1.0
+    weight_budget: float = 1.0
+    hour_weights: Tuple[float, ...] = ()
+
+
+@dataclass(frozen=True)
+class PermissionSection:
+    """[selfie.permission]，白名单在构建时一次性标准化为 stream_id 集合"""
+    allow_all: bool = False
+    allowed_groups: Tuple[str, ...] = ()
+    debug_groups: Tuple[str, ...] = ()
+    allowed_streams: FrozenSet[str] = field(init=False, repr=False, compare=False)
+    debug_streams: Tuple[str, ...] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "allowed_streams", frozenset(_normalize_ids(self.allowed_groups)))
+        object.__setattr__(self, "debug_streams", _normalize_ids(self.debug_groups))
+
+    def is_allowed(self, stream_id: Optional[str]) -> bool:
+        """检查群是否允许自拍（allow_all 时总是允许）"""
+        if self.allow_all:
+            return True
+        if not stream_id:
+            return False
+        allowed = stream_id.lower() in self.allowed_streams
+        if not allowed:
+            debug_log(f"stream_id 不在白名单中: {stream_id}, 列表: {list(self.allowed_groups)}")
+        return allowed
+
+    def is_debug(self, stream_id: Optional[str]) -> bool:
+        """检查群是否为调试群"""
+        return bool(stream_id) and stream_id.lower() in self.debug_streams
+
+
+@dataclass(frozen=True)
+class TargetSection:
+    """[selfie.target]"""
+    selection_mode: str = "most_active"
+    activity_window_minutes: int = 30
+    configured_groups: Tuple[str, ...] = ()
+    configured_streams: Tuple[str, ...] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "configured_streams", _normalize_ids(self.configured_groups))
+
+
+@dataclass(frozen=True)
+class DebugSection:
+    """[selfie.debug]"""
+    flush_interval_seconds: float = 0.0
+    max_parallel_sends: int = 4
+    max_pending_chars: int = 8000
+
+
+@dataclass(frozen=True)
+class HistorySection:
+    """[selfie.history]，按群的限制为 0/false 时不生效"""
+    enabled: bool = True
+    db_path: str = ""
+    retention_days: int = 90
+    group_cooldown_seconds: int = 0
+    group_max_daily: int = 0
+    no_repeat_activity: bool = False
+
+
+@dataclass(frozen=True)
+class RateLimitSection:
+    """[selfie.rate_limit]，per_hour <= 0 的作用域不限流"""
+    enabled: bool = True
+    state_path: str = ""
+    global_per_hour: float = 0.0
+    global_burst: int = 0
+    stream_per_hour: float = 1.0
+    stream_burst: int = 2
+    user_per_hour: float = 2.0
+    user_burst: int = 2
+
+
+@dataclass(frozen=True)
+class BudgetSection:
+    """[selfie.budget]，预算和单价为 0 时不限制 / 不计价"""
+    enabled: bool = True
+    state_path: str = ""
+    daily_requests: int = 0
+    monthly_requests: int = 0
+    daily_cost: float = 0.0
+    monthly_cost: float = 0.0
+    cost_per_request: float = 0.0
+    cost_per_1k_prompt_tokens: float = 0.0
+    cost_per_1k_completion_tokens: float = 0.0
+    pacing_start_hour: int = 8
+    pacing_end_hour: int = 24
+
+
+@dataclass(frozen=True)
+class OffloadSection:
+    """[selfie.offload]"""
+    executor: str = "thread"
+    max_workers: int = 2
+    min_bytes: int = 65536
+    lag_monitor_interval: float = 0.5
+
+
+@dataclass(frozen=True)
+class ImageSection:
+    """[selfie.image]，max_bytes / max_side / max_scan_bytes 为 0 时不限制"""
+    validate: bool = True
+    max_bytes: int = 2 * 1024 * 1024
+    max_side: int = 2048
+    output_format: str = "auto"
+    quality: int = 85
+    max_scan_bytes: int = 32 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class DownloadSection:
+    """[selfie.download]，max_bytes 为 0 时不限制"""
+    max_bytes: int = 20 * 1024 * 1024
+    timeout: float = 30.0
+    chunk_size: int = 65536
+    max_resumes: int = 2
+    allowed_content_types: Tuple[str, ...] = ("image/", "application/octet-stream", "binary/octet-stream")
+
+
+@dataclass(frozen=True)
+class TimeoutSection:
+    """[selfie.timeouts]，各阶段还受整体截止时间约束；为 0 时该项不限时"""
+    total: float = 180.0
+    connect: float = 10.0
+    first_byte: float = 0.0
+    body_read: float = 60.0
+    send: float = 30.0
+    min_attempt: float = 10.0
+    # 自适应超时：单次尝试的超时 = 近期延迟的 adaptive_quantile 分位数 × adaptive_multiplier，
+    # 限制在 [adaptive_min, adaptive_max] 内（adaptive_max 为 0 时取 [selfie.api].timeout）
+    adaptive: bool = False
+    adaptive_quantile: float = 0.99
+    adaptive_multiplier: float = 2.0
+    adaptive_min: float = 15.0
+    adaptive_max: float = 0.0
+    adaptive_min_samples: int = 20
+    latency_window: float = 1800.0
+
+
+@dataclass(frozen=True)
+class HedgeSection:
+    """[selfie.hedge]，默认关闭"""
+    enabled: bool = False
+    percentile: float = 0.95
+    min_samples: int = 20
+    initial_delay: float = 0.0
+    min_delay: float = 1.0
+    budget_ratio: float = 0.1
+    budget_burst: int = 3
+
+
+@dataclass(frozen=True)
+class SchedulerSection:
+    """[selfie.scheduler]，并发/队列上限为 0 时不限"""
+    max_concurrent: int = 4
+    interactive_concurrency: int = 0
+    debug_concurrency: int = 1
+    background_concurrency: int = 1
+    debug_priority: int = 1
+    max_queue: int = 8
+    background_max_wait: float = 60.0
+
+
+@dataclass(frozen=True)
+class JournalSection:
+    """[selfie.journal]，path 为空时使用插件 data 目录"""
+    enabled: bool = True
+    path: str = ""
+    deliver_generated: bool = True
+    resume_enqueued: bool = False
+    max_age: float = 1800.0
+    retention_days: int = 7
+
+
+@dataclass(frozen=True)
+class SharedStateSection:
+    """[selfie.shared_state]，默认关闭；多个进程要指向同一个 path"""
+    enabled: bool = False
+    path: str = ""
+    busy_timeout: float = 5.0
+
+
+@dataclass(frozen=True)
+class WorkerSection:
+    """[selfie.worker]，默认关闭（在本进程内生图）"""
+    enabled: bool = False
+    start_timeout: float = 20.0
+    restart_interval: float = 30.0
+
+
+@dataclass(frozen=True)
+class CassetteSection:
+    """[selfie.cassette]，mode 为 off / record / replay"""
+    mode: str = "off"
+    path: str = ""
+    speed: float = 1.0
+    cycle: bool = True
+
+
+@dataclass(frozen=True)
+class RefusalSection:
+    """[selfie.refusal]，cache_seconds 为 0 时不缓存"""
+    enabled: bool = True
+    retry_text_only: bool = False
+    cache_seconds: float = 600.0
+    cache_size: int = 256
+
+
+# 人设可以覆盖的配置段（limits 取人设表顶层的 cooldown_seconds / max_daily_selfies）
+PERSONA_SECTIONS = {
+    "limits": LimitSection,
+    "api": ApiSection,
+    "character": CharacterSection,
+    "style": StyleSection,
+}
+
+
+@dataclass(frozen=True)
+class PersonaProfile:
+    """[selfie.persona.profiles.<name>]：映射的群 + 对全局配置段的覆盖（未覆盖的字段沿用全局）"""
+    name: str
+    groups: Tuple[str, ...] = ()
+    # ((配置段, ((字段, 值), ...)), ...)，保持可哈希以便快照比较
+    overrides: Tuple[Tuple[str, Tuple[Tuple[str, Any], ...]], ...] = field(default=(), repr=False)
+    streams: FrozenSet[str] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "streams", frozenset(_normalize_ids(self.groups)))
+
+    @classmethod
+    def from_dict(cls, name: str, data: Dict[str, Any]) -> "PersonaProfile":
+        groups = data.get("groups", ())
+        overrides = []
+        for section, section_cls in PERSONA_SECTIONS.items():
+            source = data if section == "limits" else data.get(section, {})
+            if not isinstance(source, dict):
+                continue
+            table = f"selfie.persona.profiles.{name}" + ("" if section == "limits" else f".{section}")
+            items = tuple(sorted(_section_values(section_cls, source, table).items()))
+            if items:
+                overrides.append((section, items))
+        return cls(
+            name=name,
+            groups=tuple(str(g) for g in groups) if isinstance(groups, (list, tuple)) else (),
+            overrides=tuple(overrides),
+        )
+
+    @property
+    def overridden_sections(self) -> Set[str]:
+        return {section for section, _ in self.overrides}
+
+    def apply(self, config: "SelfieConfig") -> "SelfieConfig":
+        """在全局快照上叠加本人设的覆盖，返回该人设的有效配置"""
+        changes = {section: replace(getattr(config, section), **dict(items)) for section, items in self.overrides}
+        return replace(config, **changes) if changes else config
+
+
+@dataclass(frozen=True)
+class PersonaSection:
+    """[selfie.persona]，没有配置人设时所有群使用全局配置"""
+    default: str = ""
+    profiles: Tuple[PersonaProfile, ...] = ()
+
+    @classmethod
+    def from_dict(cls, data: Any) -> "PersonaSection":
+        if not isinstance(data, dict):
+            data = {}
+        raw_profiles = data.get("profiles", {})
+        if not isinstance(raw_profiles, dict):
+            raw_profiles = {}
+        return cls(
+            default=str(data.get("default", "")),
+            profiles=tuple(
+                PersonaProfile.from_dict(str(name), value)
+                for name, value in raw_profiles.items() if isinstance(value, dict)
+            ),
+        )
+
+    def get(self, name: str) -> Optional[PersonaProfile]:
+        for profile in self.profiles:
+            if profile.name == name:
+                return profile
+        return None
+
+    def resolve(self, stream_id: Optional[str]) -> Optional[PersonaProfile]:
+        """群映射的人设；未映射时取 default，都没有返回 None（使用全局配置）"""
+        if stream_id:
+            key = stream_id.lower()
+            for profile in self.profiles:
+                if key in profile.streams:
+                    return profile
+        return self.get(self.default) if self.default else None
+
+
+@dataclass(frozen=True)
+class SelfieConfig:
+    """
+    完整配置快照
+
+    只读、解析一次；version 在每次成功重载后递增，不参与相等比较。
+    """
+
+    plugin: PluginSection = field(default_factory=PluginSection)
+    limits: LimitSection = field(default_factory=LimitSection)
+    api: ApiSection = field(default_factory=ApiSection)
+    character: CharacterSection = field(default_factory=CharacterSection)
+    style: StyleSection = field(default_factory=StyleSection)
+    trigger: TriggerSection = field(default_factory=TriggerSection)
+    permission: PermissionSection = field(default_factory=PermissionSection)
+    target: TargetSection = field(default_factory=TargetSection)
+    debug: DebugSection = field(default_factory=DebugSection)
+    history: HistorySection = field(default_factory=HistorySection)
+    rate_limit: RateLimitSection = field(default_factory=RateLimitSection)
+    budget: BudgetSection = field(default_factory=BudgetSection)
+    offload: OffloadSection = field(default_factory=OffloadSection)
+    image: ImageSection = field(default_factory=ImageSection)
+    download: DownloadSection = field(default_factory=DownloadSection)
+    persona: PersonaSection = field(default_factory=PersonaSection)
+    hedge: HedgeSection = field(default_factory=HedgeSection)
+    timeouts: TimeoutSection = field(default_factory=TimeoutSection)
+    scheduler: SchedulerSection = field(default_factory=SchedulerSection)
+    journal: JournalSection = field(default_factory=JournalSection)
+    shared_state: SharedStateSection = field(default_factory=SharedStateSection)
+    worker: WorkerSection = field(default_factory=WorkerSection)
+    cassette: CassetteSection = field(default_factory=CassetteSection)
+    refusal: RefusalSection = field(default_factory=RefusalSection)
+    version: int = field(default=0, compare=False)
+
+    SECTIONS = (
+        "plugin", "limits", "api", "character", "style", "trigger",
+        "permission", "target", "debug", "history", "rate_limit", "budget", "offload",
+        "image", "download", "persona", "hedge", "timeouts", "scheduler", "journal", "shared_state",
+        "worker", "cassette", "refusal",
+    )
+
+    @classmethod
+    def from_dict(cls, raw: Dict[str, Any], version: int = 0) -> "SelfieConfig":
+        """从合并后的 TOML 字典构建快照"""
+        selfie = raw.get("selfie", {}) if isinstance(raw, dict) else {}
+        if not isinstance(selfie, dict):
+            selfie = {}
+        return cls(
+            plugin=_build_section(PluginSection, raw.get("plugin", {}), "plugin"),
+            limits=_build_section(LimitSection, selfie, "selfie"),
+            api=_build_section(ApiSection, selfie.get("api", {}), "selfie.api"),
+            character=_build_section(CharacterSection, selfie.get("character", {}), "selfie.character"),
+            style=_build_section(StyleSection, selfie.get("style", {}), "selfie.style"),
+            trigger=_build_section(TriggerSection, selfie.get("trigger", {}), "selfie.trigger"),
+            permission=_build_section(PermissionSection, selfie.get("permission", {}), "selfie.permission"),
+            target=_build_section(TargetSection, selfie.get("target", {}), "selfie.target"),
+            debug=_build_section(DebugSection, selfie.get("debug", {}), "selfie.debug"),
+            history=_build_section(HistorySection, selfie.get("history", {}), "selfie.history"),
+            rate_limit=_build_section(RateLimitSection, selfie.get("rate_limit", {}), "selfie.rate_limit"),
+            budget=_build_section(BudgetSection, selfie.get("budget", {}), "selfie.budget"),
+            offload=_build_section(OffloadSection, selfie.get("offload", {}), "selfie.offload"),
+            image=_build_section(ImageSection, selfie.get("image", {}), "selfie.image"),
+            download=_build_section(DownloadSection, selfie.get("download", {}), "selfie.download"),
+            persona=PersonaSection.from_dict(selfie.get("persona", {})),
+            hedge=_build_section(HedgeSection, selfie.get("hedge", {}), "selfie.hedge"),
+            timeouts=_build_section(TimeoutSection, selfie.get("timeouts", {}), "selfie.timeouts"),
+            scheduler=_build_section(SchedulerSection, selfie.get("scheduler", {}), "selfie.scheduler"),
+            journal=_build_section(JournalSection, selfie.get("journal", {}), "selfie.journal"),
+            shared_state=_build_section(SharedStateSection, selfie.get("shared_state", {}), "selfie.shared_state"),
+            worker=_build_section(WorkerSection, selfie.get("worker", {}), "selfie.worker"),
+            cassette=_build_section(CassetteSection, selfie.get("cassette", {}), "selfie.cassette"),
+            refusal=_build_section(RefusalSection, selfie.get("refusal", {}), "selfie.refusal"),
+            version=version,
+        )
+
+    def changed_sections(self, other: Optional["SelfieConfig"]) -> Set[str]:
+        """返回与另一个快照相比发生变化的配置段名"""
+        if other is None:
+            return set(self.SECTIONS)
+        return {name for name in self.SECTIONS if getattr(self, name) != getattr(other, name)}
+
+
+# 订阅回调: (新快照, 变化的配置段)
+ConfigListener = Callable[[SelfieConfig, Set[str]], None]
+
+
+class ConfigStore:
+    """
+    配置快照存储
+
+    首次加载走 ConfigManager 的合并流程；之后按 config.toml 的 mtime
+    检测变化（访问时节流检查，一次 stat），变化时重建快照并只通知
+    关心对应配置段的订阅者。
+    """
+
+    def __init__(self, plugin_dir: Path, check_interval: float = 2.0):
+        self._manager = ConfigManager(plugin_dir)
+        self._check_interval = check_interval
+        self._lock = threading.RLock()
+        self._snapshot: Optional[SelfieConfig] = None
+        self._file_stamp: Optional[Tuple[int, int]] = None
+        self._last_check: float = 0.0
+        self._listeners: List[Tuple[ConfigListener, Optional[FrozenSet[str]]]] = []
+
+    def _stat_stamp(self) -> Optional[Tuple[int, int]]:
+        """config.toml 的 (mtime_ns, size)，文件不存在返回 None"""
+        try:
+            st = self._manager.user_config_path.stat()
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    @property
+    def snapshot(self) -> SelfieConfig:
+        """当前快照（必要时检查文件变化）"""
+        return self.refresh()
+
+    def load(self) -> SelfieConfig:
+        """首次加载：确保用户配置存在并合并默认配置"""
+        with self._lock:
+            raw = self._manager.ensure_user_config()
+            self._file_stamp = self._stat_stamp()
+            self._last_check = time.monotonic()
+            self._install(SelfieConfig.from_dict(raw))
+            return self._snapshot
+
+    def refresh(self, force: bool = False) -> SelfieConfig:
+        """检查 config.toml 是否变化，变化则重载"""
+        if self._snapshot is None:
+            return self.load()
+
+        now = time.monotonic()
+        if not force and now - self._last_check < self._check_interval:
+            return self._snapshot
+
+        with self._lock:
+            self._last_check = now
+            stamp = self._stat_stamp()
+            if stamp == self._file_stamp:
+                return self._snapshot
+
+            raw = self._manager.load_merged()
+            if raw is None:
+                # 文件可能正在被编辑，保留旧快照，下次再试
+                logger.warning("配置文件重载失败，继续使用旧配置")
+                return self._snapshot
+
+            self._file_stamp = stamp
+            new_snapshot = SelfieConfig.from_dict(raw)
+            if new_snapshot == self._snapshot:
+                return self._snapshot
+            self._install(new_snapshot)
+            return self._snapshot
+
+    def _install(self, new_snapshot: SelfieConfig):
+        """替换快照并通知订阅者"""
+        old = self._snapshot
+        changed = new_snapshot.changed_sections(old)
+        version = old.version + 1 if old else 1
+        new_snapshot = SelfieConfig(**{name: getattr(new_snapshot, name) for name in SelfieConfig.SECTIONS}, version=version)
+        self._snapshot = new_snapshot
+
+        if old is not None:
+            logger.info(f"配置已重载 (v{version})，变化: {sorted(changed)}")
+
+        for listener, sections in list(self._listeners):
+            if sections is not None and not (sections & changed):
+                continue
+            try:
+                listener(new_snapshot, changed)
+            except Exception as e:
+                logger.error(f"配置变更回调失败: {e}", exc_info=True)
+
+    def subscribe(self, listener: ConfigListener, sections: Optional[Tuple[str, ...]] = None) -> Callable[[], None]:
+        """
+        订阅配置变更
+
+        Args:
+            listener: 回调 (新快照, 变化的配置段)
+            sections: 只关心的配置段，None 表示全部
+
+        Returns:
+            取消订阅函数
+        """
+        entry = (listener, frozenset(sections) if sections is not None else None)
+        with self._lock:
+            self._listeners.append(entry)
+
+        def unsubscribe():
+            with self._lock:
+                if entry in self._listeners:
+                    self._listeners.remove(entry)
+
+        return unsubscribe
+
+
+_store: Optional[ConfigStore] = None
+
+
+def get_config_store() -> ConfigStore:
+    """获取全局配置存储"""
+    global _store
+    if _store is None:
+        _store = ConfigStore(PLUGIN_DIR)
+    return _store
+
+
+def set_config_store(store: ConfigStore):
+    """替换全局配置存储（基准测试等场景指向临时配置目录）"""
+    global _store
+    _store = store
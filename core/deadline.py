@@ -0,0 +1,107 @@
+"""请求截止时间 - 入口处创建，沿调用链传递，每个阶段只能用剩余的时间"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+import math
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Iterator, Optional, TypeVar
+
+from .metrics import REGISTRY
+
+TIMEOUTS_TOTAL = REGISTRY.counter(
+    "selfie_timeouts_total", "各阶段超时次数", ("phase",),
+)
+
+T = TypeVar("T")
+
+# 剩余时间不足 1ms 时也给出一个正数（aiohttp 把 0 当作不限时）
+_MIN_TIMEOUT = 0.001
+
+
+class PhaseTimeout(asyncio.TimeoutError):
+    """某个阶段超时（阶段上限或整体截止时间，取先到者）"""
+
+    def __init__(self, phase: str, seconds: Optional[float] = None):
+        detail = f" ({seconds:.1f}秒)" if seconds is not None else ""
+        super().__init__(f"{phase} 超时{detail}")
+        self.phase = phase
+        TIMEOUTS_TOTAL.inc(phase=phase)
+
+
+class Deadline:
+    """一次请求的截止时间（单调时钟），seconds 为空或 <= 0 时不限时"""
+
+    __slots__ = ("expires_at",)
+
+    def __init__(self, seconds: Optional[float] = None):
+        self.expires_at = time.monotonic() + seconds if seconds and seconds > 0 else None
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return math.inf
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def cap(self, limit: Optional[float] = None) -> Optional[float]:
+        """阶段上限与剩余时间中较小的一个（limit 为空或 <= 0 表示阶段本身不限时；都不限时返回 None）"""
+        seconds = self.remaining()
+        if limit and limit > 0:
+            seconds = min(seconds, limit)
+        if math.isinf(seconds):
+            return None
+        return max(seconds, _MIN_TIMEOUT)
+
+    def check(self, phase: str):
+        """已经过了截止时间就抛出 PhaseTimeout"""
+        if self.expired:
+            raise PhaseTimeout(phase)
+
+
+_UNBOUNDED = Deadline()
+_current_deadline: ContextVar[Optional[Deadline]] = ContextVar("selfie_deadline", default=None)
+
+
+def current_deadline() -> Deadline:
+    """当前上下文的截止时间（没有设置时不限时）"""
+    return _current_deadline.get() or _UNBOUNDED
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float]) -> Iterator[Deadline]:
+    """
+    在入口处设置整体截止时间，嵌套时取更早的那个
+
+    用法:
+        with deadline_scope(cfg.timeouts.total):
+            ...
+    """
+    deadline = Deadline(seconds)
+    outer = _current_deadline.get()
+    if outer is not None and outer.remaining() < deadline.remaining():
+        deadline = outer
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+async def run_phase(phase: str, awaitable: Awaitable[T], limit: Optional[float] = None) -> T:
+    """在阶段上限和剩余时间内等待 awaitable，超时抛出 PhaseTimeout"""
+    seconds = current_deadline().cap(limit)
+    if seconds is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, seconds)
+    except PhaseTimeout:
+        raise
+    except asyncio.TimeoutError:
+        raise PhaseTimeout(phase, seconds) from None
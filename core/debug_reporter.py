@@ -0,0 +1,159 @@
+"""调试报告 - 合并单次请求的调试事件，后台并发发送到调试群"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+from typing import Dict, List, Optional, Sequence
+
+from src.plugin_system.apis import send_api
+from src.common.logger import get_logger
+from .metrics import REGISTRY
+
+logger = get_logger("selfie_plugin.debug")
+
+DEBUG_MESSAGES_TOTAL = REGISTRY.counter(
+    "selfie_debug_messages_total", "调试群消息", ("result",),
+)
+
+# 合并多条调试事件时的分隔
+_SEPARATOR = "\n\n"
+
+
+class DebugDispatcher:
+    """
+    调试消息分发器（进程内共享）
+
+    - submit() 不等待发送，生产调用路径不会被调试群拖慢
+    - 每个群同一时刻最多一个发送任务；发送期间到达的消息会合并进下一条
+    - 所有群共享并发上限
+    - 某个群积压超过字符上限时丢弃最旧的消息，并在下一条里注明丢弃数量
+    """
+
+    def __init__(self, max_parallel: int = 4, max_pending_chars: int = 8000):
+        self._max_parallel = max(1, max_parallel)
+        self._max_pending_chars = max(0, max_pending_chars)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._pending: Dict[str, List[str]] = {}
+        self._dropped: Dict[str, int] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def configure(self, max_parallel: int, max_pending_chars: int):
+        """更新参数（并发上限在下一批发送时生效）"""
+        if max(1, max_parallel) != self._max_parallel:
+            self._max_parallel = max(1, max_parallel)
+            self._semaphore = None
+        self._max_pending_chars = max(0, max_pending_chars)
+
+    def submit(self, stream_ids: Sequence[str], message: str):
+        """把消息排入各调试群的待发队列（stream_id 需已标准化）"""
+        for stream_id in stream_ids:
+            pending = self._pending.setdefault(stream_id, [])
+            pending.append(message)
+            self._trim(stream_id, pending)
+
+            task = self._tasks.get(stream_id)
+            if task is None or task.done():
+                self._tasks[stream_id] = asyncio.create_task(self._drain(stream_id))
+
+    def _trim(self, stream_id: str, pending: List[str]):
+        """背压：积压超过上限时丢弃最旧的消息（至少保留最新一条）"""
+        if not self._max_pending_chars:
+            return
+        total = sum(len(m) for m in pending)
+        while len(pending) > 1 and total > self._max_pending_chars:
+            total -= len(pending.pop(0))
+            self._dropped[stream_id] = self._dropped.get(stream_id, 0) + 1
+            DEBUG_MESSAGES_TOTAL.inc(result="dropped")
+
+    async def _drain(self, stream_id: str):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_parallel)
+        semaphore = self._semaphore
+
+        while self._pending.get(stream_id):
+            messages = self._pending.pop(stream_id)
+            dropped = self._dropped.pop(stream_id, 0)
+            text = _SEPARATOR.join(messages)
+            if dropped:
+                text = f"(调试消息积压，已丢弃 {dropped} 条)\n\n{text}"
+
+            async with semaphore:
+                try:
+                    await send_api.text_to_stream(text, stream_id)
+                    DEBUG_MESSAGES_TOTAL.inc(result="sent")
+                except Exception as e:
+                    DEBUG_MESSAGES_TOTAL.inc(result="failed")
+                    logger.debug(f"发送到 debug 群 {stream_id} 失败: {e}")
+
+        self._tasks.pop(stream_id, None)
+
+    @property
+    def pending_count(self) -> int:
+        """待发送的消息条数"""
+        return sum(len(messages) for messages in self._pending.values())
+
+    async def drain(self, timeout: Optional[float] = None):
+        """等待所有待发消息发送完毕（用于关闭和基准测试）"""
+        tasks = [t for t in self._tasks.values() if not t.done()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+
+_dispatcher: Optional[DebugDispatcher] = None
+
+
+def get_debug_dispatcher() -> DebugDispatcher:
+    """获取全局调试消息分发器"""
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = DebugDispatcher()
+    return _dispatcher
+
+
+class DebugReporter:
+    """
+    单次请求的调试报告
+
+    请求过程中 add() 收集事件，close() 时合并为每个调试群一条消息。
+    flush_interval > 0 时，第一条未发送事件之后最多等待这么久就先发一批，
+    避免长时间生成时调试群迟迟看不到 "正在生成"。
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        stream_ids: Sequence[str],
+        flush_interval: float = 0.0,
+        dispatcher: Optional[DebugDispatcher] = None,
+    ):
+        self.enabled = bool(enabled and stream_ids)
+        self._stream_ids = tuple(stream_ids)
+        self._flush_interval = flush_interval
+        self._dispatcher = dispatcher or get_debug_dispatcher()
+        self._events: List[str] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def add(self, message: str):
+        """记录一条调试事件（未启用时为空操作）"""
+        if not self.enabled:
+            return
+        self._events.append(message)
+        if self._flush_interval > 0 and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._flush_interval, self.flush)
+
+    def flush(self):
+        """立即把已收集的事件合并提交"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._events:
+            return
+        message = _SEPARATOR.join(self._events)
+        self._events = []
+        self._dispatcher.submit(self._stream_ids, message)
+
+    def close(self):
+        """请求结束：提交剩余事件"""
+        self.flush()
@@ -0,0 +1,187 @@
+"""图片下载 - 流式读取、大小/类型限制、断点续传"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+import re
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+
+from src.common.logger import get_logger
+from .config_snapshot import DownloadSection
+from .deadline import TIMEOUTS_TOTAL, current_deadline
+from .metrics import REGISTRY
+
+logger = get_logger("selfie_plugin.download")
+
+DOWNLOAD_BYTES_TOTAL = REGISTRY.counter(
+    "selfie_download_bytes_total", "CDN 图片下载字节数", ("endpoint",),
+)
+DOWNLOAD_THROUGHPUT = REGISTRY.histogram(
+    "selfie_download_throughput_bytes", "CDN 图片下载吞吐（字节/秒）", ("endpoint",),
+    buckets=(65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456),
+)
+DOWNLOAD_FAILURES_TOTAL = REGISTRY.counter(
+    "selfie_download_failures_total", "CDN 图片下载失败", ("reason",),
+)
+DOWNLOAD_RESUMES_TOTAL = REGISTRY.counter(
+    "selfie_download_resumes_total", "断点续传次数", ("result",),
+)
+
+_CONTENT_RANGE_RE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)")
+
+# 连接中断时可以续传的异常
+_INTERRUPTED = (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+class DownloadError(Exception):
+    """下载被拒绝或失败（reason 用作指标标签）"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+@dataclass
+class DownloadResult:
+    data: bytes
+    content_type: str
+    seconds: float
+    resumes: int
+
+    @property
+    def throughput(self) -> float:
+        """字节/秒"""
+        return len(self.data) / self.seconds if self.seconds > 0 else 0.0
+
+
+class _Buffer:
+    """
+    下载缓冲区
+
+    知道总长度时一次性预分配，分块写入 memoryview；不知道时按块追加。
+    两种情况都在写入前检查上限，超过 max_bytes 立即中止。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total: Optional[int] = None
+        self._data = bytearray()
+        self.size = 0
+
+    def preallocate(self, total: int):
+        if self.max_bytes > 0 and total > self.max_bytes:
+            raise DownloadError("too_large", f"图片过大 ({total} > {self.max_bytes} 字节)")
+        self.total = total
+        if len(self._data) < total:
+            self._data.extend(bytes(total - len(self._data)))
+
+    def write(self, chunk: bytes):
+        end = self.size + len(chunk)
+        if self.max_bytes > 0 and end > self.max_bytes:
+            raise DownloadError("too_large", f"图片超过 {self.max_bytes} 字节，已中止下载")
+        if self.total is not None and end <= len(self._data):
+            memoryview(self._data)[self.size:end] = chunk
+        else:
+            del self._data[self.size:]
+            self._data.extend(chunk)
+        self.size = end
+
+    def reset(self):
+        self.size = 0
+        self.total = None
+
+    def getvalue(self) -> bytes:
+        return bytes(memoryview(self._data)[:self.size])
+
+
+def _check_content_type(content_type: str, allowed: Tuple[str, ...]):
+    """按前缀匹配允许的 Content-Type（缺失时放行，交给后续图片校验）"""
+    if not content_type or not allowed:
+        return
+    lowered = content_type.lower()
+    if not any(lowered.startswith(prefix.lower()) for prefix in allowed):
+        raise DownloadError("content_type", f"不是图片 (Content-Type: {content_type})")
+
+
+async def download_image(
+    session: aiohttp.ClientSession,
+    url: str,
+    config: DownloadSection,
+    endpoint: str = "",
+) -> DownloadResult:
+    """
+    流式下载图片
+
+    - Content-Type 不在白名单、Content-Length 或实际字节数超过 max_bytes 时中止
+    - 连接中断时带 Range 头续传（服务端给 ETag/Last-Modified 时附带 If-Range），
+      服务端不支持 Range（返回 200）则从头重下；总耗时不超过 config.timeout 和请求剩余时间
+
+    Raises:
+        DownloadError
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    limit = current_deadline().cap(config.timeout)
+    deadline = started + (limit if limit is not None else float("inf"))
+    buffer = _Buffer(config.max_bytes)
+    content_type = ""
+    validator: Optional[str] = None
+    resumes = 0
+
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            TIMEOUTS_TOTAL.inc(phase="download")
+            raise DownloadError("timeout", f"下载超时 ({limit:.1f}秒)")
+
+        headers: Dict[str, str] = {}
+        if buffer.size:
+            headers["Range"] = f"bytes={buffer.size}-"
+            if validator:
+                headers["If-Range"] = validator
+
+        try:
+            timeout = aiohttp.ClientTimeout(total=remaining if remaining != float("inf") else None)
+            async with session.get(url, headers=headers, timeout=timeout) as resp:
+                if resp.status == 206 and buffer.size:
+                    match = _CONTENT_RANGE_RE.match(resp.headers.get("Content-Range", ""))
+                    if not match or int(match.group(1)) != buffer.size:
+                        raise DownloadError("bad_range", "续传返回的 Content-Range 不匹配")
+                    DOWNLOAD_RESUMES_TOTAL.inc(result="resumed")
+                elif resp.status == 200:
+                    if buffer.size:
+                        # 服务端不支持 Range 或资源已变化：从头开始
+                        DOWNLOAD_RESUMES_TOTAL.inc(result="restarted")
+                        buffer.reset()
+                    content_type = resp.headers.get("Content-Type", "")
+                    _check_content_type(content_type, config.allowed_content_types)
+                    validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+                    if resp.content_length is not None:
+                        buffer.preallocate(resp.content_length)
+                else:
+                    raise DownloadError(f"http_{resp.status}", f"HTTP {resp.status}")
+
+                async for chunk in resp.content.iter_chunked(config.chunk_size):
+                    buffer.write(chunk)
+
+            if buffer.total is not None and buffer.size < buffer.total:
+                raise aiohttp.ClientPayloadError(f"响应不完整 ({buffer.size}/{buffer.total})")
+            break
+
+        except _INTERRUPTED as e:
+            if resumes >= config.max_resumes:
+                raise DownloadError("interrupted", f"下载中断: {e or type(e).__name__}") from None
+            resumes += 1
+            logger.debug(f"下载中断，从 {buffer.size} 字节处续传 ({resumes}/{config.max_resumes}): {e}")
+
+    seconds = loop.time() - started
+    result = DownloadResult(buffer.getvalue(), content_type, seconds, resumes)
+    if endpoint:
+        DOWNLOAD_BYTES_TOTAL.inc(len(result.data), endpoint=endpoint)
+        DOWNLOAD_THROUGHPUT.observe(result.throughput, endpoint=endpoint)
+    return result
@@ -0,0 +1,138 @@
+"""请求对冲 - 生图请求超过近期延迟分位数仍未返回时补发一份，先成功者胜出"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from src.common.logger import get_logger
+from .config_snapshot import HedgeSection
+from .latency import get_latency_tracker
+from .metrics import REGISTRY
+
+logger = get_logger("selfie_plugin.hedge")
+
+HEDGE_TOTAL = REGISTRY.counter(
+    "selfie_hedge_total", "对冲请求（sent 补发 / won 补发胜出 / lost 补发被取消 / throttled 额度不足）", ("result",),
+)
+HEDGE_DELAY_SECONDS = REGISTRY.histogram(
+    "selfie_hedge_delay_seconds", "补发前等待的时间", (),
+)
+
+T = TypeVar("T")
+
+
+class HedgePolicy:
+    """
+    对冲策略
+
+    - 对冲延迟：主请求所在接口、模型近期成功响应延迟的 percentile 分位数（不低于 min_delay）；
+      样本不足 min_samples 时用 initial_delay，为 0 则不对冲
+    - 对冲额度：令牌桶，每个请求积累 budget_ratio 个令牌（上限 budget_burst），补发一次消耗 1 个，
+      补发请求因此长期不超过请求数的 budget_ratio
+    """
+
+    def __init__(self, section: Optional[HedgeSection] = None):
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self.configure(section or HedgeSection())
+
+    def configure(self, section: HedgeSection):
+        with self._lock:
+            self.section = section
+            self._tokens = min(self._tokens, float(section.budget_burst))
+
+    @property
+    def enabled(self) -> bool:
+        return self.section.enabled
+
+    def delay(self, endpoint: str, model: str) -> Optional[float]:
+        """主请求等待多久后补发（None 表示本次不对冲）"""
+        section = self.section
+        estimate = get_latency_tracker().quantile(endpoint, model, section.percentile, section.min_samples)
+        if estimate is None:
+            if section.initial_delay <= 0:
+                return None
+            estimate = section.initial_delay
+        return max(estimate, section.min_delay)
+
+    def on_request(self):
+        """每个主请求积累对冲额度"""
+        with self._lock:
+            self._tokens = min(float(self.section.budget_burst), self._tokens + self.section.budget_ratio)
+
+    def try_acquire(self) -> bool:
+        """消耗一次对冲额度"""
+        with self._lock:
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+        HEDGE_TOTAL.inc(result="throttled")
+        return False
+
+
+async def run_hedged(
+    primary: Callable[[], Awaitable[T]],
+    hedge: Callable[[], Awaitable[T]],
+    delay: float,
+    is_success: Callable[[T], bool],
+    may_hedge: Callable[[], bool],
+) -> Tuple[T, int]:
+    """
+    先发主请求，delay 秒内没有结束且 may_hedge() 允许时补发一份，取第一个成功的结果
+
+    主请求在 delay 内失败时直接返回失败（交给外层重试），不补发。
+    结束时取消并等待另一个请求收尾（让它的记账/清理照常执行）。
+
+    Returns:
+        (结果, 胜出者: 0 主请求 / 1 补发请求)；都失败时返回第一个失败结果，都抛异常时抛出第一个异常
+    """
+    tasks: Dict["asyncio.Future[T]", int] = {asyncio.ensure_future(primary()): 0}
+    try:
+        done, _ = await asyncio.wait(set(tasks), timeout=delay)
+        if not done and may_hedge():
+            HEDGE_TOTAL.inc(result="sent")
+            HEDGE_DELAY_SECONDS.observe(delay)
+            tasks[asyncio.ensure_future(hedge())] = 1
+
+        failure: Optional[Tuple[T, int]] = None
+        error: Optional[BaseException] = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=tasks.__getitem__):
+                if task.exception() is not None:
+                    error = error or task.exception()
+                    continue
+                result = task.result()
+                if is_success(result):
+                    if len(tasks) > 1:
+                        HEDGE_TOTAL.inc(result="won" if tasks[task] else "lost")
+                    return result, tasks[task]
+                if failure is None:
+                    failure = (result, tasks[task])
+        if failure is not None:
+            return failure
+        raise error
+    finally:
+        losers = [task for task in tasks if not task.done()]
+        for task in losers:
+            task.cancel()
+        if losers:
+            await asyncio.gather(*losers, return_exceptions=True)
+
+
+_policy = HedgePolicy()
+
+
+def get_hedge_policy() -> HedgePolicy:
+    """全局对冲策略（所有人设共用延迟统计和对冲额度）"""
+    return _policy
+
+
+def configure_hedging(section: HedgeSection):
+    """应用 [selfie.hedge] 配置"""
+    _policy.configure(section)
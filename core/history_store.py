@@ -0,0 +1,427 @@
+"""自拍历史 - 基于 SQLite 的持久化记录与查询"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import atexit
+import hashlib
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import astuple, dataclass, field, fields
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from src.common.logger import get_logger
+from .metrics import REGISTRY
+
+logger = get_logger("selfie_plugin.history")
+
+HISTORY_ROWS_TOTAL = REGISTRY.counter(
+    "selfie_history_rows_total", "历史记录写入行数", ("result",),
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts           REAL    NOT NULL,
+    kind         TEXT    NOT NULL,
+    source       TEXT    NOT NULL DEFAULT '',
+    outcome      TEXT    NOT NULL DEFAULT '',
+    stream_id    TEXT,
+    activity     TEXT,
+    style        TEXT,
+    perspective  TEXT,
+    model        TEXT,
+    duration_ms  REAL,
+    image_bytes  INTEGER,
+    image_sha1   TEXT,
+    trace_id     TEXT,
+    error        TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_history_ts ON history (ts);
+CREATE INDEX IF NOT EXISTS idx_history_stream_ts ON history (stream_id, ts);
+CREATE INDEX IF NOT EXISTS idx_history_activity_ts ON history (activity, ts);
+"""
+
+# 记录类型
+KIND_GENERATE = "generate"  # 一次生图（SelfieGenerator）
+KIND_SEND = "send"          # 一次发送到群（工具/活动/命令）
+
+
+@dataclass
+class HistoryRecord:
+    """一行历史记录（字段顺序即插入列顺序）"""
+    ts: float
+    kind: str
+    source: str = ""
+    outcome: str = ""
+    stream_id: Optional[str] = None
+    activity: Optional[str] = None
+    style: Optional[str] = None
+    perspective: Optional[str] = None
+    model: Optional[str] = None
+    duration_ms: Optional[float] = None
+    image_bytes: Optional[int] = None
+    image_sha1: Optional[str] = None
+    trace_id: Optional[str] = None
+    error: Optional[str] = None
+
+
+_COLUMNS = tuple(f.name for f in fields(HistoryRecord))
+_INSERT_SQL = f"INSERT INTO history ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})"
+
+
+def image_digest(image_base64: Optional[str]) -> Optional[str]:
+    """图片 base64 的 SHA-1（用于识别重复图片，不保存图片本身）"""
+    if not image_base64:
+        return None
+    return hashlib.sha1(image_base64.encode("ascii", errors="ignore")).hexdigest()
+
+
+def start_of_today() -> float:
+    """本地时区今天 0 点的时间戳（与每日上限的日期口径一致）"""
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+
+@dataclass
+class _FlushMarker:
+    """写线程处理到这里时置位，用于 flush() 等待"""
+    done: threading.Event = field(default_factory=threading.Event)
+
+
+class GroupReservation:
+    """
+    已通过按群检查、尚未发送的一次拍照（store 为空时是空操作）
+
+    在 release() 之前按一次成功发送计入该群的冷却/每日上限/当天活动，
+    生图期间同一个群的其他请求不会一起通过检查。发送成功时先 record_send 再 release，中间没有空档。
+    """
+
+    __slots__ = ("store", "record")
+
+    def __init__(self, store: Optional["HistoryStore"] = None, record: Optional[HistoryRecord] = None):
+        self.store = store
+        self.record = record
+
+    def release(self):
+        """结束预占（可重复调用）"""
+        if self.store is not None and self.record is not None:
+            self.store._release_group(self.record)
+        self.store = self.record = None
+
+
+class HistoryStore:
+    """
+    自拍历史存储
+
+    - WAL 模式，读写互不阻塞
+    - record() 只把记录放进队列，写线程批量 executemany + 单次提交，
+      事件循环上不会发生磁盘写入
+    - 已排队但尚未提交的记录也参与查询，冷却/上限判断不会因为批量延迟而漏算
+    - reserve_group() 把检查通过的拍照记为预占，发送前同样参与查询（检查和预占在同一把锁内）
+    - 查询都走 (stream_id, ts) / (activity, ts) / ts 索引
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        batch_size: int = 64,
+        flush_interval: float = 0.5,
+        retention_days: int = 0,
+    ):
+        self.db_path = Path(db_path)
+        self._batch_size = max(1, batch_size)
+        self._flush_interval = flush_interval
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._pending: List[HistoryRecord] = []
+        self._pending_lock = threading.Lock()
+        self._reserved: List[HistoryRecord] = []
+        self._group_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._closed = False
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(_SCHEMA)
+            if retention_days > 0:
+                with conn:
+                    deleted = conn.execute(
+                        "DELETE FROM history WHERE ts < ?", (time.time() - retention_days * 86400,),
+                    ).rowcount
+                if deleted:
+                    logger.info(f"清理了 {deleted} 条超过 {retention_days} 天的历史记录")
+        finally:
+            conn.close()
+        self._read_conn = self._connect(check_same_thread=False)
+
+        self._thread = threading.Thread(target=self._writer, name="selfie-history", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.db_path), timeout=10, check_same_thread=check_same_thread)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # =========================================================================
+    # 写入
+    # =========================================================================
+
+    def record(self, kind: str, **values: Any):
+        """
+        追加一条记录（非阻塞）
+
+        Args:
+            kind: generate / send
+            values: HistoryRecord 的其余字段
+        """
+        if self._closed:
+            return
+        rec = HistoryRecord(ts=values.pop("ts", None) or time.time(), kind=kind, **values)
+        with self._pending_lock:
+            self._pending.append(rec)
+        self._queue.put(rec)
+
+    def _writer(self):
+        """写线程：攒批后一次事务提交"""
+        conn = self._connect()
+        try:
+            while True:
+                item = self._queue.get()
+                batch: List[HistoryRecord] = []
+                markers: List[_FlushMarker] = []
+                stop = False
+
+                deadline = time.monotonic() + self._flush_interval
+                while True:
+                    if item is None:
+                        stop = True
+                    elif isinstance(item, _FlushMarker):
+                        markers.append(item)
+                    else:
+                        batch.append(item)
+                    if stop or markers or len(batch) >= self._batch_size:
+                        break
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+
+                if batch:
+                    self._write_batch(conn, batch)
+                for marker in markers:
+                    marker.done.set()
+                if stop:
+                    return
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[HistoryRecord]):
+        try:
+            with conn:
+                conn.executemany(_INSERT_SQL, [astuple(rec) for rec in batch])
+            HISTORY_ROWS_TOTAL.inc(len(batch), result="written")
+        except sqlite3.Error as e:
+            HISTORY_ROWS_TOTAL.inc(len(batch), result="failed")
+            logger.error(f"写入自拍历史失败 ({len(batch)} 条): {e}")
+        finally:
+            written = set(map(id, batch))
+            with self._pending_lock:
+                self._pending = [rec for rec in self._pending if id(rec) not in written]
+
+    def flush(self, timeout: Optional[float] = 5.0) -> bool:
+        """等待已排队的记录落盘（关闭和测试用，会阻塞调用线程）"""
+        if self._closed or not self._thread.is_alive():
+            return True
+        marker = _FlushMarker()
+        self._queue.put(marker)
+        return marker.done.wait(timeout)
+
+    def close(self):
+        """写完剩余记录并关闭"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        with self._read_lock:
+            self._read_conn.close()
+        try:
+            atexit.unregister(self.close)
+        except Exception:
+            pass
+
+    # =========================================================================
+    # 查询
+    # =========================================================================
+
+    def _query(self, sql: str, params: Tuple[Any, ...] = ()) -> List[Tuple[Any, ...]]:
+        with self._read_lock:
+            return self._read_conn.execute(sql, params).fetchall()
+
+    def _pending_sends(self, stream_id: str, since: float) -> List[HistoryRecord]:
+        """尚未落盘的成功发送记录，以及已预占、尚未发送的拍照"""
+        with self._pending_lock:
+            pending = [
+                rec for rec in self._pending
+                if rec.kind == KIND_SEND and rec.outcome == "success"
+                and rec.stream_id == stream_id and rec.ts >= since
+            ]
+            pending.extend(rec for rec in self._reserved if rec.stream_id == stream_id and rec.ts >= since)
+        return pending
+
+    def last_sent_at(self, stream_id: str) -> Optional[float]:
+        """该群最近一次成功发送的时间戳"""
+        rows = self._query(
+            "SELECT ts FROM history WHERE stream_id = ? AND kind = ? AND outcome = 'success' "
+            "ORDER BY ts DESC LIMIT 1",
+            (stream_id, KIND_SEND),
+        )
+        candidates = [rows[0][0]] if rows else []
+        candidates.extend(rec.ts for rec in self._pending_sends(stream_id, 0))
+        return max(candidates) if candidates else None
+
+    def count_sent_since(self, stream_id: str, since: float) -> int:
+        """该群自 since 以来成功发送的张数"""
+        rows = self._query(
+            "SELECT COUNT(*) FROM history WHERE stream_id = ? AND ts >= ? AND kind = ? AND outcome = 'success'",
+            (stream_id, since, KIND_SEND),
+        )
+        return rows[0][0] + len(self._pending_sends(stream_id, since))
+
+    def activities_since(self, stream_id: str, since: float) -> Set[str]:
+        """该群自 since 以来已发过照片的活动"""
+        rows = self._query(
+            "SELECT DISTINCT activity FROM history WHERE stream_id = ? AND ts >= ? AND kind = ? "
+            "AND outcome = 'success' AND activity IS NOT NULL",
+            (stream_id, since, KIND_SEND),
+        )
+        activities = {row[0] for row in rows}
+        activities.update(rec.activity for rec in self._pending_sends(stream_id, since) if rec.activity)
+        return activities
+
+    def check_group_limits(
+        self,
+        stream_id: Optional[str],
+        activity: Optional[str],
+        cooldown_seconds: int,
+        max_daily: int,
+        no_repeat_activity: bool,
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        按群检查冷却/每日上限/当天重复活动（参数为 0/False 表示不限制）
+
+        Returns:
+            (是否允许, 原因)
+        """
+        if not stream_id:
+            return True, None
+
+        if max_daily > 0:
+            count = self.count_sent_since(stream_id, start_of_today())
+            if count >= max_daily:
+                return False, f"本群今日已达上限({max_daily}张)"
+
+        if cooldown_seconds > 0:
+            last = self.last_sent_at(stream_id)
+            if last is not None:
+                elapsed = time.time() - last
+                if elapsed < cooldown_seconds:
+                    return False, f"本群冷却中({int(cooldown_seconds - elapsed)}秒)"
+
+        if no_repeat_activity and activity:
+            if activity.strip() in self.activities_since(stream_id, start_of_today()):
+                return False, f"今天已经拍过「{activity.strip()}」了"
+
+        return True, None
+
+    def reserve_group(
+        self,
+        stream_id: Optional[str],
+        activity: Optional[str],
+        cooldown_seconds: int,
+        max_daily: int,
+        no_repeat_activity: bool,
+    ) -> Tuple[Optional[GroupReservation], Optional[str]]:
+        """
+        按群检查并预占一次拍照（参数同 check_group_limits）
+
+        Returns:
+            (预占, None) 或 (None, 拒绝原因)；没有目标群时返回空预占
+        """
+        if not stream_id:
+            return GroupReservation(), None
+        with self._group_lock:
+            allowed, reason = self.check_group_limits(
+                stream_id, activity, cooldown_seconds, max_daily, no_repeat_activity,
+            )
+            if not allowed:
+                return None, reason
+            record = HistoryRecord(
+                ts=time.time(), kind=KIND_SEND, outcome="reserved",
+                stream_id=stream_id, activity=activity.strip() if activity else None,
+            )
+            with self._pending_lock:
+                self._reserved.append(record)
+        return GroupReservation(self, record), None
+
+    def _release_group(self, record: HistoryRecord):
+        with self._pending_lock:
+            self._reserved = [rec for rec in self._reserved if rec is not record]
+
+    def summary(self, since: float, top: int = 5) -> Dict[str, Any]:
+        """
+        统计 since 以来的历史
+
+        Returns:
+            {"generate": {outcome: n}, "send": {outcome: n},
+             "generate_avg_ms": float|None, "streams": [(stream_id, n)], "activities": [(activity, n)]}
+        """
+        result: Dict[str, Any] = {KIND_GENERATE: {}, KIND_SEND: {}}
+        for kind, outcome, n in self._query(
+            "SELECT kind, outcome, COUNT(*) FROM history WHERE ts >= ? GROUP BY kind, outcome", (since,),
+        ):
+            result.setdefault(kind, {})[outcome] = n
+
+        avg = self._query(
+            "SELECT AVG(duration_ms) FROM history WHERE ts >= ? AND kind = ? AND outcome = 'success'",
+            (since, KIND_GENERATE),
+        )
+        result["generate_avg_ms"] = avg[0][0] if avg else None
+
+        sent_filter = "ts >= ? AND kind = ? AND outcome = 'success'"
+        result["streams"] = self._query(
+            f"SELECT stream_id, COUNT(*) AS n FROM history WHERE {sent_filter} AND stream_id IS NOT NULL "
+            "GROUP BY stream_id ORDER BY n DESC LIMIT ?",
+            (since, KIND_SEND, top),
+        )
+        result["activities"] = self._query(
+            f"SELECT activity, COUNT(*) AS n FROM history WHERE {sent_filter} AND activity IS NOT NULL "
+            "GROUP BY activity ORDER BY n DESC LIMIT ?",
+            (since, KIND_SEND, top),
+        )
+        return result
+
+    def format_summary(self, since: Optional[float] = None) -> str:
+        """今日历史摘要（用于 /selfie stats）"""
+        data = self.summary(start_of_today() if since is None else since)
+        generated, sent = data[KIND_GENERATE], data[KIND_SEND]
+        lines = [
+            f"今日生成: 成功 {generated.get('success', 0)} / 失败 {generated.get('failed', 0)}"
+            + (f"，平均 {data['generate_avg_ms']:.0f}ms" if data["generate_avg_ms"] else ""),
+            "今日发送: " + (", ".join(f"{k}={v}" for k, v in sorted(sent.items())) or "无"),
+        ]
+        if data["streams"]:
+            lines.append("按群: " + ", ".join(f"{s[:12]}={n}" for s, n in data["streams"]))
+        if data["activities"]:
+            lines.append("按活动: " + ", ".join(f"{a[:12]}={n}" for a, n in data["activities"]))
+        return "\n".join(lines)
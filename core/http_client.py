@@ -0,0 +1,52 @@
+"""共享 HTTP 会话 - 生图请求与图片下载复用同一个连接池"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+from typing import Optional
+
+import aiohttp
+
+from src.common.logger import get_logger
+from .cassette import wrap_session
+
+logger = get_logger("selfie_plugin.http")
+
+# 连接池参数：总连接数 / 每个 host 的连接数（0 = 不限），DNS 缓存秒数
+_POOL_LIMIT = 32
+_POOL_LIMIT_PER_HOST = 0
+_DNS_CACHE_SECONDS = 300
+
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    获取当前事件循环上的共享会话
+
+    会话绑定创建时的事件循环；已关闭或循环变化（如基准测试多次 asyncio.run）时重建。
+    超时由每个请求单独指定。开启 [selfie.cassette] 时返回录制/回放包装（接口与会话相同）。
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=_POOL_LIMIT,
+            limit_per_host=_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=_DNS_CACHE_SECONDS,
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+        _session_loop = loop
+        logger.debug("创建共享 HTTP 会话")
+    return wrap_session(_session)
+
+
+async def close_http_session():
+    """关闭共享会话（插件卸载或测试结束时调用）"""
+    global _session
+    session, _session = _session, None
+    if session is not None and not session.closed:
+        await session.close()
@@ -0,0 +1,536 @@
+"""图片数据处理 - 编解码与响应扫描（纯函数，可在线程池/进程池中执行）"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import base64
+import binascii
+import io
+import json
+import re
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    from PIL import Image  # 可选：完整解码校验与缩放/转码
+except ImportError:  # pragma: no cover - 没有 Pillow 时只做结构检查
+    Image = None
+
+# 提取策略（与 selfie_extractor_total 的 strategy 标签一致）
+STRATEGY_MARKDOWN_URL = "markdown_url"
+STRATEGY_DATA_URL = "data_url"
+STRATEGY_RAW_BASE64 = "raw_base64"
+STRATEGY_BARE_URL = "bare_url"
+STRATEGY_ANY_URL = "any_url"  # 不带扩展名的通用 URL，下载成功才算 bare_url
+STRATEGY_NONE = "none"
+
+# 扫描上限（字符）：只看响应的前这么多字符，够放 [selfie.download].max_bytes 大小图片的 base64
+DEFAULT_MAX_SCAN_BYTES = 32 * 1024 * 1024
+
+# 字符段：只有一个字符类的重复，从给定位置开始匹配、不回溯
+_B64_RUN_RE = re.compile(r'[A-Za-z0-9+/=]+')
+_URL_RUN_RE = re.compile(r'[^\s\)\"\']+')
+_B64_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+# 同样的字符类按字节查表（1 = 属于该字符段），ASCII 文本整块 translate 后 find，比逐字符匹配快几倍
+_B64_RUN_TABLE = bytes(1 if chr(i) in _B64_ALPHABET else 0 for i in range(256))
+_URL_RUN_TABLE = bytes(0 if chr(i).isspace() or chr(i) in ")\"'" else 1 for i in range(256))
+_RUN_CHUNK_MIN = 256
+_RUN_CHUNK_MAX = 64 * 1024
+
+# 预筛：以字面量开头，正则引擎按前缀快速跳过，绝大多数响应在这一步就能排除
+_LINK_TARGET_RE = re.compile(r'\]\(https?://[^\)]')
+_ANY_URL_RE = re.compile(r'https?://[^\s\)\"\']')
+# 不区分大小写的 http(s)://：以 "://" 为字面前缀，再向前确认协议名（IGNORECASE 的正则没有前缀可跳）。
+# 下面不区分大小写的地方都手写字符类，与原来 re.IGNORECASE 的正则等价：这些字母里 s 还匹配 U+017F，
+# i 还匹配 U+0130 / U+0131
+_ANY_SCHEME_RE = re.compile(r'://(?:(?<=[hH][tT][tT][pP]://)|(?<=[hH][tT][tT][pP][sS\u017f]://))')
+_SCHEME_S = "sS\u017f"
+# 图片扩展名按字节小写后查找（正则在密集的 "." 上每个点都要试一遍分支）
+_IMAGE_EXT_BYTES = (b".png", b".jpg", b".jpeg", b".webp", b".gif", b".g\xc4\xb0f", b".g\xc4\xb1f")
+_EXT_CHUNK = 1024 * 1024
+
+# 完整匹配。(?=(X))\1 是不依赖 3.11 原子组的“原子匹配”：前瞻里的 X 匹配一次后不再回溯，
+# 每行（每段 URL 字符）只从第一个 "!["（第一个 http）尝试一次，耗时与扫描长度成线性
+# - markdown：每行第一个 "![" 之后第一个 ](http...)，与 `!\[.*?\]\((https?://[^\)]+)\)` 命中同一个链接
+# - 图片 URL：每段 URL 字符里第一个 http(s):// 到最后一个图片扩展名，
+#   与 `https?://[^\s\)\"\']+\.(?:png|...)` 命中同一个 URL；
+#   _IMAGE_URL_RUN_RE 以分隔符开头，引擎按字符类前缀跳过长串 URL 字符，只在每段开头尝试
+_MARKDOWN_LINE_RE = re.compile(r'^(?=([^\n]*?!\[))\1[^\n]*?\]\((https?://)[^\)]', re.MULTILINE)
+_IMAGE_URL_BODY = (
+    r'(?=([^\s\)\"\']*?[hH][tT][tT][pP][sS\u017f]?://))\1[^\s\)\"\']+'
+    r'\.(?=[pPjJwWgG])(?:[pP][nN][gG]|[jJ][pP][eE]?[gG]|[wW][eE][bB][pP]|[gG][iI\u0130\u0131][fF])'
+)
+_IMAGE_URL_RE = re.compile(_IMAGE_URL_BODY)
+_IMAGE_URL_RUN_RE = re.compile(r'[\s\)\"\']' + _IMAGE_URL_BODY)
+
+# 扫描结果: (策略, 数据)，数据是 base64 或待下载的 URL
+ScanResult = Tuple[str, Optional[str]]
+
+
+def encode_base64(data: bytes) -> str:
+    """bytes -> base64 字符串"""
+    return base64.b64encode(data).decode("ascii")
+
+
+def encode_file_base64(path: str) -> str:
+    """读取文件并编码为 base64"""
+    return encode_base64(Path(path).read_bytes())
+
+
+def decode_json(body: bytes) -> Any:
+    """解析响应体 JSON"""
+    return json.loads(body)
+
+
+def encode_json(payload: Dict[str, Any]) -> bytes:
+    """序列化请求体 JSON"""
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+def response_content(response: Any) -> str:
+    """取 choices[0].message.content（取不到返回空串）"""
+    if not isinstance(response, dict):
+        return ""
+    content = response.get("choices", [{}])[0].get("message", {}).get("content", "")
+    return content if isinstance(content, str) else ""
+
+
+# =============================================================================
+# 响应扫描
+#
+# 响应文本来自上游模型，可能有几 MB 长，也可能是任意构造的内容。旧实现的
+# `!\[.*?\]\((https?://[^\)]+)\)` 这类正则在 "![![![..."、"http://http://..." 上会
+# 回溯成平方级；这里先用字面量前缀预筛，再用不回溯的匹配从第一个候选处开始，
+# 耗时与 min(len, max_scan_bytes) 成线性，结果与旧实现一致。
+# =============================================================================
+
+def _scan_end(content: str, max_scan_bytes: int) -> int:
+    """扫描范围的结束位置（max_scan_bytes 为 0 时不限）"""
+    if max_scan_bytes > 0:
+        return min(len(content), max_scan_bytes)
+    return len(content)
+
+
+def _run_end(content: str, start: int, end: int, table: bytes, pattern: "re.Pattern[str]") -> int:
+    """
+    从 start 开始、由 pattern 描述的字符段的结束位置（没有时返回 start）
+
+    按块推进（块从 256 字符倍增到 64K，短字符段不多拷贝）：ASCII 块用 table 整块判断，
+    含非 ASCII 字符的块交给 pattern 逐字符匹配
+    """
+    pos = start
+    chunk_size = _RUN_CHUNK_MIN
+    while pos < end:
+        stop = min(pos + chunk_size, end)
+        chunk = content[pos:stop]
+        if chunk.isascii():
+            offset = chunk.encode("ascii").translate(table).find(b"\0")
+            if offset >= 0:
+                return pos + offset
+        else:
+            match = pattern.match(content, pos, stop)
+            run = match.end() if match else pos
+            if run < stop:
+                return run
+        pos = stop
+        chunk_size = min(chunk_size * 2, _RUN_CHUNK_MAX)
+    return end
+
+
+def _run_start(content: str, stop: int, table: bytes, pattern: "re.Pattern[str]") -> int:
+    """以 stop 结尾、由 pattern 描述的字符段的起始位置（_run_end 的反方向）"""
+    pos = stop
+    chunk_size = _RUN_CHUNK_MIN
+    while pos > 0:
+        begin = max(0, pos - chunk_size)
+        chunk = content[begin:pos]
+        if chunk.isascii():
+            offset = chunk.encode("ascii").translate(table).rfind(b"\0")
+            if offset >= 0:
+                return begin + offset + 1
+        else:
+            match = pattern.match(chunk[::-1])
+            run = match.end() if match else 0
+            if run < len(chunk):
+                return pos - run
+        pos = begin
+        chunk_size = min(chunk_size * 2, _RUN_CHUNK_MAX)
+    return 0
+
+
+def _b64_run_end(content: str, start: int, end: int) -> int:
+    """从 start 开始的 base64 字符段的结束位置（没有时返回 start）"""
+    return _run_end(content, start, end, _B64_RUN_TABLE, _B64_RUN_RE)
+
+
+def _payload(content: str, start: int, stop: int, end: int) -> Optional[str]:
+    """取 [start, stop) 的数据；数据一直延伸到扫描上限（被截断）时返回 None"""
+    if stop == start or (stop == end and end < len(content)):
+        return None
+    return content[start:stop]
+
+
+def _find_markdown_url(content: str, end: int) -> Optional[str]:
+    """第一个 ![alt](http...) 的 URL（alt 不跨行，URL 到第一个 ')' 为止）"""
+    target = _LINK_TARGET_RE.search(content, 0, end)
+    if target is None:
+        return None
+    # 第一个候选之前的行里没有链接，从它所在的行开始完整匹配
+    line_start = content.rfind("\n", 0, target.start()) + 1
+    match = _MARKDOWN_LINE_RE.search(content, line_start, end)
+    if match is None:
+        return None
+    close = content.find(")", match.end(), end)
+    if close < 0:
+        # 后面再没有 ')'，不可能有完整的链接
+        return None
+    return content[match.start(2):close]
+
+
+def _find_data_url(content: str, end: int) -> Optional[str]:
+    """第一个后面紧跟 base64 字符的 "base64," 之后的数据"""
+    pos = 0
+    while True:
+        marker = content.find("base64,", pos, end)
+        if marker < 0:
+            return None
+        start = marker + len("base64,")
+        stop = _b64_run_end(content, start, end)
+        if stop > start:
+            return _payload(content, start, stop, end)
+        pos = start
+
+
+def _raw_base64(content: str, end: int) -> Optional[str]:
+    """整段内容（去掉首尾空白）都是 base64 且长度超过 100 时返回它"""
+    if end < len(content):
+        # 超过扫描上限的内容无法整体校验
+        return None
+    content_stripped = content.strip()
+    if len(content_stripped) > 100 and _b64_run_end(content_stripped, 0, len(content_stripped)) == len(content_stripped):
+        return content_stripped
+    return None
+
+
+def _has_image_ext(content: str, start: int, end: int) -> bool:
+    """[start, end) 里有没有图片扩展名（按块转成小写字节查找，块之间重叠 4 个字符）"""
+    pos = start
+    while pos < end:
+        stop = min(pos + _EXT_CHUNK, end)
+        data = content[pos:min(stop + 4, end)].encode("utf-8", "surrogatepass").lower()
+        if any(ext in data for ext in _IMAGE_EXT_BYTES):
+            return True
+        pos = stop
+    return False
+
+
+def _find_image_url(content: str, end: int) -> Optional[str]:
+    """第一个带图片扩展名（不区分大小写）的 http(s) URL"""
+    scheme = _ANY_SCHEME_RE.search(content, 0, end)
+    if scheme is None or not _has_image_ext(content, scheme.end(), end):
+        return None
+    # 之前的字符段里没有 URL：先试第一个 URL 所在的字符段，再从它之后的各段开头找
+    scheme_start = scheme.start() - (5 if content[scheme.start() - 1] in _SCHEME_S else 4)
+    run_start = _run_start(content, scheme_start, _URL_RUN_TABLE, _URL_RUN_RE)
+    match = _IMAGE_URL_RE.match(content, run_start, end) or _IMAGE_URL_RUN_RE.search(content, run_start, end)
+    if match is None or (match.end() == end and end < len(content)):
+        return None
+    scheme_len = 8 if content[match.end(1) - 4] in _SCHEME_S else 7
+    return content[match.end(1) - scheme_len:match.end()]
+
+
+def _find_any_url(content: str, end: int) -> Optional[str]:
+    """第一个 http(s) URL（协议名区分大小写）"""
+    match = _ANY_URL_RE.search(content, 0, end)
+    if match is None:
+        return None
+    stop = _run_end(content, match.end(), end, _URL_RUN_TABLE, _URL_RUN_RE)
+    if stop == end and end < len(content):
+        # URL 被扫描上限截断
+        return None
+    return content[match.start():stop]
+
+
+def scan_content(content: str, max_scan_bytes: int = DEFAULT_MAX_SCAN_BYTES) -> ScanResult:
+    """
+    扫描 Gemini 3.x 格式的 message.content（只看前 max_scan_bytes 个字符）
+
+    顺序: markdown 图片 URL -> data:image base64 -> 纯 base64
+    """
+    end = _scan_end(content, max_scan_bytes)
+
+    url = _find_markdown_url(content, end)
+    if url:
+        return STRATEGY_MARKDOWN_URL, url
+
+    if content.find("data:image", 0, end) >= 0:
+        data = _find_data_url(content, end)
+        if data:
+            return STRATEGY_DATA_URL, data
+
+    data = _raw_base64(content, end)
+    if data:
+        return STRATEGY_RAW_BASE64, data
+
+    return STRATEGY_NONE, None
+
+
+def scan_content_gemini_25(content: str, max_scan_bytes: int = DEFAULT_MAX_SCAN_BYTES) -> ScanResult:
+    """
+    扫描 Gemini 2.5 兼容格式的 message.content（只看前 max_scan_bytes 个字符）
+
+    顺序: markdown 图片 URL -> data:image base64 -> /9j/ 或 iVBOR 开头的原始 base64
+    -> 带图片扩展名的 URL -> 通用 URL -> 纯 base64
+    """
+    end = _scan_end(content, max_scan_bytes)
+
+    url = _find_markdown_url(content, end)
+    if url:
+        return STRATEGY_MARKDOWN_URL, url
+
+    marker = content.find("base64,", 0, end)
+    if marker >= 0 and content.find("data:image", 0, end) >= 0:
+        # 只看第一个 "base64," 之后、下一个 "base64," 之前的部分
+        start = marker + len("base64,")
+        stop = _b64_run_end(content, start, end)
+        next_marker = content.find("base64,", start, stop + 1)
+        data = _payload(content, start, stop, end) if next_marker < 0 else content[start:next_marker] or None
+        if data:
+            return STRATEGY_DATA_URL, data
+
+    if (content.startswith("/9j/") or content.startswith("iVBOR")) and end == len(content):
+        return STRATEGY_RAW_BASE64, content.strip()
+
+    if content.find("http", 0, end) >= 0:
+        url = _find_image_url(content, end)
+        if url:
+            return STRATEGY_BARE_URL, url
+        url = _find_any_url(content, end)
+        if url:
+            return STRATEGY_ANY_URL, url
+
+    data = _raw_base64(content, end)
+    if data:
+        return STRATEGY_RAW_BASE64, data
+
+    return STRATEGY_NONE, None
+
+
+# =============================================================================
+# 图片校验与规范化
+# =============================================================================
+
+class InvalidImageError(ValueError):
+    """数据不是可用的图片（base64 损坏、HTML 错误页、截断等）"""
+
+
+@dataclass
+class ImageInfo:
+    """规范化结果"""
+    format: str
+    width: Optional[int]
+    height: Optional[int]
+    bytes_in: int
+    bytes_out: int
+    transcoded: bool = False
+    note: str = ""
+
+
+# (魔数前缀, 格式)；WEBP 额外检查偏移 8 处的 "WEBP"
+_MAGIC = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+)
+
+OUTPUT_FORMATS = ("auto", "jpeg", "png", "webp")
+
+
+def decode_base64_image(data_b64: str) -> bytes:
+    """严格解码 base64（容忍换行和缺失的填充）"""
+    text = data_b64.strip()
+    try:
+        return base64.b64decode(text, validate=True)
+    except (binascii.Error, ValueError):
+        pass
+    text = "".join(text.split())
+    text += "=" * (-len(text) % 4)
+    try:
+        return base64.b64decode(text, validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise InvalidImageError(f"base64 无效: {e}") from None
+
+
+def sniff_format(data: bytes) -> Optional[str]:
+    """按魔数识别图片格式，不是图片返回 None"""
+    if len(data) >= 12 and data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    for magic, fmt in _MAGIC:
+        if data.startswith(magic):
+            return fmt
+    return None
+
+
+def image_dimensions(data: bytes, fmt: str) -> Optional[Tuple[int, int]]:
+    """只读文件头获取宽高（不解码像素），取不到返回 None"""
+    try:
+        if fmt == "png" and data[12:16] == b"IHDR":
+            return struct.unpack(">II", data[16:24])
+        if fmt == "gif":
+            return struct.unpack("<HH", data[6:10])
+        if fmt == "bmp":
+            width, height = struct.unpack("<ii", data[18:26])
+            return width, abs(height)
+        if fmt == "webp":
+            chunk = data[12:16]
+            if chunk == b"VP8X":
+                return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+            if chunk == b"VP8 ":
+                width, height = struct.unpack("<HH", data[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+            if chunk == b"VP8L":
+                bits = int.from_bytes(data[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if fmt == "jpeg":
+            pos = 2
+            while pos + 9 < len(data):
+                if data[pos] != 0xFF:
+                    pos += 1
+                    continue
+                marker = data[pos + 1]
+                if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                    pos += 1 if marker == 0xFF else 2
+                    continue
+                length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+                    return width, height
+                pos += 2 + length
+    except struct.error:
+        return None
+    return None
+
+
+def check_structure(data: bytes, fmt: str):
+    """
+    不依赖 Pillow 的完整性检查：确认文件尾/声明长度完整，识别被截断的图片
+
+    Raises:
+        InvalidImageError
+    """
+    tail = data[-1024:].rstrip(b"\x00")
+    if fmt == "png" and b"IEND" not in tail[-16:]:
+        raise InvalidImageError("PNG 缺少 IEND，图片被截断")
+    if fmt == "jpeg" and not tail.endswith(b"\xff\xd9"):
+        raise InvalidImageError("JPEG 缺少 EOI，图片被截断")
+    if fmt == "gif" and not tail.endswith(b"\x3b"):
+        raise InvalidImageError("GIF 缺少结束符，图片被截断")
+    if fmt == "webp" and int.from_bytes(data[4:8], "little") + 8 > len(data):
+        raise InvalidImageError("WEBP 长度不足，图片被截断")
+    if fmt == "bmp" and int.from_bytes(data[2:6], "little") > len(data):
+        raise InvalidImageError("BMP 长度不足，图片被截断")
+
+
+def _transcode(image, output_format: str, max_side: int, max_bytes: int, quality: int) -> bytes:
+    """用 Pillow 缩放/转码，有损格式超出体积上限时逐步降低质量和尺寸"""
+    if max_side > 0 and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    if output_format == "jpeg" and image.mode not in ("RGB", "L"):
+        # JPEG 不支持透明：铺白底
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        rgba = image.convert("RGBA")
+        background.paste(rgba, mask=rgba.split()[-1])
+        image = background
+    elif output_format == "webp" and image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    elif output_format == "png" and image.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+        image = image.convert("RGBA")
+
+    pil_format = {"jpeg": "JPEG", "png": "PNG", "webp": "WEBP"}[output_format]
+    lossy = output_format in ("jpeg", "webp")
+    for _ in range(4):
+        buffer = io.BytesIO()
+        if lossy:
+            image.save(buffer, pil_format, quality=quality, optimize=True)
+        else:
+            image.save(buffer, pil_format, optimize=True)
+        out = buffer.getvalue()
+        if max_bytes <= 0 or len(out) <= max_bytes:
+            return out
+        # 仍然超限：有损格式先降质量，再缩小尺寸
+        if lossy and quality > 55:
+            quality -= 15
+        else:
+            image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)), Image.LANCZOS)
+    return out
+
+
+def normalize_image(
+    data_b64: str,
+    max_bytes: int = 0,
+    max_side: int = 0,
+    output_format: str = "auto",
+    quality: int = 85,
+) -> Tuple[str, ImageInfo]:
+    """
+    校验并规范化生成的图片
+
+    1. 严格解码 base64，按魔数确认是图片（HTML 错误页等直接拒绝）
+    2. 有 Pillow 时完整解码一遍，否则检查文件尾/声明长度，识别截断
+    3. 超过 max_side / max_bytes，或指定了与原图不同的 output_format 时，
+       用 Pillow 缩放/转码（auto 表示超限时转为 JPEG）；没有 Pillow 时原样返回
+
+    Returns:
+        (base64, ImageInfo)
+
+    Raises:
+        InvalidImageError: 不是可用的图片
+    """
+    data = decode_base64_image(data_b64)
+    fmt = sniff_format(data)
+    if fmt is None:
+        preview = data[:32].decode("utf-8", errors="replace").strip()
+        raise InvalidImageError(f"不是图片数据 ({len(data)} 字节，开头: {preview!r})")
+
+    dims = image_dimensions(data, fmt)
+    info = ImageInfo(fmt, dims[0] if dims else None, dims[1] if dims else None, len(data), len(data))
+
+    too_big = (max_bytes > 0 and len(data) > max_bytes) or (max_side > 0 and dims is not None and max(dims) > max_side)
+    wrong_format = output_format not in ("auto", fmt)
+
+    if Image is None:
+        check_structure(data, fmt)
+        if too_big or wrong_format:
+            info.note = "未安装 Pillow，跳过缩放/转码"
+        return data_b64, info
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception as e:
+        raise InvalidImageError(f"图片解码失败: {e}") from None
+    info.width, info.height = image.size
+
+    too_big = too_big or (max_side > 0 and max(image.size) > max_side)
+    if not (too_big or wrong_format):
+        return data_b64, info
+    if getattr(image, "is_animated", False):
+        info.note = "动图不转码"
+        return data_b64, info
+
+    target = output_format if output_format != "auto" else "jpeg"
+    out = _transcode(image, target, max_side, max_bytes, quality)
+    if not wrong_format and len(out) >= len(data) and (max_side <= 0 or max(image.size) <= max_side):
+        # 转码反而更大且尺寸本来就合规，保留原图
+        return data_b64, info
+
+    with Image.open(io.BytesIO(out)) as result:
+        info.width, info.height = result.size
+    info.format, info.bytes_out, info.transcoded = target, len(out), True
+    return encode_base64(out), info
@@ -0,0 +1,477 @@
+"""任务日志 - 追加记录每次自拍任务的状态（入队/已生成/已发送），重启后补发或放弃未完成的任务"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import atexit
+import json
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.common.logger import get_logger
+from .metrics import REGISTRY
+
+logger = get_logger("selfie_plugin.journal")
+
+JOBS_TOTAL = REGISTRY.counter(
+    "selfie_jobs_total", "任务日志记录的状态变化", ("state",),
+)
+JOBS_RECOVERED_TOTAL = REGISTRY.counter(
+    "selfie_jobs_recovered_total", "重启后处理的未完成任务（delivered 补发 / regenerated 重新生成 / abandoned 放弃 / failed 失败）",
+    ("result",),
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts       REAL    NOT NULL,
+    job_id   TEXT    NOT NULL,
+    state    TEXT    NOT NULL,
+    persona  TEXT    NOT NULL DEFAULT '',
+    data     TEXT,
+    owner    TEXT    NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_journal_job ON journal (job_id, seq);
+CREATE INDEX IF NOT EXISTS idx_journal_state_ts ON journal (state, ts);
+CREATE TABLE IF NOT EXISTS owners (
+    owner     TEXT    PRIMARY KEY,
+    pid       INTEGER NOT NULL,
+    host      TEXT    NOT NULL,
+    heartbeat REAL    NOT NULL
+);
+"""
+
+# 打开日志的进程每隔 _HEARTBEAT_SECONDS 续租；心跳超过 _LEASE_SECONDS 的进程视为已退出
+_HEARTBEAT_SECONDS = 15.0
+_LEASE_SECONDS = 60.0
+_HOST = socket.gethostname()
+# 本进程里打开着的实例（热重载时新旧实例可能短暂并存）
+_LOCAL_OWNERS: set = set()
+
+# 任务状态（enqueued → generated → sent；任何一步都可能以 failed / abandoned 结束）
+STATE_ENQUEUED = "enqueued"
+STATE_GENERATED = "generated"
+STATE_SENT = "sent"
+STATE_FAILED = "failed"
+STATE_ABANDONED = "abandoned"
+TERMINAL_STATES = (STATE_SENT, STATE_FAILED, STATE_ABANDONED)
+
+
+@dataclass
+class JobRecord:
+    """重启时未完成的任务（各条日志合并后的最新状态）"""
+    job_id: str
+    state: str
+    created: float
+    persona: str = ""
+    source: str = ""
+    stream_id: Optional[str] = None
+    activity: Optional[str] = None
+    style: Optional[str] = None
+    perspective: Optional[str] = None
+    prompt: Optional[str] = None
+    image_path: Optional[str] = None
+    owner: str = ""
+
+
+@dataclass
+class _Entry:
+    """一条待写入的日志（image 为需要先落盘的 base64 图片）"""
+    ts: float
+    job_id: str
+    state: str
+    persona: str
+    data: Dict[str, Any]
+    image: Optional[str] = field(default=None, repr=False)
+
+
+@dataclass
+class _FlushMarker:
+    done: threading.Event = field(default_factory=threading.Event)
+
+
+class JobHandle:
+    """
+    一个任务的日志句柄（journal 为空时所有操作都是空操作）
+
+    入口在限流通过、提示词构建后创建；生图成功后 generated()，发送后 finish()，
+    其余失败路径 fail()。只有进程崩溃/被取消的任务会停留在未完成状态。
+    """
+
+    __slots__ = ("journal", "job_id", "persona", "state")
+
+    def __init__(self, journal: Optional["JobJournal"], job_id: str = "", persona: str = "", state: str = STATE_ENQUEUED):
+        self.journal = journal
+        self.job_id = job_id
+        self.persona = persona
+        self.state = state
+
+    @property
+    def done(self) -> bool:
+        return self.state in TERMINAL_STATES
+
+    def _append(self, state: str, image_base64: Optional[str] = None, **data: Any):
+        if self.done:
+            return
+        self.state = state
+        if self.journal is not None:
+            self.journal.append(self.job_id, state, self.persona, image_base64, **data)
+
+    def generated(self, image_base64: str):
+        """图片已生成（图片落盘后才记为 generated，重启后可以直接补发）"""
+        self._append(STATE_GENERATED, image_base64)
+
+    def finish(self, sent: bool, error: Optional[str] = None):
+        """发送结束"""
+        if sent:
+            self._append(STATE_SENT)
+        else:
+            self._append(STATE_FAILED, error=error or "发送失败")
+
+    def fail(self, error: Optional[str] = None):
+        self._append(STATE_FAILED, error=error)
+
+    def abandon(self, reason: str):
+        self._append(STATE_ABANDONED, error=reason)
+
+
+class JobJournal:
+    """
+    任务日志
+
+    - 只追加：每次状态变化写一行 (job_id, state, data)，任务的当前状态取最后一行
+    - 写线程组提交：队列里积压的日志一次事务提交（synchronous=FULL，每批一次 fsync），事件循环上没有磁盘写入
+    - 生成的图片先写到 spool 目录并 fsync，再提交 generated 日志；任务结束后删除图片
+    - 打开时读出未完成的任务（take_unfinished），清理超过 retention_days 的已结束任务和孤立图片
+    - 每个打开日志的实例登记为一个 owner 并由写线程续租；日志行记下写入者，
+      只接管 owner 已退出的未完成任务（接管时把任务改记到自己名下，同时启动的进程不会重复补发）
+    """
+
+    def __init__(self, db_path: Path, retention_days: int = 7):
+        self.db_path = Path(db_path)
+        self.spool_dir = self.db_path.with_name(self.db_path.stem + "_spool")
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._read_lock = threading.Lock()
+        self._closed = False
+        self.owner = uuid.uuid4().hex
+
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(_SCHEMA)
+            self._migrate(conn)
+            if retention_days > 0:
+                self._compact(conn, time.time() - retention_days * 86400)
+            self._unfinished = self._claim_unfinished(conn)
+        finally:
+            conn.close()
+        self._remove_orphans()
+        self._read_conn = self._connect(check_same_thread=False)
+
+        self._thread = threading.Thread(target=self._writer, name="selfie-journal", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.db_path), timeout=10, check_same_thread=check_same_thread)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection):
+        """旧版本的日志没有 owner 列（旧行的 owner 为空，视为已退出的进程写入）"""
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(journal)")}
+        if "owner" not in columns:
+            with conn:
+                conn.execute("ALTER TABLE journal ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+
+    # =========================================================================
+    # 写入
+    # =========================================================================
+
+    def begin(
+        self,
+        source: str,
+        stream_id: Optional[str],
+        activity: Optional[str],
+        prompt: str,
+        persona: str = "",
+        style: Optional[str] = None,
+        perspective: Optional[str] = None,
+    ) -> JobHandle:
+        """记录一个新任务（enqueued），返回它的句柄"""
+        job_id = uuid.uuid4().hex
+        self.append(
+            job_id, STATE_ENQUEUED, persona,
+            source=source, stream_id=stream_id, activity=activity,
+            style=style, perspective=perspective, prompt=prompt,
+        )
+        return JobHandle(self, job_id, persona)
+
+    def append(self, job_id: str, state: str, persona: str = "", image_base64: Optional[str] = None, **data: Any):
+        """追加一条状态日志（非阻塞）"""
+        if self._closed:
+            return
+        JOBS_TOTAL.inc(state=state)
+        self._queue.put(_Entry(time.time(), job_id, state, persona, data, image_base64))
+
+    def _spool_path(self, job_id: str) -> Path:
+        return self.spool_dir / f"{job_id}.b64"
+
+    def _spill(self, entry: _Entry):
+        """图片原样（base64）写入 spool 目录（临时文件 + fsync + 原子替换；不解码，写线程少占 GIL）"""
+        path = self._spool_path(entry.job_id)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(entry.image.encode("ascii"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        entry.data["image_path"] = path.name
+        entry.image = None
+
+    def _writer(self):
+        """写线程：取出积压的全部日志，落盘图片后一次事务提交"""
+        conn = self._connect()
+        beat = time.monotonic()
+        try:
+            while True:
+                try:
+                    items = [self._queue.get(timeout=_HEARTBEAT_SECONDS)]
+                except queue.Empty:
+                    items = []
+                while True:
+                    try:
+                        items.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                batch = [item for item in items if isinstance(item, _Entry)]
+                if batch:
+                    self._write_batch(conn, batch)
+                for item in items:
+                    if isinstance(item, _FlushMarker):
+                        item.done.set()
+                if any(item is None for item in items):
+                    _LOCAL_OWNERS.discard(self.owner)
+                    self._release_owner(conn)
+                    return
+                if time.monotonic() - beat >= _HEARTBEAT_SECONDS:
+                    beat = time.monotonic()
+                    self._heartbeat(conn)
+        finally:
+            conn.close()
+
+    def _heartbeat(self, conn: sqlite3.Connection):
+        try:
+            with conn:
+                conn.execute("UPDATE owners SET heartbeat = ? WHERE owner = ?", (time.time(), self.owner))
+        except sqlite3.Error as e:
+            logger.warning(f"任务日志续租失败: {e}")
+
+    def _release_owner(self, conn: sqlite3.Connection):
+        """正常关闭时注销（名下未完成的任务由下一个打开日志的进程接管）"""
+        try:
+            with conn:
+                conn.execute("DELETE FROM owners WHERE owner = ?", (self.owner,))
+        except sqlite3.Error as e:
+            logger.warning(f"注销任务日志 owner 失败: {e}")
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[_Entry]):
+        # 同一批里已经结束的任务（发送得快时 generated 和 sent 一起到达）不必落盘图片
+        finished = {entry.job_id for entry in batch if entry.state in TERMINAL_STATES}
+        for entry in batch:
+            if entry.image and entry.job_id in finished:
+                entry.image = None
+            elif entry.image:
+                try:
+                    self._spill(entry)
+                except (OSError, UnicodeEncodeError) as e:
+                    logger.error(f"任务 {entry.job_id[:8]} 的图片落盘失败，重启后无法补发: {e}")
+                    entry.image = None
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO journal (ts, job_id, state, persona, data, owner) VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            e.ts, e.job_id, e.state, e.persona,
+                            json.dumps(e.data, ensure_ascii=False) if e.data else None, self.owner,
+                        )
+                        for e in batch
+                    ],
+                )
+        except sqlite3.Error as e:
+            logger.error(f"写入任务日志失败 ({len(batch)} 条): {e}")
+            return
+        # 已结束任务的图片不再需要
+        for entry in batch:
+            if entry.state in TERMINAL_STATES:
+                self._spool_path(entry.job_id).unlink(missing_ok=True)
+
+    def flush(self, timeout: Optional[float] = 5.0) -> bool:
+        """等待已排队的日志落盘（关闭和测试用，会阻塞调用线程）"""
+        if self._closed or not self._thread.is_alive():
+            return True
+        marker = _FlushMarker()
+        self._queue.put(marker)
+        return marker.done.wait(timeout)
+
+    def close(self):
+        """写完剩余日志并关闭"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        with self._read_lock:
+            self._read_conn.close()
+        try:
+            atexit.unregister(self.close)
+        except Exception:
+            pass
+
+    # =========================================================================
+    # 恢复
+    # =========================================================================
+
+    @staticmethod
+    def _compact(conn: sqlite3.Connection, before: float):
+        """删除最后一条日志早于 before 的任务"""
+        with conn:
+            deleted = conn.execute(
+                "DELETE FROM journal WHERE job_id IN "
+                "(SELECT job_id FROM journal GROUP BY job_id HAVING MAX(ts) < ?)",
+                (before,),
+            ).rowcount
+        if deleted:
+            logger.info(f"清理了 {deleted} 条过期的任务日志")
+
+    @staticmethod
+    def _owner_alive(owner: str, pid: int, host: str, heartbeat: float, now: float) -> bool:
+        """心跳未过期，且（同一台机器上时）进程还在"""
+        if now - heartbeat > _LEASE_SECONDS:
+            return False
+        if host != _HOST or os.name != "posix":
+            return True
+        if pid == os.getpid():
+            # 同 pid 但不在本进程里的登记来自重启前的进程（容器里 pid 常被复用）
+            return owner in _LOCAL_OWNERS
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def _claim_unfinished(self, conn: sqlite3.Connection) -> List[JobRecord]:
+        """
+        登记本实例，接管已退出的 owner 名下的未完成任务
+
+        返回接管的任务。整个过程在一个 IMMEDIATE 事务里，
+        同时打开日志的进程依次接管，同一个任务只会被一个进程取走。
+        """
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            alive = {
+                owner for owner, pid, host, heartbeat in conn.execute("SELECT owner, pid, host, heartbeat FROM owners")
+                if self._owner_alive(owner, pid, host, heartbeat, now)
+            }
+            conn.execute(
+                f"DELETE FROM owners WHERE owner NOT IN ({','.join('?' * len(alive))})", tuple(alive),
+            )
+            conn.execute(
+                "INSERT INTO owners (owner, pid, host, heartbeat) VALUES (?, ?, ?, ?)",
+                (self.owner, os.getpid(), _HOST, now),
+            )
+            claimed, live = [], []
+            for record in self._load_unfinished(conn):
+                (live if record.owner in alive else claimed).append(record)
+            conn.executemany(
+                "UPDATE journal SET owner = ? WHERE job_id = ?", [(self.owner, r.job_id) for r in claimed],
+            )
+            conn.commit()
+            _LOCAL_OWNERS.add(self.owner)
+        except BaseException:
+            conn.rollback()
+            raise
+        self._others_alive = bool(alive)
+        for record in claimed:
+            record.owner = self.owner
+        if live:
+            logger.info(f"{len(live)} 个未完成的任务仍由其他进程处理，不接管")
+        return claimed
+
+    @staticmethod
+    def _load_unfinished(conn: sqlite3.Connection) -> List[JobRecord]:
+        rows = conn.execute(
+            "SELECT j.job_id FROM journal j "
+            "JOIN (SELECT job_id, MAX(seq) AS seq FROM journal GROUP BY job_id) last "
+            "ON j.seq = last.seq WHERE j.state NOT IN (?, ?, ?) ORDER BY j.seq",
+            TERMINAL_STATES,
+        ).fetchall()
+        records = []
+        for (job_id,) in rows:
+            record: Optional[JobRecord] = None
+            for ts, state, persona, data, owner in conn.execute(
+                "SELECT ts, state, persona, data, owner FROM journal WHERE job_id = ? ORDER BY seq", (job_id,),
+            ):
+                if record is None:
+                    record = JobRecord(job_id, state, ts, persona)
+                record.state = state
+                record.owner = owner
+                for key, value in (json.loads(data) if data else {}).items():
+                    if hasattr(record, key) and key not in ("job_id", "state", "created", "persona", "owner"):
+                        setattr(record, key, value)
+            if record is not None:
+                records.append(record)
+        return records
+
+    def _remove_orphans(self):
+        """
+        删除不属于任何未完成任务的图片（上次崩溃在落盘和提交之间留下的）
+
+        还有其他进程在用这份日志时不清理：它们的图片可能已落盘、日志还没提交，留给最后一个打开的进程
+        """
+        if self._others_alive:
+            return
+        keep = {record.image_path for record in self._unfinished if record.image_path}
+        for path in self.spool_dir.iterdir():
+            if path.name not in keep:
+                path.unlink(missing_ok=True)
+
+    def take_unfinished(self) -> List[JobRecord]:
+        """取出打开时未完成的任务（只返回一次）"""
+        records, self._unfinished = self._unfinished, []
+        return records
+
+    def read_image(self, record: JobRecord) -> Optional[str]:
+        """读取任务已生成的图片（base64），文件不存在时返回 None"""
+        if not record.image_path:
+            return None
+        try:
+            return (self.spool_dir / record.image_path).read_text(encoding="ascii")
+        except OSError as e:
+            logger.warning(f"读取任务 {record.job_id[:8]} 的图片失败: {e}")
+            return None
+
+    def generated_since(self, persona: str, since: float) -> Tuple[int, Optional[float]]:
+        """该人设自 since 以来生成成功的张数和最近一次的时间（重启后恢复冷却和每日计数）"""
+        with self._read_lock:
+            count, last = self._read_conn.execute(
+                "SELECT COUNT(*), MAX(ts) FROM journal WHERE state = ? AND ts >= ? AND persona = ?",
+                (STATE_GENERATED, since, persona),
+            ).fetchone()
+        return count, last
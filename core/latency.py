@@ -0,0 +1,145 @@
+"""延迟统计 - 按接口和模型维护滚动的延迟分位数草图，供自适应超时和请求对冲使用"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import math
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from .metrics import REGISTRY
+
+ATTEMPT_TIMEOUT_SECONDS = REGISTRY.histogram(
+    "selfie_attempt_timeout_seconds", "每次生图尝试使用的超时时间", (),
+    buckets=(5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300),
+)
+
+# 低于 1ms 的延迟都记为 1ms（对数分桶不能处理 0）
+_MIN_VALUE = 0.001
+
+
+class LatencySketch:
+    """
+    对数分桶的分位数草图（DDSketch 思路）
+
+    第 k 个桶覆盖 (γ^(k-1), γ^k]，γ = (1+α)/(1-α)，分位数的相对误差不超过 α；
+    桶数只与延迟的数量级跨度有关（1ms~10min 在 α=1% 时约 660 个桶），与样本数无关。
+    """
+
+    __slots__ = ("_log_gamma", "_gamma", "_buckets", "count")
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        alpha = min(max(relative_accuracy, 1e-4), 0.5)
+        self._gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self._gamma)
+        self._buckets: Dict[int, int] = {}
+        self.count = 0
+
+    def add(self, value: float):
+        key = math.ceil(math.log(max(value, _MIN_VALUE)) / self._log_gamma)
+        self._buckets[key] = self._buckets.get(key, 0) + 1
+        self.count += 1
+
+    def merge(self, other: "LatencySketch"):
+        for key, n in other._buckets.items():
+            self._buckets[key] = self._buckets.get(key, 0) + n
+        self.count += other.count
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = min(max(q, 0.0), 1.0) * (self.count - 1)
+        seen = 0
+        for key in sorted(self._buckets):
+            seen += self._buckets[key]
+            if seen > rank:
+                break
+        # 取桶的"中点"，使桶内任意值的相对误差都不超过 α
+        return 2 * self._gamma ** key / (self._gamma + 1)
+
+
+class RollingSketch:
+    """
+    滚动窗口的草图：当前窗口写入，满 window 秒后轮换，查询合并当前和上一个窗口
+
+    查询结果反映最近 window~2×window 秒内的样本，旧的延迟分布会自然淡出。
+    """
+
+    def __init__(self, window: float, relative_accuracy: float = 0.01):
+        self.window = window
+        self._accuracy = relative_accuracy
+        self._current = LatencySketch(relative_accuracy)
+        self._previous = LatencySketch(relative_accuracy)
+        self._rotated_at = time.monotonic()
+
+    def _rotate(self, now: float):
+        if self.window <= 0:
+            return
+        elapsed = now - self._rotated_at
+        if elapsed < self.window:
+            return
+        # 空闲超过两个窗口时两份都已过期
+        self._previous = self._current if elapsed < 2 * self.window else LatencySketch(self._accuracy)
+        self._current = LatencySketch(self._accuracy)
+        self._rotated_at = now
+
+    def add(self, value: float, now: Optional[float] = None):
+        self._rotate(time.monotonic() if now is None else now)
+        self._current.add(value)
+
+    def snapshot(self, now: Optional[float] = None) -> LatencySketch:
+        self._rotate(time.monotonic() if now is None else now)
+        merged = LatencySketch(self._accuracy)
+        merged.merge(self._previous)
+        merged.merge(self._current)
+        return merged
+
+
+class LatencyTracker:
+    """按 (接口, 模型) 分别统计的延迟草图"""
+
+    def __init__(self, window: float = 1800.0):
+        self._lock = threading.Lock()
+        self._window = window
+        self._sketches: Dict[Tuple[str, str], RollingSketch] = {}
+
+    def configure(self, window: float):
+        with self._lock:
+            self._window = window
+            for sketch in self._sketches.values():
+                sketch.window = window
+
+    def observe(self, endpoint: str, model: str, seconds: float):
+        with self._lock:
+            sketch = self._sketches.get((endpoint, model))
+            if sketch is None:
+                sketch = self._sketches[(endpoint, model)] = RollingSketch(self._window)
+            sketch.add(seconds)
+
+    def quantile(self, endpoint: str, model: str, q: float, min_samples: int = 1) -> Optional[float]:
+        """近期延迟的 q 分位数，样本不足 min_samples 时返回 None"""
+        with self._lock:
+            sketch = self._sketches.get((endpoint, model))
+            merged = sketch.snapshot() if sketch is not None else None
+        if merged is None or merged.count < max(min_samples, 1):
+            return None
+        return merged.quantile(q)
+
+    def reset(self):
+        with self._lock:
+            self._sketches.clear()
+
+
+_tracker = LatencyTracker()
+
+
+def get_latency_tracker() -> LatencyTracker:
+    """全局延迟统计（所有人设共用，按接口和模型区分）"""
+    return _tracker
+
+
+def configure_latency(window: float):
+    """应用 [selfie.timeouts] 中的 latency_window"""
+    _tracker.configure(window)
@@ -0,0 +1,343 @@
+"""指标收集 - 进程内 Prometheus 风格指标注册表"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+from .tracing import current_trace
+
+# 默认延迟分桶（秒），覆盖从毫秒级的 prompt 构建到分钟级的生图请求
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 180)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{_escape(extra[1])}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """指标基类"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}，收到 {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def summary(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+    def summary(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} = {_format_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值，也可以绑定回调在采集时取值"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._functions: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: str):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+    def set_function(self, func: Callable[[], float], **labels: str):
+        """采集时调用 func 取值（用于缓存大小等已有状态）"""
+        with self._lock:
+            self._functions[self._key(labels)] = func
+
+    @contextmanager
+    def track_inprogress(self, **labels: str) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def _collect(self) -> List[Tuple[LabelValues, float]]:
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, func in functions.items():
+            try:
+                values[key] = float(func())
+            except Exception:
+                continue
+        return sorted(values.items())
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in self._collect()]
+
+    def summary(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, k)} = {_format_value(v)}" for k, v in self._collect()]
+
+
+class Histogram(_Metric):
+    """累积分桶直方图"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._upper_bounds = tuple(sorted(buckets)) + (float("inf"),)
+        # 每个标签组合: [各桶计数(非累积)], 总和, 总数
+        self._data: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        index = bisect.bisect_left(self._upper_bounds, value)
+        with self._lock:
+            counts, totals = self._data.setdefault(key, ([0] * len(self._upper_bounds), [0.0, 0]))
+            counts[index] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """计时上下文（单调时钟）"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def quantile(self, q: float, **labels: str) -> Optional[float]:
+        """按分桶近似分位数（取所在桶上界）"""
+        data = self._data.get(self._key(labels))
+        return self._quantile(data, q) if data else None
+
+    def _quantile(self, data, q: float) -> Optional[float]:
+        counts, totals = data
+        if not totals[1]:
+            return None
+        target = q * totals[1]
+        cumulative = 0
+        for bound, count in zip(self._upper_bounds, counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return self._upper_bounds[-1]
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted((k, (list(c), list(t))) for k, (c, t) in self._data.items())
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, (counts, totals) in self._snapshot():
+            cumulative = 0
+            for bound, count in zip(self._upper_bounds, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(totals[0])}")
+            lines.append(f"{self.name}_count{labels} {int(totals[1])}")
+        return lines
+
+    def summary(self) -> List[str]:
+        lines = []
+        for key, data in self._snapshot():
+            counts, totals = data
+            if not totals[1]:
+                continue
+            avg = totals[0] / totals[1]
+            p50 = self._quantile(data, 0.5)
+            p99 = self._quantile(data, 0.99)
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, key)} "
+                f"n={int(totals[1])} avg={avg:.3f}s p50≤{_format_value(p50)}s p99≤{_format_value(p99)}s"
+            )
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Prometheus 文本格式 (text/plain; version=0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def render_summary(self) -> str:
+        """紧凑摘要（用于聊天内展示，跳过没有数据的指标）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.summary())
+        return "\n".join(lines) if lines else "(暂无数据)"
+
+
+def endpoint_label(url: str) -> str:
+    """把 API 地址压缩为 host 作为标签值（不带路径和查询参数）"""
+    if not url:
+        return "none"
+    parsed = urlparse(url)
+    return parsed.netloc or parsed.path or "unknown"
+
+
+REGISTRY = MetricsRegistry()
+
+# === 延迟 ===
+PROMPT_BUILD_SECONDS = REGISTRY.histogram(
+    "selfie_prompt_build_seconds", "构建生图 prompt 耗时",
+)
+API_LATENCY_SECONDS = REGISTRY.histogram(
+    "selfie_api_latency_seconds", "生图 API 单次请求耗时", ("endpoint",),
+)
+DOWNLOAD_SECONDS = REGISTRY.histogram(
+    "selfie_download_seconds", "CDN 图片下载耗时", ("endpoint",),
+)
+SEND_SECONDS = REGISTRY.histogram(
+    "selfie_send_seconds", "图片发送到聊天平台耗时", ("source",),
+)
+
+# === 计数 ===
+REQUESTS_TOTAL = REGISTRY.counter(
+    "selfie_requests_total", "自拍请求结果", ("source", "outcome"),
+)
+API_REQUESTS_TOTAL = REGISTRY.counter(
+    "selfie_api_requests_total", "生图 API 请求", ("endpoint", "status"),
+)
+EXTRACTOR_TOTAL = REGISTRY.counter(
+    "selfie_extractor_total", "图片提取命中的策略", ("strategy",),
+)
+EXTRACTOR_SCAN_TRUNCATED_TOTAL = REGISTRY.counter(
+    "selfie_extractor_scan_truncated_total", "响应文本超过 max_scan_bytes、只扫描了开头部分的次数",
+)
+IMAGE_POSTPROCESS_TOTAL = REGISTRY.counter(
+    "selfie_image_postprocess_total", "生成图片的校验/规范化结果", ("result",),
+)
+IMAGE_BYTES = REGISTRY.histogram(
+    "selfie_image_bytes", "发送前的图片大小（字节）", ("stage",),
+    buckets=(65536, 262144, 524288, 1048576, 2097152, 4194304, 8388608, 16777216),
+)
+
+# === 瞬时值 ===
+QUEUE_DEPTH = REGISTRY.gauge(
+    "selfie_queue_depth", "正在进行中的生图请求数",
+)
+CACHE_SIZE = REGISTRY.gauge(
+    "selfie_cache_size", "缓存条目数", ("cache",),
+)
+
+
+def record_outcome(source: str, outcome: str):
+    """记录一次请求结果（source: tool/activity/command），同时标注到当前 trace"""
+    REQUESTS_TOTAL.inc(source=source, outcome=outcome)
+    trace = current_trace()
+    if trace is not None:
+        trace.set(outcome=outcome)
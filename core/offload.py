@@ -0,0 +1,186 @@
+"""CPU 任务卸载 - 大块编解码/扫描放到线程池或进程池，并监测事件循环延迟"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import pickle
+import time
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional, TypeVar
+
+from src.common.logger import get_logger
+from .metrics import REGISTRY
+
+logger = get_logger("selfie_plugin.offload")
+
+T = TypeVar("T")
+
+OFFLOAD_SECONDS = REGISTRY.histogram(
+    "selfie_offload_seconds", "CPU 任务耗时（含排队）", ("task", "mode"),
+)
+EVENT_LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "selfie_event_loop_lag_seconds", "事件循环调度延迟（定时器实际唤醒 - 预期唤醒）",
+    buckets=(0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+EXECUTOR_KINDS = ("inline", "thread", "process")
+
+
+class LoopLagMonitor:
+    """
+    事件循环延迟监测
+
+    每 interval 秒睡一次，实际唤醒时间比预期晚多少就是这段时间里
+    事件循环被同步代码占住的时长。
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def ensure_started(self):
+        """在当前事件循环上启动（已在运行或 interval <= 0 时为空操作）"""
+        if self.interval <= 0 or (self._task is not None and not self._task.done()):
+            return
+        try:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        except RuntimeError:
+            pass
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.max_lag = max(self.max_lag, lag)
+            EVENT_LOOP_LAG_SECONDS.observe(lag)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class Offloader:
+    """
+    CPU 任务执行器
+
+    - inline: 直接在事件循环上执行（旧行为，用于对比）
+    - thread: 线程池；文件读取期间释放 GIL，多个步骤之间事件循环能得到调度，
+      但单次 base64/json/正则调用在 C 层持有 GIL，期间事件循环仍会停顿
+    - process: 进程池，不占事件循环所在进程的 GIL，延迟最低；参数和结果需要
+      跨进程拷贝，吞吐略低。不可用（如函数无法 pickle）时自动退回线程池
+
+    小于 min_bytes 的数据直接内联执行，避免调度开销大于计算本身。
+    """
+
+    def __init__(self, kind: str = "thread", max_workers: int = 2, min_bytes: int = 64 * 1024):
+        if kind not in EXECUTOR_KINDS:
+            logger.warning(f"未知的执行器类型 {kind}，使用 thread")
+            kind = "thread"
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        self.min_bytes = max(0, min_bytes)
+        self._executor: Optional[concurrent.futures.Executor] = None
+        self._fallback: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="selfie-cpu",
+                )
+        return self._executor
+
+    def _get_fallback(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self._fallback is None:
+            self._fallback = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="selfie-cpu",
+            )
+        return self._fallback
+
+    async def run(self, task: str, func: Callable[..., T], *args: Any, size: int = 0) -> T:
+        """
+        执行一个 CPU 任务
+
+        Args:
+            task: 任务名（指标标签）
+            func: 模块级函数（进程池模式下需要可 pickle）
+            size: 输入数据大小（字节），小于 min_bytes 时内联执行
+        """
+        get_lag_monitor().ensure_started()
+
+        mode = self.kind if size >= self.min_bytes else "inline"
+        started = time.perf_counter()
+        try:
+            if mode == "inline":
+                return func(*args)
+
+            loop = asyncio.get_running_loop()
+            call = functools.partial(func, *args)
+            try:
+                return await loop.run_in_executor(self._get_executor(), call)
+            except (BrokenProcessPool, pickle.PicklingError, AttributeError, TypeError) as e:
+                if mode != "process":
+                    raise
+                # 进程池不可用（子进程崩溃、函数或参数无法 pickle），后续都走线程池
+                logger.warning(f"进程池执行 {task} 失败，退回线程池: {e}")
+                self.kind = mode = "thread"
+                broken, self._executor = self._executor, None
+                if broken is not None:
+                    broken.shutdown(wait=False, cancel_futures=True)
+                return await loop.run_in_executor(self._get_fallback(), call)
+        finally:
+            OFFLOAD_SECONDS.observe(time.perf_counter() - started, task=task, mode=mode)
+
+    def shutdown(self):
+        """关闭执行器（不等待进行中的任务）"""
+        for executor in (self._executor, self._fallback):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._fallback = None
+
+
+_offloader: Optional[Offloader] = None
+_lag_monitor: Optional[LoopLagMonitor] = None
+
+
+def get_lag_monitor() -> LoopLagMonitor:
+    """获取全局事件循环延迟监测"""
+    global _lag_monitor
+    if _lag_monitor is None:
+        _lag_monitor = LoopLagMonitor()
+    return _lag_monitor
+
+
+def get_offloader() -> Offloader:
+    """获取全局 CPU 任务执行器"""
+    global _offloader
+    if _offloader is None:
+        _offloader = Offloader()
+    return _offloader
+
+
+def configure_offload(kind: str, max_workers: int, min_bytes: int, lag_interval: float):
+    """按配置重建执行器（执行器参数不变时保留原执行器）"""
+    global _offloader
+    monitor = get_lag_monitor()
+    monitor.interval = lag_interval
+    if lag_interval <= 0:
+        monitor.stop()
+
+    old = _offloader
+    if old is not None and (old.kind, old.max_workers) == (kind, max(1, max_workers)):
+        old.min_bytes = max(0, min_bytes)
+        return
+    _offloader = Offloader(kind, max_workers, min_bytes)
+    if old is not None:
+        old.shutdown()
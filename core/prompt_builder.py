@@ -8,6 +8,9 @@ from datetime import datetime
 from typing import Optional
 from src.plugin_system.apis import config_api
 from .selfie_generator import SelfieStyle, PhotoPerspective
+from .config_snapshot import SelfieConfig
+from .metrics import PROMPT_BUILD_SECONDS
+from .tracing import span
 
 
 # 日系动漫风格基础提示词（强力避免恐怖谷效应）
@@ -83,25 +86,16 @@ def get_time_context() -> str:
 class SelfiePromptBuilder:
     """构建生图Prompt"""
 
-    def __init__(self, config: dict):
+    def __init__(self, config: SelfieConfig):
         self.config = config
-        style_cfg = config.get("style", {})
-        self._professional_desc = style_cfg.get(
-            "professional_desc",
-            "光线很好，画面清晰，像是精心拍摄的"
-        )
-        self._casual_desc = style_cfg.get(
-            "casual_desc",
-            "照片有点糊但是很真实，像是随手用手机拍的"
-        )
-        self._selfie_desc = style_cfg.get(
-            "selfie_desc",
-            "自拍照，能看到人物的脸和表情"
-        )
-        self._pov_desc = style_cfg.get(
-            "pov_desc",
-            "第一人称视角，像是自己眼睛看到的场景"
-        )
+        style_cfg = config.style
+        self._professional_desc = style_cfg.professional_desc
+        self._casual_desc = style_cfg.casual_desc
+        self._selfie_desc = style_cfg.selfie_desc
+        self._pov_desc = style_cfg.pov_desc
+        # 人设可以覆盖昵称和设定，为空时读麦麦全局配置
+        self._nickname = config.character.nickname
+        self._personality = config.character.personality
 
     def build_prompt(
         self,
@@ -109,6 +103,19 @@ class SelfiePromptBuilder:
         style: SelfieStyle,
         perspective: PhotoPerspective = PhotoPerspective.SELFIE,
         context: Optional[str] = None
+    ) -> str:
+        """构建生图prompt（计时后委托给 _build_prompt）"""
+        with PROMPT_BUILD_SECONDS.time(), span("build_prompt") as build_span:
+            prompt = self._build_prompt(activity, style, perspective, context)
+            build_span.set(bytes=len(prompt.encode("utf-8")))
+            return prompt
+
+    def _build_prompt(
+        self,
+        activity: str,
+        style: SelfieStyle,
+        perspective: PhotoPerspective,
+        context: Optional[str]
     ) -> str:
         """
         构建生图prompt
@@ -123,8 +130,8 @@ class SelfiePromptBuilder:
             完整的生图prompt
         """
         # 获取bot信息
-        bot_name = config_api.get_global_config("bot.nickname", "麦麦")
-        personality = config_api.get_global_config("personality.personality", "")
+        bot_name = self._nickname or config_api.get_global_config("bot.nickname", "麦麦")
+        personality = self._personality or config_api.get_global_config("personality.personality", "")
 
         # 选择质量风格描述
         quality_desc = self._professional_desc if style == SelfieStyle.PROFESSIONAL else self._casual_desc
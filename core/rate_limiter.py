@@ -0,0 +1,303 @@
+"""限流 - 全局/按群/按用户的令牌桶，状态持久化"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import json
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Protocol, Tuple
+
+from src.common.logger import get_logger
+from .metrics import REGISTRY
+from .utils import DebouncedJsonState
+
+if TYPE_CHECKING:
+    from .shared_state import SharedState
+
+logger = get_logger("selfie_plugin.ratelimit")
+
+RATE_LIMITED_TOTAL = REGISTRY.counter(
+    "selfie_rate_limited_total", "被令牌桶拒绝的请求", ("scope",),
+)
+
+# 作用域（检查顺序即报告原因的优先级）
+SCOPE_GLOBAL = "global"
+SCOPE_STREAM = "stream"
+SCOPE_USER = "user"
+
+_SCOPE_NAMES = {SCOPE_GLOBAL: "全局", SCOPE_STREAM: "本群", SCOPE_USER: "你"}
+
+
+@dataclass(frozen=True)
+class BucketSpec:
+    """令牌桶参数：每小时补充 per_hour 个，最多攒 burst 个（per_hour <= 0 表示不限）"""
+    per_hour: float
+    burst: int
+
+    @property
+    def enabled(self) -> bool:
+        return self.per_hour > 0 and self.burst > 0
+
+    @property
+    def rate(self) -> float:
+        """每秒补充的令牌数"""
+        return self.per_hour / 3600.0
+
+
+class TokenBucket:
+    """单个令牌桶（惰性补充，使用墙钟以便跨重启恢复）"""
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+    def refill(self, spec: BucketSpec, now: float) -> float:
+        """按经过的时间补充令牌，返回当前令牌数"""
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(float(spec.burst), self.tokens + elapsed * spec.rate)
+        self.updated = now
+        return self.tokens
+
+    def retry_after(self, spec: BucketSpec) -> float:
+        """距离下一个令牌还需多少秒"""
+        return max(0.0, (1.0 - self.tokens) / spec.rate)
+
+
+def _targets(
+    specs: Dict[str, BucketSpec], stream_id: Optional[str], user_id: Optional[str],
+) -> List[Tuple[Tuple[str, str], BucketSpec]]:
+    """一次拍照涉及的桶（全局/群/用户中已启用的）"""
+    targets = []
+    for scope, key in ((SCOPE_GLOBAL, "*"), (SCOPE_STREAM, stream_id), (SCOPE_USER, user_id)):
+        spec = specs.get(scope)
+        if key and spec is not None and spec.enabled:
+            targets.append(((scope, str(key)), spec))
+    return targets
+
+
+def _limited(scope: str, bucket: TokenBucket, spec: BucketSpec) -> Tuple[bool, Optional[str]]:
+    RATE_LIMITED_TOTAL.inc(scope=scope)
+    wait = int(bucket.retry_after(spec)) + 1
+    return False, f"{_SCOPE_NAMES[scope]}拍得太频繁了({wait}秒后恢复)"
+
+
+class Limiter(Protocol):
+    """
+    限流器接口（进程内 RateLimiter / 多进程共享 SharedRateLimiter）
+
+    blocking 为真时 acquire/refund 可能等待其他进程的锁，异步调用方要放到执行器里执行。
+    """
+
+    state_path: Path
+    blocking: bool
+
+    def acquire(self, stream_id: Optional[str] = None, user_id: Optional[str] = None) -> Tuple[bool, Optional[str]]: ...
+
+    def refund(self, stream_id: Optional[str] = None, user_id: Optional[str] = None): ...
+
+    def peek(self, scope: str, key: str) -> Optional[float]: ...
+
+    def configure(self, specs: Dict[str, BucketSpec]): ...
+
+    def close(self): ...
+
+
+class RateLimiter(DebouncedJsonState):
+    """
+    多作用域令牌桶限流器
+
+    一次 acquire() 同时检查全局、目标群、触发用户三个桶，全部有令牌才一起扣减，
+    每个桶都是字典查找 + 常数运算。桶状态按防抖间隔写入 JSON（原子替换），
+    已经补满的桶不保存，状态文件大小只和近期活跃的群/用户数有关。
+    """
+
+    state_name = "限流状态"
+    blocking = False
+
+    def __init__(self, state_path: Path, specs: Dict[str, BucketSpec], save_interval: float = 5.0):
+        self._init_persistence(state_path, save_interval)
+        self._specs = dict(specs)
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._load()
+
+    def configure(self, specs: Dict[str, BucketSpec]):
+        """更新桶参数（已有令牌数保留，超出新 burst 的部分在下次补充时截断）"""
+        with self._lock:
+            self._specs = dict(specs)
+
+    # =========================================================================
+    # 限流
+    # =========================================================================
+
+    def acquire(self, stream_id: Optional[str] = None, user_id: Optional[str] = None) -> Tuple[bool, Optional[str]]:
+        """
+        尝试为一次拍照扣减令牌
+
+        Returns:
+            (是否允许, 原因)；不允许时不扣减任何桶
+        """
+        now = time.time()
+        with self._lock:
+            buckets = []
+            for bucket_key, spec in _targets(self._specs, stream_id, user_id):
+                bucket = self._buckets.get(bucket_key)
+                if bucket is None:
+                    bucket = self._buckets[bucket_key] = TokenBucket(float(spec.burst), now)
+                if bucket.refill(spec, now) < 1.0:
+                    return _limited(bucket_key[0], bucket, spec)
+                buckets.append(bucket)
+
+            for bucket in buckets:
+                bucket.tokens -= 1.0
+            if buckets:
+                self._mark_dirty()
+        return True, None
+
+    def refund(self, stream_id: Optional[str] = None, user_id: Optional[str] = None):
+        """归还一次 acquire() 扣减的令牌（生成失败等没有真正发出照片的情况）"""
+        now = time.time()
+        with self._lock:
+            for bucket_key, spec in _targets(self._specs, stream_id, user_id):
+                bucket = self._buckets.get(bucket_key)
+                if bucket is not None:
+                    bucket.refill(spec, now)
+                    bucket.tokens = min(float(spec.burst), bucket.tokens + 1.0)
+            self._mark_dirty()
+
+    def peek(self, scope: str, key: str) -> Optional[float]:
+        """查看某个桶当前的令牌数（没有该桶或作用域未启用返回 None）"""
+        spec = self._specs.get(scope)
+        if spec is None or not spec.enabled:
+            return None
+        with self._lock:
+            bucket = self._buckets.get((scope, key))
+            return bucket.refill(spec, time.time()) if bucket else float(spec.burst)
+
+    # =========================================================================
+    # 持久化
+    # =========================================================================
+
+    def _load(self):
+        try:
+            raw = json.loads(self.state_path.read_bytes())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"限流状态读取失败，从满桶开始: {e}")
+            return
+
+        for entry in raw.get("buckets", []):
+            try:
+                scope, key, tokens, updated = entry
+                self._buckets[(str(scope), str(key))] = TokenBucket(float(tokens), float(updated))
+            except (TypeError, ValueError):
+                continue
+        if self._buckets:
+            logger.debug(f"恢复了 {len(self._buckets)} 个限流桶")
+
+    def _snapshot(self) -> Dict[str, Any]:
+        """未补满的桶"""
+        now = time.time()
+        entries = []
+        for (scope, key), bucket in list(self._buckets.items()):
+            spec = self._specs.get(scope)
+            if spec is None or not spec.enabled or bucket.refill(spec, now) >= spec.burst:
+                # 满桶与缺省状态等价，不必保存，也顺便从内存里清掉
+                del self._buckets[(scope, key)]
+                continue
+            entries.append([scope, key, round(bucket.tokens, 4), round(bucket.updated, 3)])
+        return {"version": 1, "buckets": entries}
+
+
+class SharedRateLimiter:
+    """
+    多进程共享的令牌桶（[selfie.shared_state] 开启时使用）
+
+    桶状态存放在共享状态库的 buckets 表，acquire/refund 各是一个写事务：
+    读出所有相关桶、补充、判断、扣减在同一把跨进程写锁内完成，并发进程不会重复扣减同一个令牌。
+    没有本地缓存和 JSON 状态文件。
+
+    事务可能等待其他进程的写锁（blocking），运行时把 acquire/refund 放到执行器里执行；
+    共享状态库不可写时放行并记录警告（每日额度在生图时另有预占）。
+    """
+
+    blocking = True
+
+    def __init__(self, shared: "SharedState", specs: Dict[str, BucketSpec]):
+        self.shared = shared
+        self.state_path = shared.db_path
+        self._specs = dict(specs)
+
+    def configure(self, specs: Dict[str, BucketSpec]):
+        """更新桶参数（下一个事务起生效）"""
+        self._specs = dict(specs)
+
+    @staticmethod
+    def _load_bucket(conn, bucket_key: Tuple[str, str], spec: BucketSpec, now: float) -> TokenBucket:
+        row = conn.execute(
+            "SELECT tokens, updated FROM buckets WHERE scope = ? AND key = ?", bucket_key,
+        ).fetchone()
+        return TokenBucket(*row) if row else TokenBucket(float(spec.burst), now)
+
+    @staticmethod
+    def _store_bucket(conn, bucket_key: Tuple[str, str], bucket: TokenBucket):
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (scope, key, tokens, updated) VALUES (?, ?, ?, ?)",
+            (*bucket_key, bucket.tokens, bucket.updated),
+        )
+
+    def acquire(self, stream_id: Optional[str] = None, user_id: Optional[str] = None) -> Tuple[bool, Optional[str]]:
+        targets = _targets(self._specs, stream_id, user_id)
+        if not targets:
+            return True, None
+        now = time.time()
+        try:
+            with self.shared.transaction("acquire") as conn:
+                buckets = []
+                for bucket_key, spec in targets:
+                    bucket = self._load_bucket(conn, bucket_key, spec, now)
+                    if bucket.refill(spec, now) < 1.0:
+                        return _limited(bucket_key[0], bucket, spec)
+                    buckets.append((bucket_key, bucket))
+                for bucket_key, bucket in buckets:
+                    bucket.tokens -= 1.0
+                    self._store_bucket(conn, bucket_key, bucket)
+        except sqlite3.Error as e:
+            logger.warning(f"共享限流状态不可用，本次放行: {e}")
+        return True, None
+
+    def refund(self, stream_id: Optional[str] = None, user_id: Optional[str] = None):
+        targets = _targets(self._specs, stream_id, user_id)
+        if not targets:
+            return
+        now = time.time()
+        try:
+            with self.shared.transaction("refund") as conn:
+                for bucket_key, spec in targets:
+                    bucket = self._load_bucket(conn, bucket_key, spec, now)
+                    bucket.refill(spec, now)
+                    bucket.tokens = min(float(spec.burst), bucket.tokens + 1.0)
+                    self._store_bucket(conn, bucket_key, bucket)
+        except sqlite3.Error as e:
+            logger.warning(f"归还共享限流令牌失败: {e}")
+
+    def peek(self, scope: str, key: str) -> Optional[float]:
+        spec = self._specs.get(scope)
+        if spec is None or not spec.enabled:
+            return None
+        now = time.time()
+        try:
+            with self.shared.read() as conn:
+                return self._load_bucket(conn, (scope, key), spec, now).refill(spec, now)
+        except sqlite3.Error as e:
+            logger.warning(f"读取共享限流状态失败: {e}")
+            return None
+
+    def close(self):
+        """共享状态库由运行时关闭"""
@@ -0,0 +1,171 @@
+"""响应分类 - 没有图片的响应按结构和 finish_reason 归为安全拦截、拒绝或纯文字回答，并短期记住被拒的提示词"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from .metrics import REGISTRY
+
+RESPONSE_REJECTED_TOTAL = REGISTRY.counter(
+    "selfie_response_rejected_total", "没有图片的响应（safety 安全拦截 / refusal 拒绝 / text_only 纯文字回答）", ("kind",),
+)
+REJECTION_CACHE_TOTAL = REGISTRY.counter(
+    "selfie_rejection_cache_total", "被拒提示词缓存（stored 记下 / hit 命中，未发请求）", ("result",),
+)
+
+KIND_SAFETY = "safety"
+KIND_REFUSAL = "refusal"
+KIND_TEXT_ONLY = "text_only"
+
+# finish_reason / native_finish_reason（OpenAI 兼容接口与透传的 Gemini 原生值，小写比较）
+_SAFETY_FINISH_REASONS = frozenset({
+    "content_filter", "safety", "image_safety", "prohibited_content", "image_prohibited_content",
+    "blocklist", "spii", "recitation",
+})
+
+# 响应里出现这些标记时可能带着图片（只是没提取成功或下载失败），交给重试
+_IMAGE_MARKERS = ("://", "base64", "data:image", "![")
+_BASE64_ONLY_RE = re.compile(r'[A-Za-z0-9+/=\s]+')
+
+# 拒绝话术只看开头
+_REFUSAL_SCAN_CHARS = 600
+_REFUSAL_RE = re.compile(
+    r"抱歉|对不起|无法(?:为你|为您)?(?:生成|创建|绘制|提供|满足|完成)|不能(?:为你|为您)?(?:生成|创建|绘制|提供)"
+    r"|违反|违背|不适当|内容政策|安全政策|使用政策"
+    r"|\bsorry\b|\bi(?:'m| am) (?:unable|not able)\b|\bi (?:can(?:no|')t|can not|won't|will not)\b"
+    r"|\bunable to (?:generate|create|produce)\b|\bcontent polic|\bsafety (?:guideline|polic)|\bviolat",
+    re.IGNORECASE,
+)
+
+_SNIPPET_CHARS = 80
+
+
+@dataclass(frozen=True)
+class ResponseVerdict:
+    """没有图片的响应的判定（reason 原样返回给调用方）"""
+    kind: str
+    reason: str
+
+
+class ResponseRejected(Exception):
+    """响应被判定为安全拦截 / 拒绝 / 纯文字回答（由重试循环决定是否放弃重试）"""
+
+    def __init__(self, verdict: ResponseVerdict):
+        super().__init__(verdict.reason)
+        self.verdict = verdict
+
+
+def _snippet(text: str) -> str:
+    text = " ".join(text[:_SNIPPET_CHARS * 2].split())
+    return text[:_SNIPPET_CHARS] + ("…" if len(text) > _SNIPPET_CHARS else "")
+
+
+def _block_reason(response: Dict[str, Any]) -> Optional[str]:
+    """透传的 Gemini promptFeedback.blockReason（提示词本身被拦截）"""
+    feedback = response.get("promptFeedback") or response.get("prompt_feedback")
+    if isinstance(feedback, dict):
+        reason = feedback.get("blockReason") or feedback.get("block_reason")
+        if reason:
+            return str(reason)
+    return None
+
+
+def classify_response(response: Any) -> Optional[ResponseVerdict]:
+    """
+    判定提取不到图片的响应
+
+    只认得出明确的情况，其余（没有 choices、内容为空、带着链接或 base64 却没提取成功）返回 None，
+    照常按可重试的失败处理：
+
+    1. finish_reason 为 content_filter / SAFETY 等，或提示词被 promptFeedback 拦截：安全拦截
+    2. message.refusal 非空，或没有任何图片标记的文字以拒绝话术开头：拒绝
+    3. 其余没有任何图片标记的文字：纯文字回答
+    """
+    if not isinstance(response, dict):
+        return None
+
+    blocked = _block_reason(response)
+    if blocked:
+        return _verdict(KIND_SAFETY, f"提示词被安全策略拦截 ({blocked})")
+
+    choices = response.get("choices")
+    if not isinstance(choices, list) or not choices or not isinstance(choices[0], dict):
+        return None
+    choice = choices[0]
+    for key in ("finish_reason", "native_finish_reason"):
+        finish = choice.get(key)
+        if isinstance(finish, str) and finish.lower() in _SAFETY_FINISH_REASONS:
+            return _verdict(KIND_SAFETY, f"内容被安全策略拦截 ({finish})")
+
+    message = choice.get("message")
+    if not isinstance(message, dict):
+        return None
+    refusal = message.get("refusal")
+    if isinstance(refusal, str) and refusal.strip():
+        return _verdict(KIND_REFUSAL, f"模型拒绝生成: {_snippet(refusal)}")
+    if message.get("images"):
+        return None
+
+    content = message.get("content")
+    if not isinstance(content, str) or not content.strip():
+        return None
+    if any(marker in content for marker in _IMAGE_MARKERS) or _BASE64_ONLY_RE.fullmatch(content):
+        return None
+    if _REFUSAL_RE.search(content, 0, _REFUSAL_SCAN_CHARS):
+        return _verdict(KIND_REFUSAL, f"模型拒绝生成: {_snippet(content)}")
+    return _verdict(KIND_TEXT_ONLY, f"模型只回复了文字，没有图片: {_snippet(content)}")
+
+
+def _verdict(kind: str, reason: str) -> ResponseVerdict:
+    RESPONSE_REJECTED_TOTAL.inc(kind=kind)
+    return ResponseVerdict(kind, reason)
+
+
+def prompt_fingerprint(model: str, prompt: str) -> str:
+    """提示词指纹（同一模型下的同一提示词）"""
+    return hashlib.sha1(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+class RejectionCache:
+    """
+    被拒提示词缓存：指纹 -> (判定, 过期时间)
+
+    每个生成器一份（人设的参考图不同，被拒的提示词不通用）；超过 max_entries 时淘汰最久未命中的。
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[str, Tuple[ResponseVerdict, float]]" = OrderedDict()
+
+    def get(self, fingerprint: str) -> Optional[Tuple[ResponseVerdict, float]]:
+        """(判定, 剩余秒数)，没有或已过期时返回 None"""
+        cached = self._entries.get(fingerprint)
+        if cached is None:
+            return None
+        remaining = cached[1] - time.monotonic()
+        if remaining <= 0:
+            del self._entries[fingerprint]
+            return None
+        self._entries.move_to_end(fingerprint)
+        return cached[0], remaining
+
+    def put(self, fingerprint: str, verdict: ResponseVerdict, ttl: float, max_entries: int):
+        if ttl <= 0 or max_entries <= 0:
+            return
+        self._entries[fingerprint] = (verdict, time.monotonic() + ttl)
+        self._entries.move_to_end(fingerprint)
+        while len(self._entries) > max_entries:
+            self._entries.popitem(last=False)
+        REJECTION_CACHE_TOTAL.inc(result="stored")
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
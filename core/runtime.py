@@ -0,0 +1,636 @@
+"""插件运行时 - 跨调用共享的组件"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from src.common.logger import get_logger
+from .config_snapshot import (
+    ConfigStore, SelfieConfig, BudgetSection, HistorySection, JournalSection, PersonaProfile, RateLimitSection,
+    SharedStateSection, PLUGIN_DIR, get_config_store,
+)
+from .selfie_generator import SelfieGenerator, get_reference_cache
+from .prompt_builder import SelfiePromptBuilder
+from .target_selector import TargetSelector
+from .utils import set_debug_mode
+from .metrics import CACHE_SIZE
+from .debug_reporter import DebugReporter, get_debug_dispatcher
+from .history_store import GroupReservation, HistoryStore, KIND_SEND, image_digest, start_of_today
+from .job_journal import JOBS_RECOVERED_TOTAL, STATE_ENQUEUED, STATE_GENERATED, JobHandle, JobJournal, JobRecord
+from .budget import BudgetTracker
+from .offload import configure_offload
+from .hedging import configure_hedging
+from .latency import configure_latency
+from .scheduler import PRIORITY_BACKGROUND, configure_scheduler
+from .rate_limiter import Limiter, RateLimiter, SharedRateLimiter, BucketSpec, SCOPE_GLOBAL, SCOPE_STREAM, SCOPE_USER
+from .shared_state import SharedState
+from .worker import configure_worker
+from .cassette import configure_cassette
+from .tracing import current_trace, start_trace
+from .deadline import PhaseTimeout, deadline_scope, run_phase
+from .trigger_scorer import TriggerDecision, TriggerScorer
+
+logger = get_logger("selfie_plugin.runtime")
+
+# 影响生成器的配置段
+GENERATOR_SECTIONS = ("limits", "api", "character", "style", "image", "download", "persona", "timeouts", "refusal")
+
+
+@dataclass
+class Persona:
+    """一个人设的生成器和提示词构建器（name 为空表示全局配置）"""
+    name: str
+    generator: SelfieGenerator
+    prompt_builder: SelfiePromptBuilder
+    profile: Optional[PersonaProfile] = None
+
+
+class SelfieRuntime:
+    """
+    插件运行时
+
+    工具、命令和事件处理器共用同一组生成器/构建器/选择器，
+    冷却和每日计数因此在各入口之间共享。配置变化时只重建受影响的组件。
+
+    配置了人设（[selfie.persona]）时，每个人设有自己的生成器（参考图、接口池、冷却和每日上限）
+    和提示词构建器；历史库、用量预算、限流、连接池和参考图缓存由所有人设共用。
+    """
+
+    def __init__(self, store: ConfigStore):
+        self._store = store
+        cfg = store.snapshot
+
+        set_debug_mode(cfg.plugin.debug_mode)
+        self._on_offload_change(cfg, {"offload"})
+        self._on_hedge_change(cfg, {"hedge"})
+        self._on_timeouts_change(cfg, {"timeouts"})
+        self._on_scheduler_change(cfg, {"scheduler"})
+        self._on_worker_change(cfg, {"worker"})
+        self._on_cassette_change(cfg, {"cassette"})
+        self.history: Optional[HistoryStore] = self._open_history(cfg.history)
+        self.shared_state: Optional[SharedState] = self._open_shared_state(cfg.shared_state)
+        self.budget: Optional[BudgetTracker] = self._open_budget(cfg.budget)
+        self.journal: Optional[JobJournal] = self._open_journal(cfg.journal)
+        self._recovery: Optional[asyncio.Task] = None
+        self.generator = SelfieGenerator(cfg, history=self.history, budget=self.budget, shared_state=self.shared_state)
+        self._restore_quota(self.generator)
+        self.rate_limiter: Optional[Limiter] = self._open_rate_limiter(cfg.rate_limit)
+        self.prompt_builder = SelfiePromptBuilder(cfg)
+        self._personas: Dict[str, Persona] = {}
+        self._sync_personas(cfg, set())
+        self.target_selector = TargetSelector(cfg)
+        self.trigger_scorer = TriggerScorer(cfg.trigger)
+
+        CACHE_SIZE.set_function(
+            lambda: len({path for persona in self.personas for path in persona.generator.reference_images}),
+            cache="reference_images",
+        )
+
+        store.subscribe(self._on_plugin_change, ("plugin",))
+        store.subscribe(self._on_generator_change, GENERATOR_SECTIONS)
+        store.subscribe(self._on_prompt_change, ("style", "character"))
+        store.subscribe(self._on_target_change, ("target", "permission"))
+        store.subscribe(self._on_trigger_change, ("trigger",))
+        store.subscribe(self._on_debug_change, ("debug",))
+        store.subscribe(self._on_history_change, ("history",))
+        store.subscribe(self._on_rate_limit_change, ("rate_limit",))
+        store.subscribe(self._on_budget_change, ("budget",))
+        store.subscribe(self._on_offload_change, ("offload",))
+        store.subscribe(self._on_hedge_change, ("hedge",))
+        store.subscribe(self._on_timeouts_change, ("timeouts",))
+        store.subscribe(self._on_scheduler_change, ("scheduler",))
+        store.subscribe(self._on_journal_change, ("journal",))
+        store.subscribe(self._on_shared_state_change, ("shared_state",))
+        store.subscribe(self._on_worker_change, ("worker",))
+        store.subscribe(self._on_cassette_change, ("cassette", "api", "persona"))
+        self._on_debug_change(cfg, {"debug"})
+
+    @property
+    def store(self) -> ConfigStore:
+        return self._store
+
+    @property
+    def config(self) -> SelfieConfig:
+        """当前配置快照（访问时检查热重载）"""
+        return self._store.snapshot
+
+    def _on_plugin_change(self, cfg: SelfieConfig, changed: Set[str]):
+        set_debug_mode(cfg.plugin.debug_mode)
+
+    def _on_generator_change(self, cfg: SelfieConfig, changed: Set[str]):
+        self.generator.apply_config(cfg, changed)
+        self._sync_personas(cfg, changed)
+        if changed & {"character", "persona"}:
+            get_reference_cache().retain(
+                {path for persona in self.personas for path in persona.generator.reference_images}
+            )
+
+    def _sync_personas(self, cfg: SelfieConfig, changed: Set[str]):
+        """按配置增删人设；已有人设只刷新变化的配置段（人设覆盖本身变化时刷新它覆盖的段）"""
+        profiles = {profile.name: profile for profile in cfg.persona.profiles}
+        for name in [name for name in self._personas if name not in profiles]:
+            del self._personas[name]
+            logger.info(f"人设已移除: {name}")
+
+        for name, profile in profiles.items():
+            effective = profile.apply(cfg)
+            persona = self._personas.get(name)
+            if persona is None:
+                generator = SelfieGenerator(
+                    effective, history=self.history, budget=self.budget, persona=name, shared_state=self.shared_state,
+                )
+                self._restore_quota(generator)
+                self._personas[name] = Persona(name, generator, SelfiePromptBuilder(effective), profile)
+                logger.info(f"人设已加载: {name} ({len(profile.streams)} 个群, {generator.reference_image_count} 张参考图)")
+                continue
+            sections = set(changed)
+            if persona.profile != profile:
+                sections |= persona.profile.overridden_sections | profile.overridden_sections
+                persona.profile = profile
+            persona.generator.apply_config(effective, sections)
+            if sections & {"style", "character"}:
+                persona.prompt_builder = SelfiePromptBuilder(effective)
+
+    @property
+    def personas(self) -> List[Persona]:
+        """全局配置 + 所有人设"""
+        return [Persona("", self.generator, self.prompt_builder), *self._personas.values()]
+
+    def persona_for(self, stream_id: Optional[str]) -> Persona:
+        """群映射的人设（未映射且没有默认人设时使用全局配置）"""
+        profile = self.config.persona.resolve(stream_id)
+        if profile is not None:
+            persona = self._personas.get(profile.name)
+            if persona is not None:
+                return persona
+        return Persona("", self.generator, self.prompt_builder)
+
+    async def preload_reference_images(self) -> int:
+        """预编码所有人设的参考图（共享缓存，同一张图只编码一次）"""
+        loaded = 0
+        for persona in self.personas:
+            loaded += await persona.generator.preload_reference_images()
+        return loaded
+
+    def _on_prompt_change(self, cfg: SelfieConfig, changed: Set[str]):
+        self.prompt_builder = SelfiePromptBuilder(cfg)
+
+    def _on_target_change(self, cfg: SelfieConfig, changed: Set[str]):
+        self.target_selector = TargetSelector(cfg)
+
+    def _on_trigger_change(self, cfg: SelfieConfig, changed: Set[str]):
+        self.trigger_scorer.configure(cfg.trigger)
+
+    def _on_offload_change(self, cfg: SelfieConfig, changed: Set[str]):
+        section = cfg.offload
+        configure_offload(section.executor, section.max_workers, section.min_bytes, section.lag_monitor_interval)
+
+    def _on_hedge_change(self, cfg: SelfieConfig, changed: Set[str]):
+        configure_hedging(cfg.hedge)
+
+    def _on_timeouts_change(self, cfg: SelfieConfig, changed: Set[str]):
+        configure_latency(cfg.timeouts.latency_window)
+
+    def _on_scheduler_change(self, cfg: SelfieConfig, changed: Set[str]):
+        configure_scheduler(cfg.scheduler)
+
+    def _on_worker_change(self, cfg: SelfieConfig, changed: Set[str]):
+        configure_worker(cfg.worker)
+
+    def _on_cassette_change(self, cfg: SelfieConfig, changed: Set[str]):
+        # 录制时从响应里去掉所有人设的 API 密钥
+        keys = {cfg.api.api_key, os.environ.get("SELFIE_API_KEY", "")}
+        keys.update(profile.apply(cfg).api.api_key for profile in cfg.persona.profiles)
+        configure_cassette(cfg.cassette, keys)
+
+    def _on_debug_change(self, cfg: SelfieConfig, changed: Set[str]):
+        get_debug_dispatcher().configure(cfg.debug.max_parallel_sends, cfg.debug.max_pending_chars)
+
+    def _on_history_change(self, cfg: SelfieConfig, changed: Set[str]):
+        # 只有开关/路径变化才需要重开数据库；按群限制在检查时直接读配置
+        path = self._history_path(cfg.history) if cfg.history.enabled else None
+        current = self.history.db_path if self.history else None
+        if path == current:
+            return
+        old = self.history
+        self.history = self._open_history(cfg.history)
+        for persona in self.personas:
+            persona.generator.history = self.history
+        if old:
+            old.close()
+
+    @staticmethod
+    def _history_path(section: HistorySection) -> Path:
+        return Path(section.db_path) if section.db_path else PLUGIN_DIR / "data" / "selfie_history.db"
+
+    def _open_history(self, section: HistorySection) -> Optional[HistoryStore]:
+        if not section.enabled:
+            return None
+        try:
+            return HistoryStore(self._history_path(section), retention_days=section.retention_days)
+        except Exception as e:
+            logger.error(f"打开自拍历史数据库失败，历史记录已停用: {e}")
+            return None
+
+    @staticmethod
+    def _journal_path(section: JournalSection) -> Path:
+        return Path(section.path) if section.path else PLUGIN_DIR / "data" / "jobs.db"
+
+    def _open_journal(self, section: JournalSection) -> Optional[JobJournal]:
+        if not section.enabled:
+            return None
+        try:
+            return JobJournal(self._journal_path(section), retention_days=section.retention_days)
+        except Exception as e:
+            logger.error(f"打开任务日志失败，任务日志已停用: {e}")
+            return None
+
+    def _on_journal_change(self, cfg: SelfieConfig, changed: Set[str]):
+        # 补发/恢复策略在恢复时直接读配置，只有开关/路径变化才需要重开
+        path = self._journal_path(cfg.journal) if cfg.journal.enabled else None
+        current = self.journal.db_path if self.journal else None
+        if path == current:
+            return
+        old = self.journal
+        self.journal = self._open_journal(cfg.journal)
+        if old:
+            old.close()
+        if self.journal is None:
+            return
+        # 新日志里可能有今天更早生成的照片，以及刚接管的已退出进程的任务
+        for persona in self.personas:
+            self._restore_quota(persona.generator)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._recovery = loop.create_task(self.recover_jobs())
+
+    @staticmethod
+    def _shared_state_path(section: SharedStateSection) -> Path:
+        return Path(section.path) if section.path else PLUGIN_DIR / "data" / "shared_state.db"
+
+    def _open_shared_state(self, section: SharedStateSection) -> Optional[SharedState]:
+        if not section.enabled:
+            return None
+        try:
+            return SharedState(self._shared_state_path(section), busy_timeout=section.busy_timeout)
+        except Exception as e:
+            logger.error(f"打开共享状态库失败，每日计数/冷却/限流只在本进程内生效: {e}")
+            return None
+
+    def _on_shared_state_change(self, cfg: SelfieConfig, changed: Set[str]):
+        path = self._shared_state_path(cfg.shared_state) if cfg.shared_state.enabled else None
+        current = self.shared_state.db_path if self.shared_state else None
+        if path == current:
+            return
+        old = self.shared_state
+        self.shared_state = self._open_shared_state(cfg.shared_state)
+        for persona in self.personas:
+            persona.generator.shared_state = self.shared_state
+        # 限流桶和用量跟着换存储
+        if self.rate_limiter:
+            self.rate_limiter.close()
+        self.rate_limiter = self._open_rate_limiter(cfg.rate_limit)
+        if self.budget:
+            self.budget.close()
+            self.budget = self._open_budget(cfg.budget)
+            for persona in self.personas:
+                persona.generator.budget = self.budget
+        if old:
+            old.close()
+
+    def _restore_quota(self, generator: SelfieGenerator):
+        """从任务日志恢复生成器的每日计数和冷却（重启前生成的照片同样计入）"""
+        if self.journal is None:
+            return
+        count, last_at = self.journal.generated_since(generator.persona, start_of_today())
+        if count or last_at:
+            generator.restore_quota(count, last_at)
+            logger.info(f"{generator.persona or '全局'} 今日已生成 {count} 张（从任务日志恢复）")
+
+    def open_job(
+        self,
+        source: str,
+        stream_id: Optional[str],
+        activity: Optional[str],
+        prompt: str,
+        style: Optional[str] = None,
+        perspective: Optional[str] = None,
+    ) -> JobHandle:
+        """在任务日志中登记一次拍照（未启用任务日志时返回空句柄）"""
+        persona = self.persona_for(stream_id).name
+        if self.journal is None:
+            return JobHandle(None, persona=persona)
+        return self.journal.begin(source, stream_id, activity, prompt, persona, style, perspective)
+
+    async def recover_jobs(self) -> int:
+        """
+        处理上次运行未完成的任务：已生成未发送的补发（不再生图），未生成的按配置重新生成或放弃
+
+        Returns:
+            处理的任务数
+        """
+        if self.journal is None:
+            return 0
+        records = self.journal.take_unfinished()
+        for record in records:
+            try:
+                await self._recover_job(record)
+            except Exception as e:
+                logger.error(f"恢复任务 {record.job_id[:8]} 失败: {e}", exc_info=True)
+                JobHandle(self.journal, record.job_id, record.persona, record.state).fail(str(e))
+                JOBS_RECOVERED_TOTAL.inc(result="failed")
+        return len(records)
+
+    async def _recover_job(self, record: JobRecord):
+        section = self.config.journal
+        job = JobHandle(self.journal, record.job_id, record.persona, record.state)
+        age = time.time() - record.created
+        if section.max_age > 0 and age > section.max_age:
+            job.abandon(f"任务已过期 ({age:.0f}秒)")
+            JOBS_RECOVERED_TOTAL.inc(result="abandoned")
+            return
+
+        deliver = record.state == STATE_GENERATED and section.deliver_generated
+        regenerate = record.state == STATE_ENQUEUED and section.resume_enqueued and bool(record.prompt)
+        if not record.stream_id or not (deliver or regenerate):
+            job.abandon("重启时未完成")
+            JOBS_RECOVERED_TOTAL.inc(result="abandoned")
+            return
+
+        # 和入口一样过一遍群限制、限流和生成器的冷却/每日上限，补发不能绕过限额
+        generator = self.persona_for(record.stream_id).generator
+        group, reason = self.reserve_group(record.stream_id, record.activity)
+        if group is None:
+            self._abandon_recovered(job, reason)
+            return
+        try:
+            allowed, reason = True, None
+            if regenerate:
+                allowed, reason = await generator.can_take_selfie()
+            if allowed:
+                allowed, reason = await self.acquire_rate(record.stream_id)
+            if not allowed:
+                self._abandon_recovered(job, reason)
+                return
+            await self._deliver_recovered(record, job, generator, deliver)
+        finally:
+            group.release()
+
+    def _abandon_recovered(self, job: JobHandle, reason: Optional[str]):
+        job.abandon(f"重启后未通过限制: {reason}")
+        JOBS_RECOVERED_TOTAL.inc(result="abandoned")
+        logger.info(f"重启前未完成的任务 {job.job_id[:8]} 已放弃: {reason}")
+
+    async def _deliver_recovered(self, record: JobRecord, job: JobHandle, generator: SelfieGenerator, deliver: bool):
+        """补发已生成的图片或重新生成后发送（限制已检查、令牌已扣减，没发出去时归还）"""
+        with start_trace("recovery", job_id=record.job_id), deadline_scope(self.config.timeouts.total):
+            if deliver:
+                loop = asyncio.get_running_loop()
+                image_base64 = await loop.run_in_executor(None, self.journal.read_image, record)
+                result = "delivered"
+                if image_base64 is None:
+                    await self.refund_rate(record.stream_id)
+                    job.abandon("已生成的图片丢失")
+                    JOBS_RECOVERED_TOTAL.inc(result="abandoned")
+                    return
+            else:
+                image_base64, error = await generator.generate_selfie(record.prompt, PRIORITY_BACKGROUND)
+                result = "regenerated"
+                if image_base64 is None:
+                    await self.refund_rate(record.stream_id)
+                    job.fail(error)
+                    JOBS_RECOVERED_TOTAL.inc(result="failed")
+                    return
+                job.generated(image_base64)
+
+            from src.plugin_system.apis import send_api
+            try:
+                success = await run_phase(
+                    "send", send_api.image_to_stream(image_base64, record.stream_id), self.config.timeouts.send,
+                )
+            except PhaseTimeout as e:
+                logger.warning(f"补发照片超时: {e}")
+                success = False
+            if not success:
+                await self.refund_rate(record.stream_id)
+            self.record_send(
+                record.source, "success" if success else "send_failed", record.stream_id, record.activity,
+                style=record.style, perspective=record.perspective, image_base64=image_base64,
+            )
+        job.finish(success)
+        JOBS_RECOVERED_TOTAL.inc(result=result if success else "failed")
+        logger.info(f"重启前未完成的任务 {record.job_id[:8]} {'已补发' if success else '补发失败'}: stream={record.stream_id}")
+
+    def reserve_group(
+        self, stream_id: Optional[str], activity: Optional[str],
+    ) -> Tuple[Optional[GroupReservation], Optional[str]]:
+        """
+        按群检查冷却/每日上限/当天重复活动并预占（未启用历史时总是允许）
+
+        通过时返回预占，发送结束（先 record_send）或放弃时 release()；不通过时返回 (None, 原因)。
+        """
+        if self.history is None:
+            return GroupReservation(), None
+        section = self.config.history
+        return self.history.reserve_group(
+            stream_id,
+            activity,
+            cooldown_seconds=section.group_cooldown_seconds,
+            max_daily=section.group_max_daily,
+            no_repeat_activity=section.no_repeat_activity,
+        )
+
+    def record_send(
+        self,
+        source: str,
+        outcome: str,
+        stream_id: Optional[str],
+        activity: Optional[str],
+        style: Optional[str] = None,
+        perspective: Optional[str] = None,
+        image_base64: Optional[str] = None,
+        duration_ms: Optional[float] = None,
+    ):
+        """记录一次发送结果到自拍历史"""
+        if self.history is None:
+            return
+        trace = current_trace()
+        self.history.record(
+            KIND_SEND,
+            source=source,
+            outcome=outcome,
+            stream_id=stream_id,
+            activity=activity.strip() if activity else None,
+            style=style,
+            perspective=perspective,
+            model=self.persona_for(stream_id).generator.model,
+            duration_ms=duration_ms if duration_ms is not None else (trace.root.duration_ms if trace else None),
+            image_bytes=len(image_base64) if image_base64 else None,
+            image_sha1=image_digest(image_base64),
+            trace_id=trace.trace_id if trace else None,
+        )
+
+    @staticmethod
+    def _rate_limit_specs(section: RateLimitSection) -> Dict[str, BucketSpec]:
+        return {
+            SCOPE_GLOBAL: BucketSpec(section.global_per_hour, section.global_burst),
+            SCOPE_STREAM: BucketSpec(section.stream_per_hour, section.stream_burst),
+            SCOPE_USER: BucketSpec(section.user_per_hour, section.user_burst),
+        }
+
+    @staticmethod
+    def _rate_limit_path(section: RateLimitSection) -> Path:
+        return Path(section.state_path) if section.state_path else PLUGIN_DIR / "data" / "rate_limits.json"
+
+    def _open_rate_limiter(self, section: RateLimitSection) -> Optional[Limiter]:
+        if not section.enabled:
+            return None
+        if self.shared_state is not None:
+            return SharedRateLimiter(self.shared_state, self._rate_limit_specs(section))
+        return RateLimiter(self._rate_limit_path(section), self._rate_limit_specs(section))
+
+    def _on_rate_limit_change(self, cfg: SelfieConfig, changed: Set[str]):
+        section = cfg.rate_limit
+        path = None
+        if section.enabled:
+            path = self.shared_state.db_path if self.shared_state else self._rate_limit_path(section)
+        current = self.rate_limiter.state_path if self.rate_limiter else None
+        if path == current:
+            if self.rate_limiter:
+                self.rate_limiter.configure(self._rate_limit_specs(section))
+            return
+        if self.rate_limiter:
+            self.rate_limiter.close()
+        self.rate_limiter = self._open_rate_limiter(section)
+
+    async def acquire_rate(self, stream_id: Optional[str], user_id: Optional[str] = None) -> Tuple[bool, Optional[str]]:
+        """扣减全局/群/用户令牌（未启用限流时总是允许）"""
+        limiter = self.rate_limiter
+        if limiter is None:
+            return True, None
+        if limiter.blocking:
+            # 跨进程写事务可能等其他进程的写锁，不能卡住事件循环
+            return await asyncio.get_running_loop().run_in_executor(None, limiter.acquire, stream_id, user_id)
+        return limiter.acquire(stream_id, user_id)
+
+    async def refund_rate(self, stream_id: Optional[str], user_id: Optional[str] = None):
+        """没有真正发出照片时归还令牌"""
+        limiter = self.rate_limiter
+        if limiter is None:
+            return
+        if limiter.blocking:
+            await asyncio.get_running_loop().run_in_executor(None, limiter.refund, stream_id, user_id)
+        else:
+            limiter.refund(stream_id, user_id)
+
+    @staticmethod
+    def _budget_path(section: BudgetSection) -> Path:
+        return Path(section.state_path) if section.state_path else PLUGIN_DIR / "data" / "usage.json"
+
+    def _open_budget(self, section: BudgetSection) -> Optional[BudgetTracker]:
+        if not section.enabled:
+            return None
+        return BudgetTracker(self._budget_path(section), section, shared=self.shared_state)
+
+    def _on_budget_change(self, cfg: SelfieConfig, changed: Set[str]):
+        section = cfg.budget
+        path = self._budget_path(section) if section.enabled else None
+        current = self.budget.state_path if self.budget else None
+        if path == current:
+            if self.budget:
+                self.budget.configure(section)
+            return
+        if self.budget:
+            self.budget.close()
+        self.budget = self._open_budget(section)
+        for persona in self.personas:
+            persona.generator.budget = self.budget
+
+    def pacing_factor(self, stream_id: Optional[str] = None) -> float:
+        """
+        自动触发概率的缩放系数（0~1）
+
+        同时考虑用量预算和（该群人设的）max_daily_selfies：花得比时间快时降低触发概率。
+        """
+        if self.budget is None:
+            return 1.0
+        generator = self.persona_for(stream_id).generator
+        return self.budget.pacing_factor(
+            extra_daily=(generator.daily_count, generator.config.limits.max_daily_selfies),
+        )
+
+    def score_trigger(self, activity: str, previous: Optional[str], stream_id: str) -> TriggerDecision:
+        """
+        为一次活动变化打分并决定是否拍照
+
+        近期已拍活动取目标群今天发过的照片；最近拍照时间取该群历史和本进程生成时间中较晚的一个。
+        """
+        now = time.time()
+        recent: Set[str] = set()
+        last_photo_at = self.persona_for(stream_id).generator.last_selfie_time
+        if self.history is not None:
+            recent = self.history.activities_since(stream_id, start_of_today())
+            group_last = self.history.last_sent_at(stream_id)
+            if group_last is not None:
+                last_photo_at = max(last_photo_at or 0.0, group_last)
+        return self.trigger_scorer.evaluate(
+            activity,
+            previous,
+            now=now,
+            hour=datetime.fromtimestamp(now).hour,
+            recent_activities=recent,
+            last_photo_at=last_photo_at,
+            audience=self.target_selector.activity_level(stream_id),
+            budget=self.pacing_factor(stream_id),
+        )
+
+    def debug_reporter(self, cfg: Optional[SelfieConfig] = None) -> DebugReporter:
+        """为一次请求创建调试报告（调试模式关闭或没有调试群时为空操作）"""
+        cfg = cfg or self.config
+        return DebugReporter(
+            enabled=cfg.plugin.debug_mode,
+            stream_ids=cfg.permission.debug_streams,
+            flush_interval=cfg.debug.flush_interval_seconds,
+        )
+
+
+_runtime: Optional[SelfieRuntime] = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime() -> SelfieRuntime:
+    """获取全局运行时（首次调用时创建；预热在线程池中构建，需要加锁）"""
+    global _runtime
+    if _runtime is None:
+        with _runtime_lock:
+            if _runtime is None:
+                _runtime = SelfieRuntime(get_config_store())
+    return _runtime
+
+
+def reset_runtime():
+    """丢弃全局运行时，下次 get_runtime() 时按当前配置存储重建"""
+    global _runtime
+    if _runtime is not None:
+        if _runtime.history is not None:
+            _runtime.history.close()
+        if _runtime.rate_limiter is not None:
+            _runtime.rate_limiter.close()
+        if _runtime.budget is not None:
+            _runtime.budget.close()
+        if _runtime.journal is not None:
+            _runtime.journal.close()
+        if _runtime.shared_state is not None:
+            _runtime.shared_state.close()
+    _runtime = None
@@ -0,0 +1,199 @@
+"""生图调度 - 按优先级分配生图并发：交互请求优先，后台触发在队列饱和时丢弃"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+import itertools
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from src.common.logger import get_logger
+from .config_snapshot import SchedulerSection
+from .deadline import run_phase
+from .metrics import REGISTRY
+
+logger = get_logger("selfie_plugin.scheduler")
+
+# 优先级类别：LLM 工具调用 / 调试命令 / 活动触发
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_DEBUG = "debug"
+PRIORITY_BACKGROUND = "background"
+PRIORITY_CLASSES = (PRIORITY_INTERACTIVE, PRIORITY_DEBUG, PRIORITY_BACKGROUND)
+
+SCHEDULER_WAIT_SECONDS = REGISTRY.histogram(
+    "selfie_scheduler_wait_seconds", "生图请求排队等待的时间", ("priority",),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+SCHEDULER_QUEUED = REGISTRY.gauge(
+    "selfie_scheduler_queued", "排队中的生图请求数", ("priority",),
+)
+SCHEDULER_RUNNING = REGISTRY.gauge(
+    "selfie_scheduler_running", "正在生图的请求数", ("priority",),
+)
+SCHEDULER_REJECTED_TOTAL = REGISTRY.counter(
+    "selfie_scheduler_rejected_total",
+    "被调度器拒绝的生图请求（queue_full 队列已满 / preempted 被挤出队列 / wait_timeout 排队超时）",
+    ("priority", "reason"),
+)
+
+
+class SchedulerRejected(Exception):
+    """请求没有拿到生图名额（队列已满、被更高优先级挤出或排队超时）"""
+
+    def __init__(self, priority: str, reason: str, message: str):
+        super().__init__(message)
+        self.priority = priority
+        self.reason = reason
+        SCHEDULER_REJECTED_TOTAL.inc(priority=priority, reason=reason)
+
+
+@dataclass(eq=False)
+class _Waiter:
+    priority: str
+    rank: int
+    seq: int
+    future: "asyncio.Future[None]" = field(repr=False)
+
+
+class GenerationScheduler:
+    """
+    生图调度器
+
+    - 名额：同时生图的请求不超过 max_concurrent，每个类别另有并发上限（0 表示只受总数限制）
+    - 排队：按优先级（数值小的优先，interactive 0 / debug 为 debug_priority / background 2）、
+      同优先级按到达顺序放行；某个类别到达上限时不挡住其他类别
+    - 饱和：排队数达到 max_queue 时，后台请求直接丢弃；交互和调试请求把最后到达的低优先级请求挤出队列
+    - 后台请求最多排队 background_max_wait 秒（所有请求都受整体截止时间约束）
+    """
+
+    def __init__(self, section: Optional[SchedulerSection] = None):
+        self._running: Dict[str, int] = {priority: 0 for priority in PRIORITY_CLASSES}
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self.configure(section or SchedulerSection())
+
+    def configure(self, section: SchedulerSection):
+        self.section = section
+        self._ranks = {
+            PRIORITY_INTERACTIVE: 0,
+            PRIORITY_DEBUG: section.debug_priority,
+            PRIORITY_BACKGROUND: 2,
+        }
+        self._caps = {
+            PRIORITY_INTERACTIVE: section.interactive_concurrency,
+            PRIORITY_DEBUG: section.debug_concurrency,
+            PRIORITY_BACKGROUND: section.background_concurrency,
+        }
+        # 上限调高时放行排队中的请求
+        self._dispatch()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def running(self) -> int:
+        return sum(self._running.values())
+
+    def _has_capacity(self, priority: str) -> bool:
+        limit = self.section.max_concurrent
+        if limit > 0 and self.running >= limit:
+            return False
+        cap = self._caps[priority]
+        return cap <= 0 or self._running[priority] < cap
+
+    def _update_gauges(self):
+        for priority in PRIORITY_CLASSES:
+            SCHEDULER_RUNNING.set(self._running[priority], priority=priority)
+            SCHEDULER_QUEUED.set(sum(1 for w in self._waiters if w.priority == priority), priority=priority)
+
+    def _dispatch(self):
+        for waiter in sorted(self._waiters, key=lambda w: (w.rank, w.seq)):
+            if waiter.future.done():
+                self._waiters.remove(waiter)
+                continue
+            if not self._has_capacity(waiter.priority):
+                continue
+            self._waiters.remove(waiter)
+            self._running[waiter.priority] += 1
+            waiter.future.set_result(None)
+        self._update_gauges()
+
+    def _admit(self, priority: str) -> Optional[_Waiter]:
+        """有名额时直接占用并返回 None，否则排队并返回等待者"""
+        if priority not in self._ranks:
+            raise ValueError(f"未知优先级 {priority}，可选 {PRIORITY_CLASSES}")
+        if self._has_capacity(priority):
+            self._running[priority] += 1
+            self._update_gauges()
+            return None
+
+        rank = self._ranks[priority]
+        max_queue = self.section.max_queue
+        if max_queue > 0 and len(self._waiters) >= max_queue:
+            if priority == PRIORITY_BACKGROUND:
+                raise SchedulerRejected(priority, "queue_full", "生图队列已满，跳过后台拍照")
+            # 挤出优先级最低、最后到达的请求
+            victims = [w for w in self._waiters if w.rank > rank]
+            if victims:
+                victim = max(victims, key=lambda w: (w.rank, w.seq))
+                self._waiters.remove(victim)
+                victim.future.set_exception(
+                    SchedulerRejected(victim.priority, "preempted", "生图队列已满，让位给优先级更高的请求")
+                )
+                logger.info(f"{victim.priority} 请求让位给 {priority} 请求")
+
+        waiter = _Waiter(priority, rank, next(self._seq), asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._update_gauges()
+        return waiter
+
+    def _abandon(self, waiter: _Waiter):
+        """排队中途退出（超时/取消/被挤出）：还在队列里就移除，已经拿到名额就归还"""
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+            self._update_gauges()
+        elif waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+            self.release(waiter.priority)
+
+    async def acquire(self, priority: str = PRIORITY_INTERACTIVE):
+        """
+        占用一个生图名额（用完调用 release），排不上时抛出 SchedulerRejected，
+        排队超过整体截止时间时抛出 PhaseTimeout
+        """
+        started = time.monotonic()
+        waiter = self._admit(priority)
+        if waiter is not None:
+            limit = self.section.background_max_wait if priority == PRIORITY_BACKGROUND else None
+            try:
+                await run_phase("queue", waiter.future, limit)
+            except asyncio.TimeoutError:
+                self._abandon(waiter)
+                if priority == PRIORITY_BACKGROUND:
+                    raise SchedulerRejected(priority, "wait_timeout", "生图排队超时，跳过后台拍照") from None
+                raise
+            except BaseException:
+                self._abandon(waiter)
+                raise
+        SCHEDULER_WAIT_SECONDS.observe(time.monotonic() - started, priority=priority)
+
+    def release(self, priority: str = PRIORITY_INTERACTIVE):
+        """归还名额并放行排队中的请求"""
+        self._running[priority] = max(0, self._running[priority] - 1)
+        self._dispatch()
+
+
+_scheduler = GenerationScheduler()
+
+
+def get_scheduler() -> GenerationScheduler:
+    """全局生图调度器（所有人设共用名额）"""
+    return _scheduler
+
+
+def configure_scheduler(section: SchedulerSection):
+    """应用 [selfie.scheduler] 配置"""
+    _scheduler.configure(section)
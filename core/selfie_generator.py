@@ -4,20 +4,43 @@
 // "We shape the void."
 """
 
+import asyncio
 import os
-import re
 import time
 import random
-import base64
 import mimetypes
 from pathlib import Path
-from typing import Optional, Tuple, Dict, Any, List
+from typing import Optional, Tuple, Dict, Any, List, Set
 from enum import Enum
 import aiohttp
 from src.common.logger import get_logger
+from .config_snapshot import SelfieConfig
+from .metrics import (
+    API_LATENCY_SECONDS, API_REQUESTS_TOTAL, DOWNLOAD_SECONDS, EXTRACTOR_SCAN_TRUNCATED_TOTAL, EXTRACTOR_TOTAL,
+    IMAGE_BYTES, IMAGE_POSTPROCESS_TOTAL, QUEUE_DEPTH, endpoint_label,
+)
+from .tracing import current_trace, span
+from .history_store import HistoryStore, KIND_GENERATE, image_digest
+from .budget import BudgetTracker
+from .shared_state import QuotaReservation, SharedState, judge_quota
+from .offload import get_offloader
+from .http_client import get_http_session
+from .hedging import get_hedge_policy, run_hedged
+from .latency import ATTEMPT_TIMEOUT_SECONDS, get_latency_tracker
+from .scheduler import PRIORITY_INTERACTIVE, SchedulerRejected, get_scheduler
+from .worker import WorkerUnavailable, get_worker_client
+from .deadline import PhaseTimeout, current_deadline, run_phase
+from .downloader import DOWNLOAD_FAILURES_TOTAL, DownloadError, download_image
+from .response_classifier import (
+    KIND_TEXT_ONLY, REJECTION_CACHE_TOTAL, RejectionCache, ResponseRejected, classify_response, prompt_fingerprint,
+)
+from . import image_ops
 
 logger = get_logger("selfie_plugin.generator")
 
+# aiohttp 3.10+ 区分连接超时和读超时
+_CONNECT_TIMEOUT = getattr(aiohttp, "ConnectionTimeoutError", ())
+
 
 class SelfieStyle(Enum):
     """照片质量风格"""
@@ -31,39 +54,154 @@ class PhotoPerspective(Enum):
     POV = "pov"  # 第一人称视角
 
 
+class ReferenceCache:
+    """
+    参考图 base64 缓存：路径 -> ((mtime_ns, size), base64, mime)
+
+    所有人设的生成器共用一份，多个人设引用同一张图时只编码一次；文件变化后按戳记重新编码。
+    """
+
+    def __init__(self):
+        self._entries: Dict[Path, Tuple[Tuple[int, int], str, str]] = {}
+
+    def get(self, path: Path, stamp: Tuple[int, int]) -> Optional[Tuple[str, str]]:
+        cached = self._entries.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1], cached[2]
+        return None
+
+    def put(self, path: Path, stamp: Tuple[int, int], image_data: str, mime_type: str):
+        self._entries[path] = (stamp, image_data, mime_type)
+
+    def retain(self, paths: Set[Path]):
+        """只保留仍被引用的参考图"""
+        for path in [p for p in self._entries if p not in paths]:
+            del self._entries[path]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_reference_cache = ReferenceCache()
+
+
+def get_reference_cache() -> ReferenceCache:
+    """全局参考图缓存"""
+    return _reference_cache
+
+
 class SelfieGenerator:
-    """自拍生成器"""
+    """自拍生成器（每个人设一个实例，连接池和参考图缓存全局共享）"""
 
     # Gemini 2.5 系列模型前缀
     GEMINI_25_PREFIXES = ("gemini-2.5", "gemini-2.0", "gemini-exp")
 
-    def __init__(self, config: Dict[str, Any]):
+    def __init__(
+        self,
+        config: SelfieConfig,
+        history: Optional[HistoryStore] = None,
+        budget: Optional[BudgetTracker] = None,
+        persona: str = "",
+        shared_state: Optional[SharedState] = None,
+    ):
         self.config = config
+        self.persona = persona
+        self.history = history
+        self.budget = budget
+        self.shared_state = shared_state
         self._last_selfie_time: float = 0
         self._daily_count: int = 0
         self._daily_reset_date: str = ""
+        self._shared_quota: Tuple[str, int, float] = ("", 0, 0.0)  # 最近一次读到的共享 (日期, 张数, 时间)
         self._image_index: int = 0  # 用于顺序轮换
+        self._character_images: List[Path] = []
+        self._endpoints: Tuple[str, ...] = ()
+        self._endpoint_index: int = 0  # 上次成功的接口，下次从它开始
+        self._rejections = RejectionCache()  # 被拒的提示词，过期前不再请求
+        self.apply_config(config)
+
+    def apply_config(self, config: SelfieConfig, changed: Optional[Set[str]] = None):
+        """
+        应用配置快照，只刷新变化的部分
+
+        Args:
+            config: 新配置快照
+            changed: 变化的配置段，None 表示全部
+        """
+        self.config = config
 
         # API配置
-        api_cfg = config.get("api", {})
-        self._api_base = api_cfg.get("api_base", "")
-        self._api_key = api_cfg.get("api_key", "") or os.environ.get("SELFIE_API_KEY", "")
-        self._model = api_cfg.get("model", "gemini-3-pro-image")
-        self._timeout = api_cfg.get("timeout", 120)
-        self._max_retries = api_cfg.get("max_retries", 2)
+        if changed is None or "api" in changed:
+            api_cfg = config.api
+            self._endpoints = tuple(dict.fromkeys(e for e in (api_cfg.api_base, *api_cfg.endpoints) if e))
+            self._endpoint_index = 0
+            self._api_key = api_cfg.api_key or os.environ.get("SELFIE_API_KEY", "")
+            self._model = api_cfg.model
+            self._timeout = api_cfg.timeout
+            self._max_retries = api_cfg.max_retries
 
         # 风格配置
-        style_cfg = config.get("style", {})
-        self._professional_ratio = style_cfg.get("professional_ratio", 0.3)
-        self._selfie_ratio = style_cfg.get("selfie_ratio", 0.5)
-
-        # 人设图片配置
-        char_cfg = config.get("character", {})
-        self._image_folder = char_cfg.get("image_folder", "")
-        self._use_random = char_cfg.get("use_random_image", True)
-        self._supported_formats = char_cfg.get("supported_formats", ["jpg", "jpeg", "png", "webp"])
-        self._character_images: List[Path] = []
-        self._load_character_images()
+        if changed is None or "style" in changed:
+            self._professional_ratio = config.style.professional_ratio
+            self._selfie_ratio = config.style.selfie_ratio
+
+        # 人设图片配置（只有文件夹相关配置变化时才重新扫描）
+        if changed is None or "character" in changed:
+            char_cfg = config.character
+            self._image_folder = char_cfg.image_folder
+            self._use_random = char_cfg.use_random_image
+            self._supported_formats = list(char_cfg.supported_formats)
+            self._character_images = []
+            self._image_index = 0
+            self._load_character_images()
+            # 换了参考图，之前被拒的提示词可能可以了
+            self._rejections.clear()
+
+    @property
+    def model(self) -> str:
+        """当前生图模型"""
+        return self._model
+
+    @property
+    def daily_count(self) -> int:
+        """今日已生成张数（开启共享状态时为最近一次检查/预占时读到的所有进程合计，不读库）"""
+        today = time.strftime("%Y-%m-%d")
+        if self.shared_state is not None:
+            day, count, _ = self._shared_quota
+            return count if day == today else 0
+        return self._daily_count if self._daily_reset_date == today else 0
+
+    @property
+    def last_selfie_time(self) -> Optional[float]:
+        """最近一次生成（或预占）的时间戳（开启共享状态时含其他进程）"""
+        last = self._last_selfie_time
+        if self.shared_state is not None:
+            last = max(last, self._shared_quota[2])
+        return last or None
+
+    @property
+    def quota_name(self) -> str:
+        """共享状态中每日计数/冷却的键"""
+        return f"generator:{self.persona}"
+
+    def restore_quota(self, count: int, last_at: Optional[float]):
+        """恢复今日已生成张数和最近一次生成时间（重启或换任务日志后读取，只增不减）"""
+        today = time.strftime("%Y-%m-%d")
+        if self._daily_reset_date == today:
+            count = max(count, self._daily_count)
+        self._daily_count = count
+        self._daily_reset_date = today
+        self._last_selfie_time = max(self._last_selfie_time, last_at or 0)
+
+    @property
+    def reference_image_count(self) -> int:
+        """已加载的人设参考图数量"""
+        return len(self._character_images)
+
+    @property
+    def reference_images(self) -> List[Path]:
+        """已加载的人设参考图路径"""
+        return list(self._character_images)
 
     def _is_gemini_25(self) -> bool:
         """检测是否使用 Gemini 2.5 系列模型"""
@@ -91,7 +229,7 @@ class SelfieGenerator:
         else:
             logger.warning(f"人设图片文件夹为空: {self._image_folder}")
 
-    def _get_reference_image(self) -> Optional[Tuple[str, str]]:
+    async def _get_reference_image(self) -> Optional[Tuple[str, str]]:
         """
         获取一张参考图片
 
@@ -109,14 +247,7 @@ class SelfieGenerator:
             self._image_index += 1
 
         try:
-            with open(image_path, "rb") as f:
-                image_data = base64.b64encode(f.read()).decode("utf-8")
-
-            # 获取 mime type
-            mime_type, _ = mimetypes.guess_type(str(image_path))
-            if not mime_type:
-                mime_type = "image/jpeg"
-
+            image_data, mime_type = await self._encode_reference(image_path)
             logger.debug(f"使用参考图: {image_path.name}")
             return image_data, mime_type
 
@@ -124,29 +255,115 @@ class SelfieGenerator:
             logger.error(f"读取参考图失败 {image_path}: {e}")
             return None
 
-    def can_take_selfie(self) -> Tuple[bool, Optional[str]]:
-        """检查是否可以拍照（冷却+每日上限）"""
-        current_time = time.time()
-        today = time.strftime("%Y-%m-%d")
+    async def _encode_reference(self, image_path: Path) -> Tuple[str, str]:
+        """编码参考图（按 mtime/大小缓存，文件变化后重新编码）"""
+        st = image_path.stat()
+        stamp = (st.st_mtime_ns, st.st_size)
+        cache = get_reference_cache()
+        cached = cache.get(image_path, stamp)
+        if cached is not None:
+            return cached
+
+        image_data = await get_offloader().run(
+            "encode_reference", image_ops.encode_file_base64, str(image_path), size=st.st_size,
+        )
+        # 获取 mime type
+        mime_type, _ = mimetypes.guess_type(str(image_path))
+        if not mime_type:
+            mime_type = "image/jpeg"
+        cache.put(image_path, stamp, image_data, mime_type)
+        return image_data, mime_type
+
+    async def preload_reference_images(self) -> int:
+        """预先编码所有参考图（启动预热时调用），返回成功数量"""
+        loaded = 0
+        for image_path in list(self._character_images):
+            try:
+                await self._encode_reference(image_path)
+                loaded += 1
+            except Exception as e:
+                logger.warning(f"预编码参考图失败 {image_path}: {e}")
+        if loaded:
+            logger.debug(f"预编码了 {loaded} 张参考图")
+        return loaded
+
+    async def can_take_selfie(self) -> Tuple[bool, Optional[str]]:
+        """
+        检查是否可以拍照（冷却+每日上限），入口处提前判断，避免白白构建提示词
+
+        只检查不预占，真正的预占在 generate_selfie(enforce_limits=True)。开启共享状态时按所有进程合计
+        （读库放到执行器里，不卡住事件循环）。
+        """
+        limits = self.config.limits
+        shared_state = self.shared_state
+        if shared_state is not None:
+            count, last_at = await asyncio.get_running_loop().run_in_executor(None, shared_state.quota, self.quota_name)
+            self._shared_quota = (time.strftime("%Y-%m-%d"), count, last_at)
+        else:
+            self._roll_daily()
+            count, last_at = self._daily_count, self._last_selfie_time
+        return judge_quota(count, last_at, limits.max_daily_selfies, limits.cooldown_seconds, time.time())
 
-        # 重置每日计数
+    def _roll_daily(self):
+        """跨天时重置进程内的每日计数"""
+        today = time.strftime("%Y-%m-%d")
         if today != self._daily_reset_date:
             self._daily_count = 0
             self._daily_reset_date = today
 
-        # 检查每日上限
-        max_daily = self.config.get("max_daily_selfies", 5)
-        if self._daily_count >= max_daily:
-            return False, f"今日已达上限({max_daily}张)"
-
-        # 检查冷却
-        cooldown = self.config.get("cooldown_seconds", 3600)
-        elapsed = current_time - self._last_selfie_time
-        if elapsed < cooldown:
-            remaining = int(cooldown - elapsed)
-            return False, f"冷却中({remaining}秒)"
+    async def _reserve_quota(
+        self, shared_state: Optional[SharedState],
+    ) -> Tuple[Optional[QuotaReservation], Optional[str]]:
+        """
+        原子地检查并预占一张（今日计数 +1，冷却从现在开始）
 
-        return True, None
+        开启共享状态时在共享库里预占（跨进程写事务可能等其他进程的写锁，放到执行器里），
+        否则在进程内预占（检查和扣减之间没有 await，并发的请求不会一起通过）。
+        """
+        limits = self.config.limits
+        if shared_state is not None:
+            reservation, reason = await asyncio.get_running_loop().run_in_executor(
+                None, shared_state.reserve_quota, self.quota_name, limits.max_daily_selfies, limits.cooldown_seconds,
+            )
+            if reservation is not None:
+                self._shared_quota = (reservation.day, reservation.count, reservation.reserved_at)
+            return reservation, reason
+
+        self._roll_daily()
+        now = time.time()
+        allowed, reason = judge_quota(
+            self._daily_count, self._last_selfie_time, limits.max_daily_selfies, limits.cooldown_seconds, now,
+        )
+        if not allowed:
+            return None, reason
+        reservation = QuotaReservation(
+            self.quota_name, self._daily_reset_date, now, self._last_selfie_time, self._daily_count + 1,
+        )
+        self._daily_count += 1
+        self._last_selfie_time = now
+        return reservation, None
+
+    async def _release_quota(self, reservation: QuotaReservation, shared_state: Optional[SharedState]):
+        """没生成出来时归还预占（冷却只在没有被之后的预占刷新过时回退）"""
+        if shared_state is not None:
+            await asyncio.get_running_loop().run_in_executor(None, shared_state.release_quota, reservation)
+            return
+        if self._daily_reset_date == reservation.day:
+            self._daily_count = max(0, self._daily_count - 1)
+        if self._last_selfie_time == reservation.reserved_at:
+            self._last_selfie_time = reservation.previous_last_at
+
+    async def _record_quota(self, shared_state: Optional[SharedState]) -> int:
+        """不检查地计入一张（enforce_limits=False 时生成成功后调用），返回今日张数"""
+        if shared_state is not None:
+            recorded = await asyncio.get_running_loop().run_in_executor(None, shared_state.record_quota, self.quota_name)
+            if recorded is not None:
+                self._shared_quota = (time.strftime("%Y-%m-%d"), *recorded)
+            return self.daily_count
+        self._roll_daily()
+        self._daily_count += 1
+        self._last_selfie_time = time.time()
+        return self._daily_count
 
     def select_style(self) -> SelfieStyle:
         """按配置比例随机选择质量风格"""
@@ -156,7 +373,7 @@ class SelfieGenerator:
         """按配置比例随机选择视角"""
         return PhotoPerspective.SELFIE if random.random() < self._selfie_ratio else PhotoPerspective.POV
 
-    def _build_message_content(self, prompt: str) -> Any:
+    async def _build_message_content(self, prompt: str) -> Any:
         """
         构建消息内容（支持多模态）
 
@@ -168,7 +385,9 @@ class SelfieGenerator:
         Returns:
             str 或 List[dict] - 消息内容
         """
-        ref_image = self._get_reference_image()
+        with span("reference_image") as ref_span:
+            ref_image = await self._get_reference_image()
+            ref_span.set(bytes=len(ref_image[0]) if ref_image else 0)
 
         if ref_image is None:
             # 无参考图，返回纯文本
@@ -193,23 +412,121 @@ class SelfieGenerator:
         logger.debug("使用多模态消息（含参考图）")
         return content
 
-    async def generate_selfie(self, prompt: str) -> Tuple[Optional[str], Optional[str]]:
+    async def generate_selfie(
+        self, prompt: str, priority: str = PRIORITY_INTERACTIVE, enforce_limits: bool = True,
+    ) -> Tuple[Optional[str], Optional[str]]:
         """
         生成自拍图片
 
         Args:
             prompt: 生图提示词
+            priority: 调度优先级（interactive 工具调用 / debug 调试命令 / background 活动触发）
+            enforce_limits: 是否受冷却和每日上限约束。是则生图前原子地预占一张、没生成出来时归还；
+                否（调试命令）则不检查，生成成功后照常计入今日张数。开启共享状态与否行为一致。
 
         Returns:
             (base64_image, error_message) - 成功返回(base64, None)，失败返回(None, error)
         """
         if not self._api_key:
             return None, "API密钥未配置"
-        if not self._api_base:
+        if not self._endpoints:
             return None, "API地址未配置"
+        if self.budget is not None:
+            within_budget, reason = self.budget.check()
+            if not within_budget:
+                return None, reason
+
+        # 生图期间换了共享状态时，按预占时的存储归还/计数
+        shared_state = self.shared_state
+        reservation = None
+        if enforce_limits:
+            reservation, reason = await self._reserve_quota(shared_state)
+            if reservation is None:
+                return None, reason
+
+        image_data, error = None, None
+        try:
+            image_data, error = await self._schedule(prompt, priority)
+            if image_data:
+                count = reservation.count if reservation is not None else await self._record_quota(shared_state)
+                persona = f"[{self.persona}] " if self.persona else ""
+                logger.info(f"{persona}图片生成成功，今日第{count}张")
+            return image_data, error
+        finally:
+            if reservation is not None and not image_data:
+                await self._release_quota(reservation, shared_state)
+
+    async def _schedule(self, prompt: str, priority: str) -> Tuple[Optional[str], Optional[str]]:
+        """按优先级排队占用生图名额（整个生成过程含重试、对冲都占着这一个名额）"""
+        scheduler = get_scheduler()
+        try:
+            with span("queue", priority=priority):
+                await scheduler.acquire(priority)
+        except SchedulerRejected as e:
+            logger.info(str(e))
+            return None, str(e)
+        except PhaseTimeout as e:
+            return None, f"请求超时: {e}"
+        try:
+            return await self._run(prompt)
+        finally:
+            scheduler.release(priority)
+
+    async def _run(self, prompt: str) -> Tuple[Optional[str], Optional[str]]:
+        """占到生图名额后生图，并记入历史（每日计数和冷却在 generate_selfie 里）"""
+        started = time.monotonic()
+        with QUEUE_DEPTH.track_inprogress():
+            image_data, error = await self._produce(prompt)
+
+        if image_data:
+            self._record_history("success", started, image_data=image_data)
+            return image_data, None
+        error = error or "生成失败，请稍后重试"
+        self._record_history("failed", started, error=error)
+        return None, error
+
+    async def _produce(self, prompt: str) -> Tuple[Optional[str], Optional[str]]:
+        """开启生图子进程时交给子进程，子进程不可用时在本进程内生成"""
+        worker = get_worker_client()
+        if worker is not None and worker.available:
+            try:
+                budget = self.budget.check() if self.budget is not None else (True, None)
+                with span("worker"):
+                    result = await worker.generate(self.persona, self.config, prompt, budget)
+            except WorkerUnavailable as e:
+                logger.warning(f"{e}，改为在本进程内生图")
+            except PhaseTimeout as e:
+                return None, f"请求超时: {e}"
+            else:
+                # 子进程里的请求同样计入本进程的用量预算
+                if self.budget is not None:
+                    for record in result.usage:
+                        self.budget.record(*record)
+                return result.image, result.error
+        return await self.generate_local(prompt)
+
+    async def generate_local(self, prompt: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        在当前进程内构建请求并按接口池重试
+
+        不检查额度、不排队、不记账，由 _run（或生图子进程）负责。
+        响应被判定为安全拦截、拒绝或纯文字回答时不再重试，同一提示词在 cache_seconds 内直接返回上次的原因。
+
+        Returns:
+            (base64_image, error_message)
+        """
+        refusal = self.config.refusal
+        fingerprint = prompt_fingerprint(self._model, prompt)
+        if refusal.enabled:
+            cached = self._rejections.get(fingerprint)
+            if cached is not None:
+                verdict, remaining = cached
+                REJECTION_CACHE_TOTAL.inc(result="hit")
+                logger.info(f"提示词近期被拒 ({verdict.kind})，跳过请求")
+                return None, f"{verdict.reason}（同一提示词{remaining:.0f}秒内不再请求）"
 
         # 构建消息内容（支持多模态）
-        message_content = self._build_message_content(prompt)
+        message_content = await self._build_message_content(prompt)
 
         payload = {
             "model": self._model,
@@ -225,78 +542,317 @@ class SelfieGenerator:
             logger.info(f"检测到 Gemini 2.5 系列模型: {self._model}，使用兼容解析")
 
         last_error = None
+        deadline = current_deadline()
+        min_attempt = self.config.timeouts.min_attempt
         for attempt in range(self._max_retries + 1):
+            # 剩余时间不够一次像样的尝试时不再重试（首次尝试只要没过截止时间就发）
+            remaining = deadline.remaining()
+            if remaining <= 0 or (attempt and remaining < min_attempt):
+                logger.warning(f"剩余时间不足 ({remaining:.1f}秒)，停止重试")
+                last_error = last_error or "请求超时 (已到截止时间)"
+                break
+
+            # 接口池：从上次成功的接口开始，每次重试换下一个
+            index = (self._endpoint_index + attempt) % len(self._endpoints)
+            api_base = self._endpoints[index]
+            endpoint = endpoint_label(api_base)
             try:
-                logger.debug(f"生成图片 (尝试 {attempt + 1}/{self._max_retries + 1})")
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        self._api_base,
-                        json=payload,
-                        headers=headers,
-                        timeout=aiohttp.ClientTimeout(total=self._timeout)
-                    ) as resp:
-                        if resp.status != 200:
-                            error_text = await resp.text()
-                            last_error = f"API返回 {resp.status}: {error_text[:100]}"
-                            logger.warning(last_error)
-                            continue
-
-                        data = await resp.json()
-
-                        # 根据模型版本选择解析方式
-                        if is_25:
-                            image_data = await self._extract_image_gemini_25(data)
-                        else:
-                            image_data = await self._extract_image(data)
-
-                        if image_data:
-                            self._last_selfie_time = time.time()
-                            self._daily_count += 1
-                            logger.info(f"图片生成成功，今日第{self._daily_count}张")
-                            return image_data, None
-                        else:
-                            last_error = "无法从响应中提取图片"
-                            logger.warning(last_error)
-
-            except aiohttp.ClientTimeout:
-                last_error = f"请求超时 ({self._timeout}秒)"
-                logger.warning(f"生图超时 (尝试 {attempt + 1})")
+                logger.debug(f"生成图片 (尝试 {attempt + 1}/{self._max_retries + 1}, 接口 {endpoint})")
+                with span("attempt", attempt=attempt + 1, endpoint=endpoint):
+                    image_data, last_error, index = await self._attempt(index, payload, headers, is_25)
+
+                if image_data:
+                    self._endpoint_index = index
+                    return image_data, None
+                logger.warning(last_error)
+
+            except ResponseRejected as e:
+                verdict = e.verdict
+                last_error = verdict.reason
+                if verdict.kind == KIND_TEXT_ONLY and refusal.retry_text_only:
+                    logger.warning(last_error)
+                    continue
+                logger.warning(f"{last_error}，不再重试")
+                self._rejections.put(fingerprint, verdict, refusal.cache_seconds, refusal.cache_size)
+                break
+            except asyncio.TimeoutError as e:
+                API_REQUESTS_TOTAL.inc(endpoint=endpoint, status="timeout")
+                last_error = f"请求超时: {e}" if isinstance(e, PhaseTimeout) else f"请求超时 ({self._timeout}秒)"
+                logger.warning(f"生图超时 (尝试 {attempt + 1}): {e}")
             except Exception as e:
+                API_REQUESTS_TOTAL.inc(endpoint=endpoint, status="error")
                 last_error = str(e)
                 logger.error(f"生图失败 (尝试 {attempt + 1}): {e}")
 
-        return None, last_error or "生成失败，请稍后重试"
+        return None, last_error
+
+    async def _attempt(
+        self,
+        index: int,
+        payload: Dict[str, Any],
+        headers: Dict[str, str],
+        is_25: bool,
+    ) -> Tuple[Optional[str], Optional[str], int]:
+        """
+        一次尝试：开启对冲时主请求超过近期延迟分位数仍未返回，就向接口池中的下一个接口
+        （只有一个接口时为同一接口）补发，先成功者胜出
+
+        Returns:
+            (base64_image, error_message, 出图的接口序号)
+        """
+        api_base = self._endpoints[index]
+        endpoint = endpoint_label(api_base)
+        policy = get_hedge_policy()
+        delay = policy.delay(endpoint, self._model) if policy.enabled else None
+        if delay is None:
+            image_data, error = await self._request_once(api_base, payload, headers, is_25, endpoint)
+            return image_data, error, index
+
+        policy.on_request()
+        hedge_index = (index + 1) % len(self._endpoints)
+        hedge_base = self._endpoints[hedge_index]
+
+        def may_hedge() -> bool:
+            # 补发同样计入用量，预算用完时不补发
+            if self.budget is not None and not self.budget.check()[0]:
+                return False
+            return policy.try_acquire()
+
+        (image_data, error), winner = await run_hedged(
+            lambda: self._request_once(api_base, payload, headers, is_25, endpoint),
+            lambda: self._request_once(hedge_base, payload, headers, is_25, endpoint_label(hedge_base)),
+            delay,
+            is_success=lambda result: result[0] is not None,
+            may_hedge=may_hedge,
+        )
+        if winner:
+            logger.info(f"对冲请求胜出 (主请求 {delay:.2f}秒未返回，补发到 {endpoint_label(hedge_base)})")
+        return image_data, error, hedge_index if winner else index
+
+    def _record_history(
+        self,
+        outcome: str,
+        started: float,
+        image_data: Optional[str] = None,
+        error: Optional[str] = None,
+    ):
+        """记录一次生图结果到自拍历史"""
+        if self.history is None:
+            return
+        trace = current_trace()
+        self.history.record(
+            KIND_GENERATE,
+            source=trace.source if trace else "",
+            outcome=outcome,
+            model=self._model,
+            duration_ms=(time.monotonic() - started) * 1000,
+            image_bytes=len(image_data) if image_data else None,
+            image_sha1=image_digest(image_data),
+            trace_id=trace.trace_id if trace else None,
+            error=error[:200] if error else None,
+        )
+
+    def _attempt_timeout(self, endpoint: str) -> float:
+        """
+        单次尝试的超时
+
+        开启自适应超时且样本足够时取该接口、模型近期延迟的分位数 × 倍数（限制在上下限内），
+        否则为 [selfie.api].timeout
+        """
+        timeouts = self.config.timeouts
+        if not timeouts.adaptive:
+            return self._timeout
+        estimate = get_latency_tracker().quantile(
+            endpoint, self._model, timeouts.adaptive_quantile, timeouts.adaptive_min_samples,
+        )
+        if estimate is None:
+            return self._timeout
+        upper = timeouts.adaptive_max if timeouts.adaptive_max > 0 else self._timeout
+        return min(upper, max(timeouts.adaptive_min, estimate * timeouts.adaptive_multiplier))
+
+    @staticmethod
+    def _payload_size_hint(payload: Dict[str, Any]) -> int:
+        """估算请求体大小（只看多模态内容里的 data URL，避免为估算先序列化一遍）"""
+        size = 0
+        for message in payload.get("messages", []):
+            content = message.get("content")
+            if isinstance(content, str):
+                size += len(content)
+            elif isinstance(content, list):
+                for part in content:
+                    if isinstance(part, dict):
+                        size += len(part.get("image_url", {}).get("url", "")) + len(part.get("text", ""))
+        return size
+
+    async def _request_once(
+        self,
+        api_base: str,
+        payload: Dict[str, Any],
+        headers: Dict[str, str],
+        is_25: bool,
+        endpoint: str,
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        发送一次生图请求并提取图片
+
+        Returns:
+            (base64_image, error_message)
+        """
+        # 自行序列化请求体，便于按字节记账（含参考图时体积较大，交给执行器）
+        offloader = get_offloader()
+        request_body = await offloader.run(
+            "encode_json", image_ops.encode_json, payload, size=self._payload_size_hint(payload),
+        )
+        body = b""
+        usage = None
+        image_data = None
+        started = time.monotonic()
+        try:
+            # 每个阶段取自身上限与请求剩余时间中较小的一个
+            timeouts = self.config.timeouts
+            deadline = current_deadline()
+            deadline.check("first_byte")
+            attempt_timeout = self._attempt_timeout(endpoint)
+            ATTEMPT_TIMEOUT_SECONDS.observe(attempt_timeout)
+            client_timeout = aiohttp.ClientTimeout(
+                total=deadline.cap(attempt_timeout),
+                sock_connect=deadline.cap(timeouts.connect),
+                sock_read=deadline.cap(timeouts.first_byte),
+            )
+            session = get_http_session()
+            phase = "first_byte"
+            with span("http_post", endpoint=endpoint) as post_span:
+                try:
+                    async with session.post(
+                        api_base,
+                        data=request_body,
+                        headers=headers,
+                        timeout=client_timeout,
+                    ) as resp:
+                        post_span.set(status=resp.status)
+                        phase = "body_read"
+                        body = await run_phase("body_read", resp.read(), timeouts.body_read)
+                        post_span.set(bytes=len(body))
+                except asyncio.TimeoutError as e:
+                    # 用满单次尝试超时的请求按已等待时长计入统计（真实延迟只会更长），
+                    # 接口整体变慢时分位数随之上升，超时不会卡在旧的延迟水平；截止时间截断的不计入
+                    if client_timeout.total == attempt_timeout:
+                        get_latency_tracker().observe(endpoint, self._model, time.monotonic() - started)
+                    if isinstance(e, PhaseTimeout):
+                        raise
+                    raise PhaseTimeout("connect" if isinstance(e, _CONNECT_TIMEOUT) else phase) from e
+            elapsed = time.monotonic() - started
+            API_LATENCY_SECONDS.observe(elapsed, endpoint=endpoint)
+            API_REQUESTS_TOTAL.inc(endpoint=endpoint, status=str(resp.status))
+
+            if resp.status != 200:
+                error_text = body.decode("utf-8", errors="replace")
+                return None, f"API返回 {resp.status}: {error_text[:100]}"
+            # 只统计成功响应的延迟（快速失败的错误响应会把分位数拉低）
+            get_latency_tracker().observe(endpoint, self._model, elapsed)
+
+            with span("json_decode", bytes=len(body)):
+                data = await offloader.run("decode_json", image_ops.decode_json, body, size=len(body))
+            if isinstance(data, dict):
+                usage = data.get("usage")
+
+            # 根据模型版本选择解析方式
+            with span("extract") as extract_span:
+                if is_25:
+                    image_data = await self._extract_image_gemini_25(data)
+                else:
+                    image_data = await self._extract_image(data)
+                extract_span.set(bytes=len(image_data) if image_data else 0)
+
+            if not image_data:
+                # 拒绝、安全拦截、纯文字回答重试多半还是一样，交给重试循环放弃
+                verdict = classify_response(data) if self.config.refusal.enabled else None
+                if verdict is not None:
+                    raise ResponseRejected(verdict)
+                return None, "无法从响应中提取图片"
+
+            image_data, error = await self._postprocess(image_data)
+            return image_data, error
+        finally:
+            # 超时/异常的请求同样记账（多数服务商已经计费）
+            if self.budget is not None:
+                self.budget.record(endpoint, len(request_body), len(body), image_data is not None, usage)
+
+    async def _postprocess(self, image_data: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        发送前校验并规范化图片
+
+        不是图片（HTML 错误页、损坏/截断的 base64）时返回错误，由重试循环重新生成；
+        超过尺寸/体积上限时缩放转码。
+
+        Returns:
+            (base64_image, error_message)
+        """
+        image_cfg = self.config.image
+        if not image_cfg.validate:
+            return image_data, None
+
+        IMAGE_BYTES.observe(len(image_data) * 3 // 4, stage="raw")
+        with span("postprocess") as pp_span:
+            try:
+                result, info = await get_offloader().run(
+                    "normalize_image", image_ops.normalize_image, image_data,
+                    image_cfg.max_bytes, image_cfg.max_side, image_cfg.output_format, image_cfg.quality,
+                    size=len(image_data),
+                )
+            except image_ops.InvalidImageError as e:
+                IMAGE_POSTPROCESS_TOTAL.inc(result="invalid")
+                pp_span.set(result="invalid")
+                return None, f"图片校验失败: {e}"
+
+            outcome = "transcoded" if info.transcoded else "ok"
+            pp_span.set(result=outcome, fmt=info.format, bytes=info.bytes_out)
+        IMAGE_POSTPROCESS_TOTAL.inc(result=outcome)
+        IMAGE_BYTES.observe(info.bytes_out, stage="sent")
+        if info.transcoded:
+            logger.info(
+                f"图片已转码: {info.bytes_in // 1024}KB -> {info.bytes_out // 1024}KB "
+                f"({info.format} {info.width}x{info.height})"
+            )
+        elif info.note:
+            logger.debug(f"图片未转码: {info.note}")
+        return result, None
+
+    async def _scan(self, content: str, scanner) -> image_ops.ScanResult:
+        """在执行器上扫描响应文本（大响应的扫描不占用事件循环，最多看前 max_scan_bytes 个字符）"""
+        limit = self.config.image.max_scan_bytes
+        if 0 < limit < len(content):
+            EXTRACTOR_SCAN_TRUNCATED_TOTAL.inc()
+            logger.warning(f"响应内容 {len(content)} 字符，超过扫描上限 {limit}，只扫描开头部分")
+        return await get_offloader().run(
+            "scan_content", scanner, content, limit, size=min(len(content), limit or len(content)),
+        )
 
     async def _extract_image(self, response: Dict) -> Optional[str]:
         """从API响应中提取图片base64 (Gemini 3.x 格式)"""
         try:
-            content = response.get("choices", [{}])[0].get("message", {}).get("content", "")
+            content = image_ops.response_content(response)
 
             if not content:
                 logger.warning("响应内容为空")
                 return None
 
-            # 方法1: 匹配 markdown 图片格式 ![](url)
-            url_match = re.search(r'!\[.*?\]\((https?://[^\)]+)\)', content)
-            if url_match:
-                image_url = url_match.group(1)
-                logger.debug(f"从markdown提取到图片URL: {image_url[:50]}...")
-                return await self._download_image_as_base64(image_url)
-
-            # 方法2: 匹配 data:image base64 格式
-            if "data:image" in content:
-                b64_match = re.search(r'base64,([A-Za-z0-9+/=]+)', content)
-                if b64_match:
-                    logger.debug("从data:image格式提取到base64")
-                    return b64_match.group(1)
-
-            # 方法3: 纯base64字符串
-            content_stripped = content.strip()
-            if len(content_stripped) > 100 and re.match(r'^[A-Za-z0-9+/=]+$', content_stripped):
-                logger.debug("检测到纯base64格式")
-                return content_stripped
+            strategy, value = await self._scan(content, image_ops.scan_content)
+
+            # 方法1: markdown 图片格式 ![](url)
+            if strategy == image_ops.STRATEGY_MARKDOWN_URL:
+                logger.debug(f"从markdown提取到图片URL: {value[:50]}...")
+                EXTRACTOR_TOTAL.inc(strategy=strategy)
+                return await self._download_image_as_base64(value)
+
+            # 方法2: data:image base64 格式 / 方法3: 纯base64字符串
+            if strategy in (image_ops.STRATEGY_DATA_URL, image_ops.STRATEGY_RAW_BASE64):
+                logger.debug(f"提取到base64 ({strategy})")
+                EXTRACTOR_TOTAL.inc(strategy=strategy)
+                return value
 
             logger.warning(f"无法识别的响应格式，内容前100字符: {content[:100]}")
+            EXTRACTOR_TOTAL.inc(strategy=image_ops.STRATEGY_NONE)
             return None
 
         except Exception as e:
@@ -314,59 +870,34 @@ class SelfieGenerator:
         4. 原始 base64（以 /9j/ 或 iVBOR 开头）
         """
         try:
-            content = response.get("choices", [{}])[0].get("message", {}).get("content", "")
+            content = image_ops.response_content(response)
 
             if not content:
                 logger.warning("响应内容为空")
                 return None
 
-            # 方法1: 匹配 markdown 图片格式 ![](url)
-            url_match = re.search(r'!\[.*?\]\((https?://[^\)]+)\)', content)
-            if url_match:
-                image_url = url_match.group(1)
-                logger.debug(f"[2.5兼容] 从markdown提取到图片URL")
-                return await self._download_image_as_base64(image_url)
-
-            # 方法2: 检查 data:image base64 格式
-            if "data:image" in content:
-                if "base64," in content:
-                    img_data = content.split("base64,")[1]
-                    # 清理可能的尾部内容
-                    img_data = re.match(r'^[A-Za-z0-9+/=]+', img_data)
-                    if img_data:
-                        logger.debug("[2.5兼容] 从data:image格式提取到base64")
-                        return img_data.group(0)
-
-            # 方法3: 检查原始 base64 (JPEG 以 /9j/ 开头，PNG 以 iVBOR 开头)
-            if content.startswith("/9j/") or content.startswith("iVBOR"):
-                logger.debug("[2.5兼容] 检测到原始base64格式")
-                return content.strip()
-
-            # 方法4: 检查纯 URL（不带 markdown 格式）
-            if "http" in content:
-                # 匹配图片 URL
-                url_match2 = re.search(r'(https?://[^\s\)\"\']+\.(?:png|jpg|jpeg|webp|gif))', content, re.IGNORECASE)
-                if url_match2:
-                    image_url = url_match2.group(1)
-                    logger.debug(f"[2.5兼容] 从纯文本提取到图片URL")
-                    return await self._download_image_as_base64(image_url)
-
-                # 匹配任意 URL（可能是 CDN 链接不带扩展名）
-                url_match3 = re.search(r'(https?://[^\s\)\"\']+)', content)
-                if url_match3:
-                    image_url = url_match3.group(1)
-                    logger.debug(f"[2.5兼容] 尝试下载通用URL")
-                    result = await self._download_image_as_base64(image_url)
-                    if result:
-                        return result
-
-            # 方法5: 纯base64字符串（长度检查）
-            content_stripped = content.strip()
-            if len(content_stripped) > 100 and re.match(r'^[A-Za-z0-9+/=]+$', content_stripped):
-                logger.debug("[2.5兼容] 检测到纯base64格式")
-                return content_stripped
+            strategy, value = await self._scan(content, image_ops.scan_content_gemini_25)
+
+            if strategy in (image_ops.STRATEGY_MARKDOWN_URL, image_ops.STRATEGY_BARE_URL):
+                logger.debug(f"[2.5兼容] 提取到图片URL ({strategy})")
+                EXTRACTOR_TOTAL.inc(strategy=strategy)
+                return await self._download_image_as_base64(value)
+
+            if strategy == image_ops.STRATEGY_ANY_URL:
+                # 可能是不带扩展名的 CDN 链接，下载成功才算
+                logger.debug(f"[2.5兼容] 尝试下载通用URL")
+                result = await self._download_image_as_base64(value)
+                if result:
+                    EXTRACTOR_TOTAL.inc(strategy=image_ops.STRATEGY_BARE_URL)
+                    return result
+
+            elif strategy in (image_ops.STRATEGY_DATA_URL, image_ops.STRATEGY_RAW_BASE64):
+                logger.debug(f"[2.5兼容] 提取到base64 ({strategy})")
+                EXTRACTOR_TOTAL.inc(strategy=strategy)
+                return value
 
             logger.warning(f"[2.5兼容] 无法识别的响应格式，内容前200字符: {content[:200]}")
+            EXTRACTOR_TOTAL.inc(strategy=image_ops.STRATEGY_NONE)
             return None
 
         except Exception as e:
@@ -374,16 +905,23 @@ class SelfieGenerator:
             return None
 
     async def _download_image_as_base64(self, url: str) -> Optional[str]:
-        """下载图片并转换为base64"""
+        """流式下载图片（限制大小和类型，中断时续传）并转换为base64"""
+        endpoint = endpoint_label(url)
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                    if resp.status == 200:
-                        image_bytes = await resp.read()
-                        return base64.b64encode(image_bytes).decode('utf-8')
-                    else:
-                        logger.warning(f"下载图片失败: HTTP {resp.status}")
-                        return None
+            with DOWNLOAD_SECONDS.time(endpoint=endpoint), span("download") as download_span:
+                result = await download_image(get_http_session(), url, self.config.download, endpoint)
+                download_span.set(
+                    bytes=len(result.data), resumes=result.resumes, mbps=round(result.throughput / 2 ** 20, 2),
+                )
+        except DownloadError as e:
+            DOWNLOAD_FAILURES_TOTAL.inc(reason=e.reason)
+            logger.warning(f"下载图片失败: {e}")
+            return None
         except Exception as e:
+            DOWNLOAD_FAILURES_TOTAL.inc(reason="error")
             logger.error(f"下载图片异常: {e}")
             return None
+
+        return await get_offloader().run(
+            "encode_download", image_ops.encode_base64, result.data, size=len(result.data),
+        )
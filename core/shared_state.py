@@ -0,0 +1,270 @@
+"""跨进程共享状态 - 多个机器人进程共用同一个 SQLite 文件协调每日计数、冷却、限流令牌和用量"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from src.common.logger import get_logger
+from .metrics import REGISTRY
+
+logger = get_logger("selfie_plugin.shared_state")
+
+SHARED_STATE_SECONDS = REGISTRY.histogram(
+    "selfie_shared_state_seconds", "共享状态事务耗时（含等待其他进程释放写锁）", ("op",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5),
+)
+QUOTA_RESERVATIONS_TOTAL = REGISTRY.counter(
+    "selfie_quota_reservations_total",
+    "每日额度/冷却预占结果（reserved / daily_limit / cooldown / error / released / release_error）", ("result",),
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    scope    TEXT NOT NULL,
+    key      TEXT NOT NULL,
+    tokens   REAL NOT NULL,
+    updated  REAL NOT NULL,
+    PRIMARY KEY (scope, key)
+);
+CREATE TABLE IF NOT EXISTS quotas (
+    name     TEXT PRIMARY KEY,
+    day      TEXT NOT NULL,
+    count    INTEGER NOT NULL DEFAULT 0,
+    last_at  REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS usage (
+    day               TEXT NOT NULL,
+    endpoint          TEXT NOT NULL,
+    requests          INTEGER NOT NULL DEFAULT 0,
+    errors            INTEGER NOT NULL DEFAULT 0,
+    bytes_out         INTEGER NOT NULL DEFAULT 0,
+    bytes_in          INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens     INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens      INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, endpoint)
+);
+"""
+
+# usage 表的计数列（与 budget.UsageTotals 的字段一致）
+USAGE_COLUMNS = (
+    "requests", "errors", "bytes_out", "bytes_in", "prompt_tokens", "completion_tokens", "total_tokens",
+)
+
+# 按天用量：{日期: {接口: {计数列: 值}}}
+UsageDays = Dict[str, Dict[str, Dict[str, int]]]
+
+
+@dataclass(frozen=True)
+class QuotaReservation:
+    """一次预占（生成失败时凭它归还）"""
+    name: str
+    day: str
+    reserved_at: float
+    previous_last_at: float
+    count: int = 0  # 预占后的今日张数
+
+
+def judge_quota(count: int, last_at: float, max_daily: int, cooldown: float, now: float) -> Tuple[bool, Optional[str]]:
+    """按今日张数和最近一次时间判断能否再拍一张（进程内计数和共享状态共用）"""
+    if count >= max_daily:
+        return False, f"今日已达上限({max_daily}张)"
+    elapsed = now - last_at
+    if elapsed < cooldown:
+        return False, f"冷却中({int(cooldown - elapsed)}秒)"
+    return True, None
+
+
+class SharedState:
+    """
+    共享状态存储
+
+    - 每个写操作是一个 BEGIN IMMEDIATE 事务：先拿到数据库写锁再读-判断-写，
+      多个进程同时预占时由 SQLite 的文件锁串行化，不会重复扣减
+    - WAL 模式，读不阻塞写；等待其他进程释放写锁最多 busy_timeout 秒，
+      写事务因此可能阻塞，异步调用方要放到执行器里执行
+    - 只读查询走单独的连接，不会排在等写锁的事务后面
+    - 同一进程内的线程共用一个写连接和一个读连接，各由一把锁串行化
+    - 写失败（等写锁超时、磁盘错误）时记录警告并返回拒绝原因，不向调用方抛 sqlite3.Error
+    """
+
+    def __init__(self, db_path: Path, busy_timeout: float = 5.0):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        # isolation_level=None：事务由 transaction() 显式控制
+        self._conn = sqlite3.connect(
+            str(self.db_path), timeout=busy_timeout, isolation_level=None, check_same_thread=False,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._read_conn = sqlite3.connect(
+            str(self.db_path), timeout=busy_timeout, isolation_level=None, check_same_thread=False,
+        )
+
+    @contextmanager
+    def transaction(self, op: str) -> Iterator[sqlite3.Connection]:
+        """写事务（进入时取得跨进程写锁，正常退出提交，异常回滚）"""
+        started = time.perf_counter()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            else:
+                self._conn.execute("COMMIT")
+            finally:
+                SHARED_STATE_SECONDS.observe(time.perf_counter() - started, op=op)
+
+    @contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        """只读连接（WAL 下不等待写锁）"""
+        with self._read_lock:
+            yield self._read_conn
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        with self._read_lock:
+            self._read_conn.close()
+
+    # =========================================================================
+    # 每日计数 + 冷却
+    # =========================================================================
+
+    @staticmethod
+    def _read_quota(conn: sqlite3.Connection, name: str, day: str) -> Tuple[int, float]:
+        row = conn.execute("SELECT day, count, last_at FROM quotas WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return 0, 0.0
+        row_day, count, last_at = row
+        return (count if row_day == day else 0), last_at
+
+    def quota(self, name: str) -> Tuple[int, float]:
+        """(今日已用张数, 最近一次预占时间)；读取失败时按没有记录处理（真正的判断在预占时）"""
+        try:
+            with self.read() as conn:
+                return self._read_quota(conn, name, time.strftime("%Y-%m-%d"))
+        except sqlite3.Error as e:
+            logger.warning(f"读取共享额度失败: {e}")
+            return 0, 0.0
+
+    def reserve_quota(
+        self, name: str, max_daily: int, cooldown: float,
+    ) -> Tuple[Optional[QuotaReservation], Optional[str]]:
+        """
+        原子地检查并预占一张：今日计数 +1，冷却从现在开始
+
+        可能等待其他进程的写锁，异步调用方要放到执行器里执行。
+        共享状态库不可写时拒绝（不能确认额度就不花钱生图）。
+
+        Returns:
+            (预占凭据, None) 或 (None, 拒绝原因)
+        """
+        now = time.time()
+        day = time.strftime("%Y-%m-%d")
+        try:
+            with self.transaction("reserve") as conn:
+                count, last_at = self._read_quota(conn, name, day)
+                allowed, reason = judge_quota(count, last_at, max_daily, cooldown, now)
+                if not allowed:
+                    QUOTA_RESERVATIONS_TOTAL.inc(result="daily_limit" if count >= max_daily else "cooldown")
+                    return None, reason
+                conn.execute(
+                    "INSERT OR REPLACE INTO quotas (name, day, count, last_at) VALUES (?, ?, ?, ?)",
+                    (name, day, count + 1, now),
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"预占共享额度失败: {e}")
+            QUOTA_RESERVATIONS_TOTAL.inc(result="error")
+            return None, "共享额度暂时不可用，请稍后再试"
+        QUOTA_RESERVATIONS_TOTAL.inc(result="reserved")
+        return QuotaReservation(name, day, now, last_at, count + 1), None
+
+    def record_quota(self, name: str) -> Optional[Tuple[int, float]]:
+        """
+        不检查地计入一张（调试命令等不受限的生成成功后调用）
+
+        可能等待其他进程的写锁，异步调用方要放到执行器里执行。
+
+        Returns:
+            (今日已用张数, 最近一次时间)，写入失败时为 None（只记录警告）
+        """
+        now = time.time()
+        day = time.strftime("%Y-%m-%d")
+        try:
+            with self.transaction("record") as conn:
+                count, _ = self._read_quota(conn, name, day)
+                conn.execute(
+                    "INSERT OR REPLACE INTO quotas (name, day, count, last_at) VALUES (?, ?, ?, ?)",
+                    (name, day, count + 1, now),
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"记录共享额度失败: {e}")
+            return None
+        return count + 1, now
+
+    def release_quota(self, reservation: QuotaReservation):
+        """
+        生成失败时归还预占（冷却只在没有被其他进程刷新过时回退）
+
+        可能等待其他进程的写锁，异步调用方要放到执行器里执行；归还失败只记录警告（这一张照常计入今日额度）。
+        """
+        try:
+            with self.transaction("release") as conn:
+                conn.execute(
+                    "UPDATE quotas SET count = MAX(0, count - 1) WHERE name = ? AND day = ?",
+                    (reservation.name, reservation.day),
+                )
+                conn.execute(
+                    "UPDATE quotas SET last_at = ? WHERE name = ? AND last_at = ?",
+                    (reservation.previous_last_at, reservation.name, reservation.reserved_at),
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"归还共享额度失败，这一张仍计入今日额度: {e}")
+            QUOTA_RESERVATIONS_TOTAL.inc(result="release_error")
+            return
+        QUOTA_RESERVATIONS_TOTAL.inc(result="released")
+
+    # =========================================================================
+    # 用量
+    # =========================================================================
+
+    def sync_usage(self, pending: UsageDays, keep_since: str) -> UsageDays:
+        """
+        把本进程未同步的用量累加进共享库，删掉 keep_since 之前的明细，返回所有进程的合计
+
+        可能等待其他进程的写锁，调用方要在事件循环之外执行；失败时抛出 sqlite3.Error（调用方保留未同步的用量下次再试）。
+        """
+        columns = ", ".join(USAGE_COLUMNS)
+        placeholders = ", ".join("?" * len(USAGE_COLUMNS))
+        updates = ", ".join(f"{c} = {c} + excluded.{c}" for c in USAGE_COLUMNS)
+        rows: List[Tuple] = [
+            (day, endpoint, *(values.get(c, 0) for c in USAGE_COLUMNS))
+            for day, per_endpoint in pending.items()
+            for endpoint, values in per_endpoint.items()
+        ]
+        with self.transaction("usage") as conn:
+            if rows:
+                conn.executemany(
+                    f"INSERT INTO usage (day, endpoint, {columns}) VALUES (?, ?, {placeholders}) "
+                    f"ON CONFLICT (day, endpoint) DO UPDATE SET {updates}",
+                    rows,
+                )
+            conn.execute("DELETE FROM usage WHERE day < ?", (keep_since,))
+            result: UsageDays = {}
+            for day, endpoint, *values in conn.execute(f"SELECT day, endpoint, {columns} FROM usage"):
+                result.setdefault(day, {})[endpoint] = dict(zip(USAGE_COLUMNS, values))
+        return result
@@ -4,11 +4,12 @@
 // "We shape the void."
 """
 
+import math
 import time
 from typing import Optional, List
 from src.plugin_system.apis import chat_api
 from src.common.logger import get_logger
-from .utils import is_stream_in_list, debug_log
+from .config_snapshot import SelfieConfig
 
 logger = get_logger("selfie_plugin.target")
 
@@ -16,22 +17,18 @@ logger = get_logger("selfie_plugin.target")
 class TargetSelector:
     """选择发送目标群"""
 
-    def __init__(self, config: dict):
-        target_cfg = config.get("target", {})
-        self._mode = target_cfg.get("selection_mode", "most_active")
-        self._window_minutes = target_cfg.get("activity_window_minutes", 30)
-        self._configured_groups = target_cfg.get("configured_groups", [])
+    def __init__(self, config: SelfieConfig):
+        target_cfg = config.target
+        self._mode = target_cfg.selection_mode
+        self._window_minutes = target_cfg.activity_window_minutes
+        self._configured_groups = target_cfg.configured_streams
 
-        # 权限配置
-        permission_cfg = config.get("permission", {})
-        self._allow_all = permission_cfg.get("allow_all", False)
-        self._allowed_groups = permission_cfg.get("allowed_groups", [])
+        # 权限配置（白名单已在快照中标准化）
+        self._permission = config.permission
 
     def _is_group_allowed(self, stream_id: str) -> bool:
         """检查群是否在白名单中"""
-        if self._allow_all:
-            return True
-        return is_stream_in_list(stream_id, self._allowed_groups)
+        return self._permission.is_allowed(stream_id)
 
     def get_target_stream_id(self) -> Optional[str]:
         """
@@ -117,6 +114,27 @@ class TargetSelector:
             logger.error(f"获取配置目标群失败: {e}")
             return None
 
+    def activity_level(self, stream_id: str) -> float:
+        """
+        群活跃度（0~1），按最后活跃时间指数衰减
+
+        刚有人说话时为 1，过了一个活跃窗口（activity_window_minutes）约为 0.37；
+        取不到活跃时间时返回 0.5，不因信息缺失而偏向任何一边。
+        """
+        try:
+            for stream in chat_api.get_group_streams() or ():
+                if getattr(stream, 'stream_id', None) != stream_id:
+                    continue
+                last_active = getattr(stream, 'last_active_time', None)
+                if not last_active:
+                    break
+                window_seconds = max(self._window_minutes, 1) * 60
+                age = max(0.0, time.time() - last_active)
+                return math.exp(-age / window_seconds)
+        except Exception as e:
+            logger.debug(f"获取群活跃度失败: {e}")
+        return 0.5
+
     def get_all_available_targets(self) -> List[str]:
         """获取所有可用的目标群列表（只返回白名单中的）"""
         try:
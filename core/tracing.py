@@ -0,0 +1,181 @@
+"""请求追踪 - 轻量级 span 计时"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import json
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+from src.common.logger import get_logger
+
+logger = get_logger("selfie_plugin.trace")
+
+
+class Span:
+    """一个计时区间（单调时钟），可嵌套"""
+
+    __slots__ = ("name", "start", "end", "attrs", "children")
+
+    def __init__(self, name: str, attrs: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.start = time.monotonic()
+        self.end: Optional[float] = None
+        self.attrs: Dict[str, Any] = dict(attrs or {})
+        self.children: List["Span"] = []
+
+    def set(self, **attrs: Any):
+        """附加属性（如 bytes、status、strategy）"""
+        self.attrs.update(attrs)
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end if self.end is not None else time.monotonic()
+        return (end - self.start) * 1000
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        """紧凑表示：相对请求开始的偏移与耗时（毫秒）"""
+        data: Dict[str, Any] = {
+            "n": self.name,
+            "at": round((self.start - origin) * 1000, 1),
+            "ms": round(self.duration_ms, 1),
+        }
+        if self.attrs:
+            data.update(self.attrs)
+        if self.children:
+            data["c"] = [child.to_dict(origin) for child in self.children]
+        return data
+
+
+class _NoopSpan:
+    """没有活动 trace 时使用的空 span"""
+
+    __slots__ = ()
+
+    def set(self, **attrs: Any):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """一次自拍请求的追踪记录"""
+
+    def __init__(self, source: str, **attrs: Any):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.source = source
+        self.wall_start = time.time()
+        self.root = Span("request", attrs)
+
+    def set(self, **attrs: Any):
+        self.root.set(**attrs)
+
+    def finish(self):
+        if self.root.end is None:
+            self.root.end = time.monotonic()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "source": self.source,
+            "ts": round(self.wall_start, 3),
+            **self.root.to_dict(self.root.start),
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False, separators=(",", ":"), default=str)
+
+    def format_breakdown(self) -> str:
+        """多行耗时分解（用于调试群报告）"""
+        lines = [f"trace: {self.trace_id} ({self.source}) 总计 {self.root.duration_ms:.0f}ms"]
+
+        def walk(span: Span, depth: int):
+            for child in span.children:
+                extra = ""
+                if "bytes" in child.attrs:
+                    extra = f" {_format_bytes(child.attrs['bytes'])}"
+                if "error" in child.attrs:
+                    extra += f" ✗{child.attrs['error']}"
+                lines.append(f"{'  ' * depth}- {child.name}: {child.duration_ms:.0f}ms{extra}")
+                walk(child, depth + 1)
+
+        walk(self.root, 0)
+        return "\n".join(lines)
+
+
+def _format_bytes(size: Any) -> str:
+    try:
+        size = float(size)
+    except (TypeError, ValueError):
+        return str(size)
+    for unit in ("B", "KB", "MB"):
+        if size < 1024 or unit == "MB":
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}MB"
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("selfie_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("selfie_span", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    """当前上下文中的 trace（没有则为 None）"""
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace(source: str, **attrs: Any) -> Iterator[Trace]:
+    """
+    开始一次请求追踪，结束时输出一行 JSON 日志
+
+    Args:
+        source: 触发来源（tool/activity/command）
+        attrs: 附加到根 span 的属性
+    """
+    trace = Trace(source, **attrs)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(trace.root)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.set(error=type(e).__name__)
+        raise
+    finally:
+        trace.finish()
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        logger.info(trace.to_json())
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Any]:
+    """
+    在当前 trace 下记录一个子 span；没有活动 trace 时为空操作
+
+    用法:
+        with span("http_post", attempt=1) as s:
+            ...
+            s.set(bytes=len(body))
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield _NOOP_SPAN
+        return
+
+    child = Span(name, attrs)
+    parent.children.append(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.set(error=type(e).__name__)
+        raise
+    finally:
+        child.end = time.monotonic()
+        _current_span.reset(token)
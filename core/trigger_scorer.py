@@ -0,0 +1,187 @@
+"""触发评分 - 按活动新颖度、拍照间隔、群活跃度、时段和预算决定是否自动拍照"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import random
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Optional, Set
+
+from src.common.logger import get_logger
+from .config_snapshot import TriggerSection
+from .metrics import REGISTRY
+
+logger = get_logger("selfie_plugin.trigger")
+
+TRIGGER_SCORE = REGISTRY.histogram(
+    "selfie_trigger_score", "活动变化的触发评分", (),
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+TRIGGER_DECISIONS_TOTAL = REGISTRY.counter(
+    "selfie_trigger_decisions_total", "活动变化的触发决策", ("decision",),
+)
+
+# 默认时段权重（0~23 点）：深夜几乎不拍，饭点和晚上最高
+DEFAULT_HOUR_WEIGHTS = (
+    0.1, 0.05, 0.05, 0.05, 0.05, 0.1, 0.3, 0.6,
+    0.8, 0.7, 0.7, 0.9, 1.0, 0.8, 0.7, 0.7,
+    0.8, 0.9, 1.0, 1.0, 1.0, 0.9, 0.6, 0.3,
+)
+
+# 评分分量（日志顺序）
+COMPONENTS = (
+    ("novelty", "新颖"),
+    ("recency", "间隔"),
+    ("audience", "群活跃"),
+    ("time_of_day", "时段"),
+    ("budget", "预算"),
+)
+
+# "活动名（描述）" 中的描述部分
+_DESC_RE = re.compile(r"[（(].*$")
+
+
+def activity_name(activity: str) -> str:
+    """去掉描述，只保留活动名"""
+    return _DESC_RE.sub("", activity or "").strip()
+
+
+def _bigrams(text: str) -> Set[str]:
+    text = re.sub(r"\s+", "", text.lower())
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def activity_similarity(a: str, b: str) -> float:
+    """
+    两个活动的相似度（0~1）
+
+    活动名相同（只有描述变化）视为同一活动；否则取活动名字符二元组的 Jaccard 系数，
+    "去食堂吃午饭" 和 "去食堂吃晚饭" 这类字面相近的活动会得到较高的相似度。
+    """
+    if not a or not b:
+        return 0.0
+    name_a, name_b = activity_name(a), activity_name(b)
+    if name_a and name_a == name_b:
+        return 1.0
+    grams_a, grams_b = _bigrams(name_a or a), _bigrams(name_b or b)
+    if not grams_a or not grams_b:
+        return 0.0
+    return len(grams_a & grams_b) / len(grams_a | grams_b)
+
+
+@dataclass
+class TriggerDecision:
+    """一次触发决策"""
+    fire: bool
+    probability: float
+    score: float
+    components: Dict[str, float] = field(default_factory=dict)
+    reason: str = ""
+
+    def describe(self) -> str:
+        parts = [f"{label} {self.components[key]:.2f}" for key, label in COMPONENTS if key in self.components]
+        text = f"评分 {self.score:.2f} ({', '.join(parts)}) → 概率 {self.probability:.3f}"
+        return f"{text}，{self.reason}" if self.reason else text
+
+
+class TriggerScorer:
+    """
+    活动触发评分
+
+    每个分量取 0~1，按权重做加权乘积：score = Π component ^ weight（权重 0 的分量不参与），
+    触发概率 = min(1, activity_trigger_probability × score_gain × score)。
+    与上一个活动或今天已拍过的活动过于相似（新颖度低于 min_novelty）时直接跳过，不消耗预算。
+    """
+
+    def __init__(self, section: TriggerSection, rng: Optional[random.Random] = None):
+        self._rng = rng or random.Random()
+        self.configure(section)
+
+    def configure(self, section: TriggerSection):
+        self.section = section
+        weights = tuple(section.hour_weights)
+        if weights and len(weights) != 24:
+            logger.warning(f"hour_weights 需要 24 个值，实际 {len(weights)} 个，使用默认时段权重")
+            weights = ()
+        self._hour_weights = tuple(float(w) for w in weights) or DEFAULT_HOUR_WEIGHTS
+        self._weights = {
+            "novelty": section.weight_novelty,
+            "recency": section.weight_recency,
+            "audience": section.weight_audience,
+            "time_of_day": section.weight_time_of_day,
+            "budget": section.weight_budget,
+        }
+
+    def novelty(self, activity: str, previous: Optional[str], recent: Iterable[str] = ()) -> float:
+        """1 - 与上一个活动、近期已拍活动的最大相似度"""
+        similarity = activity_similarity(activity, previous) if previous else 0.0
+        for other in recent:
+            similarity = max(similarity, activity_similarity(activity, other))
+        return 1.0 - similarity
+
+    def evaluate(
+        self,
+        activity: str,
+        previous: Optional[str],
+        now: float,
+        hour: int,
+        recent_activities: Iterable[str] = (),
+        last_photo_at: Optional[float] = None,
+        audience: float = 1.0,
+        budget: float = 1.0,
+    ) -> TriggerDecision:
+        """
+        对一次活动变化打分并抽签
+
+        Args:
+            activity / previous: 新旧活动
+            now: 当前时间戳
+            hour: 当前小时（0~23）
+            recent_activities: 目标群近期已拍过的活动
+            last_photo_at: 最近一次拍照时间
+            audience: 目标群活跃度（0~1）
+            budget: 预算节奏系数（0~1）
+        """
+        section = self.section
+        base = section.activity_trigger_probability
+
+        if not section.smart_scoring:
+            probability = max(0.0, min(1.0, base * budget))
+            fire = self._rng.random() < probability
+            TRIGGER_DECISIONS_TOTAL.inc(decision="fired" if fire else "skipped")
+            return TriggerDecision(fire, probability, budget, {"budget": budget})
+
+        recency_window = max(section.recency_full_hours, 0.0) * 3600
+        if last_photo_at is None or recency_window <= 0:
+            recency = 1.0
+        else:
+            recency = min(1.0, max(0.0, now - last_photo_at) / recency_window)
+
+        components = {
+            "novelty": self.novelty(activity, previous, recent_activities),
+            "recency": recency,
+            "audience": max(0.0, min(1.0, audience)),
+            "time_of_day": max(0.0, min(1.0, self._hour_weights[hour % 24])),
+            "budget": max(0.0, min(1.0, budget)),
+        }
+
+        score = 1.0
+        for key, value in components.items():
+            weight = self._weights[key]
+            if weight > 0:
+                score *= value ** weight
+        TRIGGER_SCORE.observe(score)
+
+        if components["novelty"] < section.min_novelty:
+            TRIGGER_DECISIONS_TOTAL.inc(decision="duplicate")
+            return TriggerDecision(False, 0.0, score, components, "与近期活动重复")
+
+        probability = max(0.0, min(1.0, base * section.score_gain * score))
+        fire = self._rng.random() < probability
+        TRIGGER_DECISIONS_TOTAL.inc(decision="fired" if fire else "skipped")
+        return TriggerDecision(fire, probability, score, components, "触发" if fire else "未触发")
+
@@ -4,10 +4,16 @@
 // "We shape the void."
 """
 
+import asyncio
+import atexit
 import hashlib
+import json
+import threading
 from datetime import datetime
-from typing import List, Optional, Tuple
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 from src.common.logger import get_logger
+from .config_manager import atomic_write_bytes
 
 logger = get_logger("selfie_plugin.utils")
 
@@ -97,6 +103,33 @@ def is_stream_in_list(stream_id: str, config_list: List[str]) -> bool:
     return False
 
 
+def get_trigger_user_id(component: object) -> Optional[str]:
+    """
+    获取触发本次调用的用户 ID（平台_用户号），取不到返回 None
+
+    命令从 message.message_info.user_info 取；工具从 chat_stream.user_info 取
+    （对话流里最近一位发言者）。
+
+    Args:
+        component: 命令/工具实例
+    """
+    candidates = (
+        ("message", "message_info", "user_info"),
+        ("chat_stream", "user_info"),
+    )
+    for path in candidates:
+        obj = component
+        for attr in path:
+            obj = getattr(obj, attr, None)
+            if obj is None:
+                break
+        user_id = getattr(obj, "user_id", None) if obj is not None else None
+        if user_id:
+            platform = getattr(obj, "platform", None)
+            return f"{platform}_{user_id}" if platform else str(user_id)
+    return None
+
+
 def get_stream_id_info(stream_id: str) -> str:
     """
     获取 stream_id 的调试信息
@@ -207,3 +240,69 @@ def get_current_activity() -> Optional[str]:
     if name and desc:
         return f"{name}（{desc}）"
     return name
+
+
+class DebouncedJsonState:
+    """
+    按防抖间隔把内存状态写入 JSON 文件（原子替换，在默认线程池执行）
+
+    子类在 __init__ 中调用 _init_persistence()，修改状态后在持有 self._lock 时调用 _mark_dirty()，
+    并实现 _snapshot()：持锁时返回要保存的数据。写失败时保留脏标记，下次再试；退出时保存一次。
+    """
+
+    # 日志里的状态名称
+    state_name = "状态"
+
+    def _init_persistence(self, state_path: Path, save_interval: float):
+        self.state_path = Path(state_path)
+        self._save_interval = save_interval
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._save_handle: Optional[asyncio.TimerHandle] = None
+        atexit.register(self.save)
+
+    def _snapshot(self) -> Dict[str, Any]:
+        """要保存的数据（调用方已持有锁）"""
+        raise NotImplementedError
+
+    def _mark_dirty(self):
+        """标记需要保存，并在事件循环上安排一次防抖保存（调用方已持有锁）"""
+        self._dirty = True
+        if self._save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._save_handle = loop.call_later(self._save_interval, self._save_in_background, loop)
+
+    def _save_in_background(self, loop: asyncio.AbstractEventLoop):
+        self._save_handle = None
+        loop.run_in_executor(None, self.save)
+
+    def save(self):
+        """有未保存的修改时写入状态文件"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = self._snapshot()
+            self._dirty = False
+
+        try:
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_bytes(self.state_path, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+        except OSError as e:
+            logger.warning(f"{self.state_name}保存失败: {e}")
+            with self._lock:
+                self._dirty = True
+
+    def close(self):
+        """保存并注销退出钩子"""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        self.save()
+        try:
+            atexit.unregister(self.save)
+        except Exception:
+            pass
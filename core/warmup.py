@@ -0,0 +1,114 @@
+"""启动预热 - 插件加载后在后台完成配置合并、运行时构建、参考图编码和连接池创建"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+import time
+from typing import Dict, Optional, Set
+
+from src.common.logger import get_logger
+from .metrics import REGISTRY
+
+logger = get_logger("selfie_plugin.warmup")
+
+WARMUP_SECONDS = REGISTRY.histogram(
+    "selfie_warmup_seconds", "启动预热各阶段耗时", ("phase",),
+)
+
+_task: Optional[asyncio.Task] = None
+
+
+def schedule_warmup() -> Optional[asyncio.Task]:
+    """
+    在当前事件循环上安排一次预热
+
+    没有运行中的事件循环时为空操作（之后由 ON_START 事件或首次请求触发）；
+    已经安排过时返回同一个任务。
+    """
+    global _task
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+    if _task is None or _task.get_loop() is not loop:
+        _task = loop.create_task(warm_up())
+    return _task
+
+
+async def ensure_warm():
+    """等待预热完成（未安排时立即安排）；预热自身的错误不会传播"""
+    task = schedule_warmup()
+    if task is not None and not task.done():
+        await asyncio.shield(task)
+
+
+_background: Set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    """后台任务（保留引用直到结束，避免被回收）"""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+async def _start_worker():
+    from .worker import WorkerUnavailable, get_worker_client
+
+    client = get_worker_client()
+    if client is None:
+        return
+    try:
+        await client.ensure_started()
+    except WorkerUnavailable as e:
+        logger.warning(f"{e}，首次生图时重试")
+
+
+async def warm_up() -> Dict[str, float]:
+    """
+    预热，各阶段失败只记录日志，首次使用时会按需重试
+
+    1. config: 合并默认配置并解析快照（TOML 读写，放到线程池）
+    2. runtime: 构建运行时（扫描参考图目录、打开历史库、读取限流/用量状态）
+    3. reference_images: 所有人设的参考图预先编码为 base64
+    4. http_session: 创建共享连接池
+    5. worker: 开启生图子进程时在后台启动它（不阻塞预热）
+    6. recover_jobs: 在后台补发上次运行未完成的任务（不阻塞预热）
+
+    Returns:
+        各阶段耗时（秒）
+    """
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    timings: Dict[str, float] = {}
+
+    async def phase(name: str, func, in_executor: bool = False):
+        phase_started = time.perf_counter()
+        try:
+            result = await loop.run_in_executor(None, func) if in_executor else func()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            logger.warning(f"预热阶段 {name} 失败: {e}")
+        finally:
+            timings[name] = time.perf_counter() - phase_started
+            WARMUP_SECONDS.observe(timings[name], phase=name)
+
+    from .config_snapshot import get_config_store
+    from .runtime import get_runtime
+    from .http_client import get_http_session
+
+    await phase("config", lambda: get_config_store().snapshot, in_executor=True)
+    await phase("runtime", get_runtime, in_executor=True)
+    await phase("reference_images", lambda: get_runtime().preload_reference_images())
+    await phase("http_session", get_http_session)
+    await phase("worker", lambda: _spawn(_start_worker()))
+    await phase("recover_jobs", lambda: _spawn(get_runtime().recover_jobs()))
+
+    timings["total"] = time.perf_counter() - started
+    WARMUP_SECONDS.observe(timings["total"], phase="total")
+    logger.info(f"自拍插件预热完成 ({timings['total'] * 1000:.0f}ms)")
+    return timings
@@ -0,0 +1,506 @@
+"""生图子进程 - 在独立进程中完成 HTTP 请求、JSON/base64 处理和图片校验，机器人进程经本地套接字收发请求、经共享内存取回图片"""
+"""
+// KIRISAME SYSTEMS™ | uaih3k9x
+// "We shape the void."
+"""
+
+import asyncio
+import itertools
+import os
+import pickle
+import socket
+import struct
+import sys
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.common.logger import get_logger
+from .config_snapshot import PLUGIN_DIR, SelfieConfig, WorkerSection
+from .deadline import PhaseTimeout, current_deadline, deadline_scope
+from .metrics import REGISTRY
+
+logger = get_logger("selfie_plugin.worker")
+
+WORKER_REQUESTS_TOTAL = REGISTRY.counter(
+    "selfie_worker_requests_total", "交给生图子进程的请求（ok / failed / timeout / unavailable）", ("result",),
+)
+WORKER_STARTS_TOTAL = REGISTRY.counter(
+    "selfie_worker_starts_total", "生图子进程启动次数（ok / failed）", ("result",),
+)
+WORKER_HANDOFF_SECONDS = REGISTRY.histogram(
+    "selfie_worker_handoff_seconds", "从共享内存取回一张图片的耗时",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05),
+)
+
+# 帧格式：4 字节长度（大端）+ pickle。两端是同一份代码、经 socketpair 直连，不接受外部连接
+_HEADER = struct.Struct("!I")
+
+# 子进程按截止时间自行放弃请求，机器人进程多等这么久以便收到它的结果
+_REPLY_GRACE = 5.0
+
+# 共享内存段名前缀（子进程 pid + 请求号），子进程崩溃后按前缀清理
+_SEGMENT_PREFIX = "selfie_"
+
+# 子进程入口（python -c）：不加载宿主（MaiBot）模块，日志改用标准 logging 输出到继承的 stderr；
+# 插件目录名不必是合法模块名，按机器人进程里的包名手动挂上
+_BOOTSTRAP = """
+import asyncio, importlib, logging, socket, sys, types
+plugin_dir, package, fd = sys.argv[1], sys.argv[2], int(sys.argv[3])
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [selfie-worker] %(name)s %(levelname)s %(message)s")
+for name in ("src", "src.common"):
+    sys.modules[name] = types.ModuleType(name)
+    sys.modules[name].__path__ = []
+sys.modules["src.common.logger"] = types.ModuleType("src.common.logger")
+sys.modules["src.common.logger"].get_logger = logging.getLogger
+parts = package.split(".")
+for i in range(1, len(parts) + 1):
+    module = sys.modules[".".join(parts[:i])] = types.ModuleType(".".join(parts[:i]))
+    module.__path__ = [plugin_dir] if i == len(parts) else []
+worker = importlib.import_module(package + ".core.worker")
+asyncio.run(worker.serve(socket.socket(fileno=fd)))
+"""
+
+
+class WorkerUnavailable(Exception):
+    """生图子进程没有启动或中途退出（调用方改为在本进程内生图）"""
+
+
+@dataclass
+class WorkerResult:
+    """子进程的生图结果（usage 为子进程内每次接口请求的记账参数，由机器人进程计入预算）"""
+    image: Optional[str]
+    error: Optional[str]
+    usage: List[Tuple[Any, ...]] = field(default_factory=list)
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Dict[str, Any]:
+    (length,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    return pickle.loads(await reader.readexactly(length))
+
+
+def _write_frame(writer: asyncio.StreamWriter, message: Dict[str, Any]):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    writer.write(_HEADER.pack(len(data)) + data)
+
+
+# =============================================================================
+# 共享内存交接
+# =============================================================================
+
+def _segment_name(pid: int, request_id: int) -> str:
+    return f"{_SEGMENT_PREFIX}{pid}_{request_id}"
+
+
+def export_image(image_base64: str, name: str) -> int:
+    """
+    子进程：把 base64 图片写入一段新的共享内存，由机器人进程读取后释放
+
+    Returns:
+        写入的字节数
+    """
+    data = image_base64.encode("ascii")
+    if sys.version_info >= (3, 13):
+        segment = shared_memory.SharedMemory(name=name, create=True, size=max(len(data), 1), track=False)
+    else:
+        segment = shared_memory.SharedMemory(name=name, create=True, size=max(len(data), 1))
+        # 3.13 之前创建时就登记到 resource_tracker，子进程退出时会把还没被取走的段删掉
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(segment._name, "shared_memory")
+    try:
+        segment.buf[:len(data)] = data
+    finally:
+        segment.close()
+    return len(data)
+
+
+def take_image(name: str, size: int) -> str:
+    """机器人进程：读取子进程交回的图片（一次拷贝）并释放共享内存"""
+    segment = shared_memory.SharedMemory(name=name)
+    try:
+        with segment.buf[:size] as view:
+            return str(view, "ascii")
+    finally:
+        segment.close()
+        segment.unlink()
+
+
+def _discard_image(reply: Dict[str, Any]):
+    """请求已被放弃时释放它的图片"""
+    name = reply.get("segment")
+    if not name:
+        return
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except OSError:
+        return
+    segment.close()
+    segment.unlink()
+
+
+def _remove_segments(pid: int):
+    """子进程崩溃时删除它留下的共享内存段（只有 Linux 能列出 /dev/shm）"""
+    shm_dir = Path("/dev/shm")
+    if not shm_dir.is_dir():
+        return
+    for path in shm_dir.glob(f"{_SEGMENT_PREFIX}{pid}_*"):
+        path.unlink(missing_ok=True)
+
+
+# =============================================================================
+# 机器人进程：客户端
+# =============================================================================
+
+class WorkerClient:
+    """
+    生图子进程客户端
+
+    - 首次请求时启动子进程（python -c 引导，socketpair 一端经 pass_fds 交给子进程）
+    - 请求只带人设名、提示词和剩余时间，配置快照变化后才随请求发一次
+    - 子进程把图片写进共享内存，回复里只有段名和长度；机器人进程拷贝出来后立即释放
+    - 子进程退出或启动失败后 restart_interval 秒内不再尝试，期间调用方在本进程内生图
+    - 额度、排队、每日计数、历史和用量预算都留在机器人进程，子进程只负责生成
+    """
+
+    def __init__(self, section: WorkerSection):
+        self.section = section
+        self.pid: Optional[int] = None
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._start_lock: Optional[asyncio.Lock] = None
+        self._pending: Dict[int, "asyncio.Future[Dict[str, Any]]"] = {}
+        self._configs: Dict[str, SelfieConfig] = {}  # 已发给当前子进程的各人设配置
+        self._ids = itertools.count(1)
+        self._failed_at: Optional[float] = None
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None
+
+    @property
+    def available(self) -> bool:
+        """子进程在运行，或者已经过了重启间隔可以再试"""
+        if self._process is not None:
+            return True
+        return self._failed_at is None or time.monotonic() - self._failed_at >= self.section.restart_interval
+
+    async def ensure_started(self):
+        """启动子进程（已在运行时为空操作，启动失败抛出 WorkerUnavailable）"""
+        loop = asyncio.get_running_loop()
+        if self._process is not None and self._loop is not loop:
+            # 子进程的管道绑定在创建它的事件循环上（基准测试会多次 asyncio.run）
+            self._stop()
+        if self._process is not None:
+            return
+        if not self.available:
+            raise WorkerUnavailable("生图子进程最近启动失败")
+        if self._start_lock is None or self._loop is not loop:
+            self._start_lock = asyncio.Lock()
+            self._loop = loop
+        async with self._start_lock:
+            if self._process is not None:
+                return
+            try:
+                await self._start()
+            except Exception as e:
+                self._failed_at = time.monotonic()
+                WORKER_STARTS_TOTAL.inc(result="failed")
+                raise WorkerUnavailable(f"生图子进程启动失败: {e}") from e
+
+    async def _start(self):
+        if os.name != "posix":
+            raise OSError("子进程模式只支持 Linux/macOS")
+        parent_sock, child_sock = socket.socketpair()
+        package = __package__.rpartition(".")[0]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+        try:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, "-c", _BOOTSTRAP, str(PLUGIN_DIR), package, str(child_sock.fileno()),
+                stdin=asyncio.subprocess.DEVNULL, pass_fds=(child_sock.fileno(),), env=env,
+            )
+        except BaseException:
+            parent_sock.close()
+            raise
+        finally:
+            child_sock.close()
+
+        try:
+            reader, writer = await asyncio.open_connection(sock=parent_sock)
+            hello = await asyncio.wait_for(_read_frame(reader), self.section.start_timeout)
+        except BaseException:
+            parent_sock.close()
+            if process.returncode is None:
+                process.kill()
+            raise
+
+        self._process, self._writer, self.pid = process, writer, hello["pid"]
+        self._configs.clear()
+        self._failed_at = None
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_loop(reader, process))
+        WORKER_STARTS_TOTAL.inc(result="ok")
+        logger.info(f"生图子进程已启动 (pid={self.pid})")
+
+    async def _read_loop(self, reader: asyncio.StreamReader, process: asyncio.subprocess.Process):
+        """接收子进程的结果，交给等待中的请求；连接断开说明子进程已退出"""
+        try:
+            while True:
+                reply = await _read_frame(reader)
+                future = self._pending.pop(reply.get("id"), None)
+                if future is None or future.done():
+                    _discard_image(reply)
+                else:
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError, pickle.UnpicklingError):
+            pass
+        except asyncio.CancelledError:
+            # 事件循环关闭：断开连接，子进程读到连接关闭后自行退出
+            if self._process is process:
+                self._stop()
+            raise
+        finally:
+            if self._process is process:
+                self._failed_at = time.monotonic()
+                self._stop()
+                try:
+                    await asyncio.wait_for(process.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+                logger.warning(f"生图子进程已退出 (pid={process.pid}, code={process.returncode})")
+            _remove_segments(process.pid)
+
+    def _stop(self):
+        """断开当前子进程（子进程读到连接关闭后自行退出），等待中的请求收到 WorkerUnavailable"""
+        writer, self._writer = self._writer, None
+        self._process = None
+        if writer is not None:
+            try:
+                _write_frame(writer, {"op": "shutdown"})
+                writer.close()
+            except Exception:
+                pass
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(WorkerUnavailable("生图子进程已退出"))
+
+    def close(self):
+        """关闭子进程（可以从其他线程调用）"""
+        loop = self._loop
+        if loop is None or loop.is_closed() or self._process is None:
+            self._process = None
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._stop()
+        else:
+            loop.call_soon_threadsafe(self._stop)
+
+    def _cancel(self, request_id: int):
+        """通知子进程放弃一个请求（尽力而为）"""
+        if self._writer is not None:
+            try:
+                _write_frame(self._writer, {"op": "cancel", "id": request_id})
+            except Exception:
+                pass
+
+    async def generate(
+        self, persona: str, config: SelfieConfig, prompt: str,
+        budget: Tuple[bool, Optional[str]] = (True, None),
+    ) -> WorkerResult:
+        """
+        在子进程中生成一张图（子进程不可用时抛出 WorkerUnavailable，超过截止时间抛出 PhaseTimeout）
+
+        budget 是机器人进程当前的预算判断，子进程据此决定是否补发对冲请求。
+        """
+        await self.ensure_started()
+        request_id = next(self._ids)
+        timeout = current_deadline().cap()
+        message: Dict[str, Any] = {
+            "op": "generate", "id": request_id, "persona": persona, "prompt": prompt, "timeout": timeout,
+            "budget": tuple(budget),
+        }
+        if self._configs.get(persona) is not config:
+            message["config"] = config
+
+        future: "asyncio.Future[Dict[str, Any]]" = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            try:
+                _write_frame(self._writer, message)
+                await self._writer.drain()
+            except (AttributeError, ConnectionError, OSError) as e:
+                WORKER_REQUESTS_TOTAL.inc(result="unavailable")
+                raise WorkerUnavailable(f"生图子进程连接已断开: {e}") from e
+            self._configs[persona] = config
+
+            try:
+                reply = await asyncio.wait_for(future, timeout + _REPLY_GRACE if timeout is not None else None)
+            except asyncio.TimeoutError:
+                self._cancel(request_id)
+                WORKER_REQUESTS_TOTAL.inc(result="timeout")
+                raise PhaseTimeout("worker", timeout) from None
+            except WorkerUnavailable:
+                WORKER_REQUESTS_TOTAL.inc(result="unavailable")
+                raise
+            except asyncio.CancelledError:
+                self._cancel(request_id)
+                raise
+        finally:
+            self._pending.pop(request_id, None)
+
+        image = None
+        if reply.get("segment"):
+            started = time.perf_counter()
+            image = take_image(reply["segment"], reply["size"])
+            WORKER_HANDOFF_SECONDS.observe(time.perf_counter() - started)
+        WORKER_REQUESTS_TOTAL.inc(result="ok" if image else "failed")
+        return WorkerResult(image, reply.get("error"), reply.get("usage", []))
+
+
+_client: Optional[WorkerClient] = None
+
+
+def get_worker_client() -> Optional[WorkerClient]:
+    """开启 [selfie.worker] 时的全局客户端（关闭时为 None）"""
+    return _client
+
+
+def configure_worker(section: WorkerSection):
+    """应用 [selfie.worker] 配置（关闭时停止子进程）"""
+    global _client
+    if not section.enabled:
+        if _client is not None:
+            _client.close()
+            _client = None
+        return
+    if _client is None:
+        _client = WorkerClient(section)
+    else:
+        _client.section = section
+
+
+# =============================================================================
+# 子进程：服务端
+# =============================================================================
+
+_usage: ContextVar[Optional[List[Tuple[Any, ...]]]] = ContextVar("selfie_worker_usage", default=None)
+_budget: ContextVar[Tuple[bool, Optional[str]]] = ContextVar("selfie_worker_budget", default=(True, None))
+
+
+class _UsageRecorder:
+    """
+    子进程内代替用量预算：记下每次接口请求的记账参数，随结果交回机器人进程
+
+    预算由机器人进程记账；check() 返回随请求带来的预算判断（预算用完时子进程不再补发对冲请求）。
+    """
+
+    def check(self) -> Tuple[bool, Optional[str]]:
+        return _budget.get()
+
+    def record(self, *args: Any):
+        records = _usage.get()
+        if records is not None:
+            records.append(args)
+
+
+def _apply_config(generators: Dict[str, Any], persona: str, config: SelfieConfig, recorder: _UsageRecorder):
+    """更新子进程内的生成器和进程级设置（卸载执行器、对冲、延迟窗口、录制/回放）"""
+    from .cassette import configure_cassette
+    from .hedging import configure_hedging
+    from .latency import configure_latency
+    from .offload import configure_offload
+    from .selfie_generator import SelfieGenerator
+
+    offload = config.offload
+    configure_offload(offload.executor, offload.max_workers, offload.min_bytes, offload.lag_monitor_interval)
+    configure_hedging(config.hedge)
+    configure_latency(config.timeouts.latency_window)
+    configure_cassette(config.cassette, (config.api.api_key, os.environ.get("SELFIE_API_KEY", "")))
+    generator = generators.get(persona)
+    if generator is None:
+        generators[persona] = SelfieGenerator(config, budget=recorder, persona=persona)
+    else:
+        generator.apply_config(config)
+
+
+async def _handle(generator: Any, message: Dict[str, Any], writer: asyncio.StreamWriter):
+    request_id = message["id"]
+    records: List[Tuple[Any, ...]] = []
+    _usage.set(records)
+    _budget.set(tuple(message.get("budget", (True, None))))
+    try:
+        with deadline_scope(message.get("timeout")):
+            image, error = await generator.generate_local(message["prompt"])
+    except asyncio.CancelledError:
+        # 机器人进程已放弃这个请求
+        return
+    except Exception as e:
+        logger.error(f"生图失败: {e}", exc_info=True)
+        image, error = None, f"生图子进程出错: {e}"
+
+    reply: Dict[str, Any] = {"id": request_id, "usage": records, "error": error}
+    if image:
+        name = _segment_name(os.getpid(), request_id)
+        try:
+            reply.update(segment=name, size=export_image(image, name))
+        except (OSError, UnicodeEncodeError) as e:
+            reply["error"] = f"图片写入共享内存失败: {e}"
+    try:
+        _write_frame(writer, reply)
+        await writer.drain()
+    except (ConnectionError, OSError):
+        _discard_image(reply)
+
+
+async def serve(sock: socket.socket):
+    """子进程主循环：每个生图请求一个任务，结果按完成顺序写回；连接断开或收到 shutdown 即退出"""
+    from .http_client import close_http_session
+
+    reader, writer = await asyncio.open_connection(sock=sock)
+    _write_frame(writer, {"op": "ready", "pid": os.getpid()})
+    await writer.drain()
+
+    generators: Dict[str, Any] = {}
+    tasks: Dict[int, asyncio.Task] = {}
+    recorder = _UsageRecorder()
+    try:
+        while True:
+            try:
+                message = await _read_frame(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            op = message.get("op")
+            if op == "shutdown":
+                break
+            if op == "cancel":
+                task = tasks.get(message["id"])
+                if task is not None:
+                    task.cancel()
+                continue
+            if op != "generate":
+                continue
+
+            persona, request_id = message["persona"], message["id"]
+            if message.get("config") is not None:
+                _apply_config(generators, persona, message["config"], recorder)
+            generator = generators.get(persona)
+            if generator is None:
+                _write_frame(writer, {"id": request_id, "error": "生图子进程缺少该人设的配置"})
+                continue
+            task = asyncio.get_running_loop().create_task(_handle(generator, message, writer))
+            tasks[request_id] = task
+            task.add_done_callback(lambda _, request_id=request_id: tasks.pop(request_id, None))
+    finally:
+        for task in list(tasks.values()):
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        await close_http_session()
+        writer.close()
@@ -5,13 +5,19 @@
 """
 
 import asyncio
-import random
 from typing import Optional, Tuple
 from src.plugin_system import BaseEventHandler, EventType
 from src.plugin_system.apis import send_api
 from src.common.logger import get_logger
 
-from ..core import SelfieGenerator, SelfiePromptBuilder, TargetSelector, get_current_activity
+# 运行时（及 aiohttp 等依赖）在预热/首次使用时才导入
+from ..core.config_snapshot import SelfieConfig
+from ..core.utils import get_current_activity
+from ..core.warmup import ensure_warm, schedule_warmup
+from ..core.metrics import SEND_SECONDS, record_outcome
+from ..core.tracing import span, start_trace
+from ..core.deadline import PhaseTimeout, deadline_scope, run_phase
+from ..core.scheduler import PRIORITY_BACKGROUND
 
 logger = get_logger("selfie_plugin.handler")
 
@@ -35,34 +41,68 @@ class SelfieActivityHandler(BaseEventHandler):
         self._task: Optional[asyncio.Task] = None
         self._is_running = False
         self._last_activity: Optional[str] = None
+        self._interval: int = 60
+        self._probability: float = 0.1
+        self._unsubscribe = None
 
     async def execute(self, message=None) -> Tuple[bool, bool, Optional[str], None, None]:
-        """启动时开始监控"""
+        """启动时安排预热，预热完成后在后台开始监控（不阻塞启动事件）"""
+        schedule_warmup()
+        if not self._is_running and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._start())
+        return True, True, None, None, None
+
+    async def _start(self):
+        """等待预热完成，按配置启动监控循环"""
+        from ..core.runtime import get_runtime
+
+        await ensure_warm()
+        runtime = get_runtime()
+        cfg = runtime.config
+
         # 检查插件是否启用
-        if not self.get_config("plugin.enabled", True):
-            return True, True, None, None, None
+        if not cfg.plugin.enabled:
+            return
 
-        if not self.get_config("selfie.trigger.enable_activity_trigger", True):
+        if not cfg.trigger.enable_activity_trigger:
             logger.debug("活动触发已禁用")
-            return True, True, None, None, None
+            return
 
         # 启动监控循环
-        if not self._is_running:
-            self._is_running = True
-            self._task = asyncio.create_task(self._monitor_loop())
-            logger.info("自拍活动监控已启动")
+        self._is_running = True
+        self._apply_trigger_config(cfg)
+        self._unsubscribe = runtime.store.subscribe(self._on_config_change, ("plugin", "trigger"))
+        logger.info("自拍活动监控已启动")
+        await self._monitor_loop()
 
-        return True, True, None, None, None
+    def _apply_trigger_config(self, cfg: SelfieConfig):
+        """从配置快照更新监控参数"""
+        self._interval = cfg.trigger.check_interval_seconds
+        self._probability = cfg.trigger.activity_trigger_probability
+        mode = "评分" if cfg.trigger.smart_scoring else "固定概率"
+        logger.info(f"活动监控配置: 间隔={self._interval}秒, 基础概率={self._probability}, 触发方式={mode}")
+
+    def _on_config_change(self, cfg: SelfieConfig, changed):
+        """配置热重载回调：禁用时停止，否则只刷新触发参数"""
+        if not cfg.plugin.enabled or not cfg.trigger.enable_activity_trigger:
+            logger.info("活动触发已在配置中禁用，停止监控")
+            self.stop()
+            return
+        self._apply_trigger_config(cfg)
 
     async def _monitor_loop(self):
         """监控循环 - 检测活动变化"""
-        interval = self.get_config("selfie.trigger.check_interval_seconds", 60)
-        probability = self.get_config("selfie.trigger.activity_trigger_probability", 0.1)
+        from ..core.runtime import get_runtime
 
-        logger.info(f"活动监控配置: 间隔={interval}秒, 触发概率={probability}")
+        runtime = get_runtime()
 
         while self._is_running:
             try:
+                # 顺带检查配置文件是否变化（变化会回调 _on_config_change）
+                runtime.store.refresh()
+                if not self._is_running:
+                    break
+
                 # 获取当前活动
                 activity = self._get_current_activity()
 
@@ -72,12 +112,7 @@ class SelfieActivityHandler(BaseEventHandler):
 
                     # 首次检测不触发（避免启动时触发）
                     if old is not None:
-                        # 按概率触发
-                        if random.random() < probability:
-                            logger.info(f"活动变化触发自拍: {old} -> {activity}")
-                            await self._take_selfie(activity)
-                        else:
-                            logger.debug(f"活动变化但未触发: {old} -> {activity}")
+                        await self._on_activity_change(old, activity)
 
             except asyncio.CancelledError:
                 logger.info("活动监控被取消")
@@ -85,7 +120,29 @@ class SelfieActivityHandler(BaseEventHandler):
             except Exception as e:
                 logger.error(f"活动监控出错: {e}")
 
-            await asyncio.sleep(interval)
+            await asyncio.sleep(self._interval)
+
+    async def _on_activity_change(self, old: str, activity: str):
+        """
+        活动变化时打分决定是否拍照
+
+        先确定目标群（评分要用该群的历史和活跃度），再按新颖度/间隔/群活跃度/时段/预算打分抽签。
+        """
+        from ..core.runtime import get_runtime
+
+        runtime = get_runtime()
+        stream_id = runtime.target_selector.get_target_stream_id()
+        if not stream_id:
+            logger.debug(f"活动变化但没有可用的目标群: {old} -> {activity}")
+            record_outcome("activity", "no_target")
+            return
+
+        decision = runtime.score_trigger(activity, old, stream_id)
+        if decision.fire:
+            logger.info(f"活动变化触发自拍: {old} -> {activity}, stream={stream_id}, {decision.describe()}")
+            await self._take_selfie(activity, stream_id)
+        else:
+            logger.info(f"活动变化未触发: {old} -> {activity}, stream={stream_id}, {decision.describe()}")
 
     def _get_current_activity(self) -> Optional[str]:
         """
@@ -96,51 +153,112 @@ class SelfieActivityHandler(BaseEventHandler):
         """
         return get_current_activity()
 
-    async def _take_selfie(self, activity: str):
-        """拍摄并发送照片"""
+    async def _take_selfie(self, activity: str, stream_id: Optional[str] = None):
+        """拍摄并发送照片（整个过程在一个 trace 内，受整体截止时间约束）"""
+        from ..core.runtime import get_runtime
+
+        with start_trace("activity", activity=activity), deadline_scope(get_runtime().config.timeouts.total):
+            await self._take_selfie_traced(activity, stream_id)
+
+    async def _take_selfie_traced(self, activity: str, stream_id: Optional[str] = None):
+        """拍摄并发送照片（stream_id 为空时现选目标群）"""
+        from ..core.runtime import get_runtime
+
+        runtime = get_runtime()
+        rate_acquired = False
+        job = None
+        group = None
         try:
-            selfie_config = self.get_config("selfie", {})
+            # 先确定目标群：没有目标或该群受限时不必生图
+            stream_id = stream_id or runtime.target_selector.get_target_stream_id()
+            if not stream_id:
+                logger.debug("没有可用的目标群，跳过拍照")
+                record_outcome("activity", "no_target")
+                return
 
-            generator = SelfieGenerator(selfie_config)
-            prompt_builder = SelfiePromptBuilder(selfie_config)
-            target_selector = TargetSelector(selfie_config)
+            # 该群人设的组件
+            persona = runtime.persona_for(stream_id)
+            generator = persona.generator
+            prompt_builder = persona.prompt_builder
 
             # 检查是否可以拍照
-            can_take, reason = generator.can_take_selfie()
+            can_take, reason = await generator.can_take_selfie()
             if not can_take:
                 logger.debug(f"跳过拍照: {reason}")
+                record_outcome("activity", "limited")
+                return
+
+            group, reason = runtime.reserve_group(stream_id, activity)
+            if group is None:
+                logger.debug(f"跳过拍照: {reason}")
+                record_outcome("activity", "limited")
+                return
+
+            # 令牌桶限流（没有触发用户，只看全局和群）
+            rate_acquired, reason = await runtime.acquire_rate(stream_id)
+            if not rate_acquired:
+                logger.debug(f"跳过拍照: {reason}")
+                record_outcome("activity", "limited")
                 return
 
             # 选择风格和视角
             style = generator.select_style()
             perspective = generator.select_perspective()
             prompt = prompt_builder.build_prompt(activity, style, perspective)
+            job = runtime.open_job("activity", stream_id, activity, prompt, style.value, perspective.value)
 
             # 生成图片
-            image_base64, error = await generator.generate_selfie(prompt)
+            image_base64, error = await generator.generate_selfie(prompt, PRIORITY_BACKGROUND)
             if error:
                 logger.error(f"生成照片失败: {error}")
+                await runtime.refund_rate(stream_id)
+                job.fail(error)
+                record_outcome("activity", "generate_failed")
                 return
 
-            # 获取目标群并发送
-            stream_id = target_selector.get_target_stream_id()
-            if stream_id:
-                success = await send_api.image_to_stream(image_base64, stream_id)
-                if success:
-                    style_name = "精美" if style.value == "professional" else "随手拍"
-                    perspective_name = "自拍" if perspective.value == "selfie" else "POV"
-                    logger.info(f"自动拍照已发送: stream={stream_id}, activity={activity}, {perspective_name}, {style_name}")
-                else:
-                    logger.error(f"发送照片失败: stream={stream_id}")
+            job.generated(image_base64)
+
+            # 发送
+            with SEND_SECONDS.time(source="activity"), span("send", bytes=len(image_base64)):
+                try:
+                    success = await run_phase(
+                        "send", send_api.image_to_stream(image_base64, stream_id), runtime.config.timeouts.send,
+                    )
+                except PhaseTimeout as e:
+                    logger.warning(f"发送照片超时: {e}")
+                    success = False
+            runtime.record_send(
+                "activity", "success" if success else "send_failed", stream_id, activity,
+                style=style.value, perspective=perspective.value, image_base64=image_base64,
+            )
+            job.finish(success)
+            if success:
+                record_outcome("activity", "success")
+                style_name = "精美" if style.value == "professional" else "随手拍"
+                perspective_name = "自拍" if perspective.value == "selfie" else "POV"
+                logger.info(f"自动拍照已发送: stream={stream_id}, activity={activity}, {perspective_name}, {style_name}")
             else:
-                logger.debug("没有可用的目标群，跳过发送")
+                logger.error(f"发送照片失败: stream={stream_id}")
+                await runtime.refund_rate(stream_id)
+                record_outcome("activity", "send_failed")
 
         except Exception as e:
             logger.error(f"自动自拍失败: {e}", exc_info=True)
+            if rate_acquired:
+                await runtime.refund_rate(stream_id)
+            if job:
+                job.fail(str(e))
+            record_outcome("activity", "error")
+        finally:
+            if group is not None:
+                group.release()
 
     def stop(self):
         """停止监控"""
         self._is_running = False
+        if self._unsubscribe:
+            self._unsubscribe()
+            self._unsubscribe = None
         if self._task and not self._task.done():
             self._task.cancel()
             logger.info("自拍活动监控已停止")
@@ -4,16 +4,16 @@
 // "We shape the void."
 """
 
-from pathlib import Path
 from typing import List, Tuple, Type
 
 from src.plugin_system import BasePlugin, register_plugin, ConfigField
 from src.common.logger import get_logger
 
+# 组件模块只导入轻量依赖；生成器、aiohttp、SQLite 等在预热或首次使用时才加载
 from .tools import TakeSelfiePhotoTool
 from .handlers import SelfieActivityHandler
 from .commands import SelfieCommand
-from .core.config_manager import ConfigManager
+from .core.warmup import schedule_warmup
 
 logger = get_logger("selfie_plugin")
 
@@ -42,6 +42,22 @@ class SelfiePlugin(BasePlugin):
         "selfie.trigger": "触发机制配置",
         "selfie.permission": "权限配置",
         "selfie.target": "目标群配置",
+        "selfie.debug": "调试报告配置",
+        "selfie.history": "自拍历史配置",
+        "selfie.rate_limit": "令牌桶限流配置",
+        "selfie.budget": "用量与预算配置",
+        "selfie.offload": "CPU 任务卸载配置",
+        "selfie.image": "图片校验与规范化配置",
+        "selfie.download": "图片下载配置",
+        "selfie.hedge": "请求对冲配置",
+        "selfie.timeouts": "截止时间与分阶段超时配置",
+        "selfie.scheduler": "生图调度配置（优先级、并发和队列上限）",
+        "selfie.journal": "任务日志配置（重启后补发未完成的任务）",
+        "selfie.shared_state": "跨进程共享状态配置（多个进程共用每日计数、冷却和限流令牌）",
+        "selfie.worker": "生图子进程配置（HTTP、base64、JSON 放到独立进程，机器人进程只收图片）",
+        "selfie.cassette": "请求录制/回放配置（录下真实响应，离线调试提取逻辑和跑基准）",
+        "selfie.refusal": "拒绝识别配置（模型拒绝、安全拦截或只回复文字时不再重试）",
+        "selfie.persona": "多人设配置（人设写在 [selfie.persona.profiles.<名字>] 下）",
     }
 
     config_schema: dict = {
@@ -94,6 +110,11 @@ class SelfiePlugin(BasePlugin):
                     default=2,
                     description="重试次数"
                 ),
+                "endpoints": ConfigField(
+                    type=list,
+                    default=[],
+                    description="备用接口地址，与 api_base 组成接口池，重试时依次切换"
+                ),
             },
             "character": {
                 "image_folder": ConfigField(
@@ -111,6 +132,16 @@ class SelfiePlugin(BasePlugin):
                     default=["jpg", "jpeg", "png", "webp"],
                     description="支持的图片格式"
                 ),
+                "nickname": ConfigField(
+                    type=str,
+                    default="",
+                    description="提示词中的角色名（留空使用全局 bot.nickname）"
+                ),
+                "personality": ConfigField(
+                    type=str,
+                    default="",
+                    description="提示词中的角色设定（留空使用全局 personality）"
+                ),
             },
             "style": {
                 "professional_ratio": ConfigField(
@@ -175,6 +206,56 @@ class SelfiePlugin(BasePlugin):
                     default=60,
                     description="活动检查间隔（秒）"
                 ),
+                "smart_scoring": ConfigField(
+                    type=bool,
+                    default=True,
+                    description="按新颖度/间隔/群活跃度/时段/预算评分触发，关闭则用固定概率"
+                ),
+                "min_novelty": ConfigField(
+                    type=float,
+                    default=0.3,
+                    description="新颖度下限，与近期活动太像时直接跳过（0.0-1.0）"
+                ),
+                "score_gain": ConfigField(
+                    type=float,
+                    default=2.0,
+                    description="评分满分时触发概率的放大倍数"
+                ),
+                "recency_full_hours": ConfigField(
+                    type=float,
+                    default=3.0,
+                    description="距上次拍照超过该小时数时间隔分量为满分"
+                ),
+                "weight_novelty": ConfigField(
+                    type=float,
+                    default=1.0,
+                    description="活动新颖度权重"
+                ),
+                "weight_recency": ConfigField(
+                    type=float,
+                    default=1.0,
+                    description="拍照间隔权重"
+                ),
+                "weight_audience": ConfigField(
+                    type=float,
+                    default=0.5,
+                    description="目标群活跃度权重"
+                ),
+                "weight_time_of_day": ConfigField(
+                    type=float,
+                    default=1.0,
+                    description="时段权重"
+                ),
+                "weight_budget": ConfigField(
+                    type=float,
+                    default=1.0,
+                    description="预算节奏权重"
+                ),
+                "hour_weights": ConfigField(
+                    type=list,
+                    default=[],
+                    description="0~23 点的时段权重（24 个值），留空使用内置曲线"
+                ),
             },
             "permission": {
                 "allow_all": ConfigField(
@@ -210,6 +291,493 @@ class SelfiePlugin(BasePlugin):
                     description="指定群列表，格式如 [\"qq:123456\", \"qq:789012\"]"
                 ),
             },
+            "debug": {
+                "flush_interval_seconds": ConfigField(
+                    type=float,
+                    default=0.0,
+                    description="调试消息合并发送间隔（秒），0 表示请求结束时每个调试群只发一条"
+                ),
+                "max_parallel_sends": ConfigField(
+                    type=int,
+                    default=4,
+                    description="调试群并发发送上限"
+                ),
+                "max_pending_chars": ConfigField(
+                    type=int,
+                    default=8000,
+                    description="单个调试群积压上限（字符），超出时丢弃最旧的消息"
+                ),
+            },
+            "history": {
+                "enabled": ConfigField(
+                    type=bool,
+                    default=True,
+                    description="是否记录自拍历史（SQLite）"
+                ),
+                "db_path": ConfigField(
+                    type=str,
+                    default="",
+                    description="历史数据库路径，留空使用插件目录下 data/selfie_history.db"
+                ),
+                "retention_days": ConfigField(
+                    type=int,
+                    default=90,
+                    description="历史保留天数，0 表示永久保留"
+                ),
+                "group_cooldown_seconds": ConfigField(
+                    type=int,
+                    default=0,
+                    description="同一个群两次发送之间的冷却时间（秒），0 表示不限制"
+                ),
+                "group_max_daily": ConfigField(
+                    type=int,
+                    default=0,
+                    description="每个群每天最多发送张数，0 表示不限制"
+                ),
+                "no_repeat_activity": ConfigField(
+                    type=bool,
+                    default=False,
+                    description="同一个群当天不重复拍同一个活动"
+                ),
+            },
+            "rate_limit": {
+                "enabled": ConfigField(
+                    type=bool,
+                    default=True,
+                    description="是否启用令牌桶限流"
+                ),
+                "state_path": ConfigField(
+                    type=str,
+                    default="",
+                    description="限流状态文件路径，留空使用插件目录下 data/rate_limits.json"
+                ),
+                "global_per_hour": ConfigField(
+                    type=float,
+                    default=0.0,
+                    description="全局每小时补充的令牌数，0 表示不限"
+                ),
+                "global_burst": ConfigField(
+                    type=int,
+                    default=0,
+                    description="全局最多累积的令牌数（突发上限）"
+                ),
+                "stream_per_hour": ConfigField(
+                    type=float,
+                    default=1.0,
+                    description="每个群每小时补充的令牌数，0 表示不限"
+                ),
+                "stream_burst": ConfigField(
+                    type=int,
+                    default=2,
+                    description="每个群最多累积的令牌数"
+                ),
+                "user_per_hour": ConfigField(
+                    type=float,
+                    default=2.0,
+                    description="每个触发用户每小时补充的令牌数，0 表示不限"
+                ),
+                "user_burst": ConfigField(
+                    type=int,
+                    default=2,
+                    description="每个触发用户最多累积的令牌数"
+                ),
+            },
+            "budget": {
+                "enabled": ConfigField(
+                    type=bool,
+                    default=True,
+                    description="是否记录接口用量（预算检查依赖它）"
+                ),
+                "state_path": ConfigField(
+                    type=str,
+                    default="",
+                    description="用量记录路径，留空使用插件目录下 data/usage.json"
+                ),
+                "daily_requests": ConfigField(
+                    type=int,
+                    default=0,
+                    description="每日生图请求预算（次），0 表示不限"
+                ),
+                "monthly_requests": ConfigField(
+                    type=int,
+                    default=0,
+                    description="每月生图请求预算（次），0 表示不限"
+                ),
+                "daily_cost": ConfigField(
+                    type=float,
+                    default=0.0,
+                    description="每日花费预算，0 表示不限"
+                ),
+                "monthly_cost": ConfigField(
+                    type=float,
+                    default=0.0,
+                    description="每月花费预算，0 表示不限"
+                ),
+                "cost_per_request": ConfigField(
+                    type=float,
+                    default=0.0,
+                    description="每次请求的单价"
+                ),
+                "cost_per_1k_prompt_tokens": ConfigField(
+                    type=float,
+                    default=0.0,
+                    description="每千输入 token 单价"
+                ),
+                "cost_per_1k_completion_tokens": ConfigField(
+                    type=float,
+                    default=0.0,
+                    description="每千输出 token 单价"
+                ),
+                "pacing_start_hour": ConfigField(
+                    type=int,
+                    default=8,
+                    description="日预算节奏计算的起始小时"
+                ),
+                "pacing_end_hour": ConfigField(
+                    type=int,
+                    default=24,
+                    description="日预算节奏计算的结束小时"
+                ),
+            },
+            "offload": {
+                "executor": ConfigField(
+                    type=str,
+                    default="thread",
+                    description="大块编解码/扫描的执行方式：inline（事件循环上直接执行）、thread、process"
+                ),
+                "max_workers": ConfigField(
+                    type=int,
+                    default=2,
+                    description="执行器线程/进程数"
+                ),
+                "min_bytes": ConfigField(
+                    type=int,
+                    default=65536,
+                    description="数据小于该大小（字节）时直接内联执行"
+                ),
+                "lag_monitor_interval": ConfigField(
+                    type=float,
+                    default=0.5,
+                    description="事件循环延迟采样间隔（秒），0 表示关闭"
+                ),
+            },
+            "image": {
+                "validate": ConfigField(
+                    type=bool,
+                    default=True,
+                    description="发送前校验图片（识别格式、检查截断），不是图片时重试生成"
+                ),
+                "max_bytes": ConfigField(
+                    type=int,
+                    default=2097152,
+                    description="图片超过该大小（字节）时转码压缩，0 表示不限"
+                ),
+                "max_side": ConfigField(
+                    type=int,
+                    default=2048,
+                    description="图片长边超过该像素时缩小，0 表示不限"
+                ),
+                "output_format": ConfigField(
+                    type=str,
+                    default="auto",
+                    description="输出格式：auto（超限时转为 jpeg）、jpeg、png、webp"
+                ),
+                "quality": ConfigField(
+                    type=int,
+                    default=85,
+                    description="jpeg/webp 编码质量"
+                ),
+                "max_scan_bytes": ConfigField(
+                    type=int,
+                    default=33554432,
+                    description="从响应文本里提取图片时最多扫描的字符数，超出部分不看，0 表示不限"
+                ),
+            },
+            "download": {
+                "max_bytes": ConfigField(
+                    type=int,
+                    default=20971520,
+                    description="单张图片下载上限（字节），超过立即中止，0 表示不限"
+                ),
+                "timeout": ConfigField(
+                    type=float,
+                    default=30.0,
+                    description="单张图片下载总超时（秒，含续传）"
+                ),
+                "chunk_size": ConfigField(
+                    type=int,
+                    default=65536,
+                    description="流式读取的块大小（字节）"
+                ),
+                "max_resumes": ConfigField(
+                    type=int,
+                    default=2,
+                    description="连接中断时带 Range 续传的最大次数"
+                ),
+                "allowed_content_types": ConfigField(
+                    type=list,
+                    default=["image/", "application/octet-stream", "binary/octet-stream"],
+                    description="允许的 Content-Type 前缀（响应没有 Content-Type 时放行）"
+                ),
+            },
+            "hedge": {
+                "enabled": ConfigField(
+                    type=bool,
+                    default=False,
+                    description="开启请求对冲：生图请求超过近期延迟分位数仍未返回时补发一份，先成功者胜出"
+                ),
+                "percentile": ConfigField(
+                    type=float,
+                    default=0.95,
+                    description="对冲延迟取近期成功请求延迟的分位数"
+                ),
+                "min_samples": ConfigField(
+                    type=int,
+                    default=20,
+                    description="样本少于此数时使用 initial_delay"
+                ),
+                "initial_delay": ConfigField(
+                    type=float,
+                    default=0.0,
+                    description="样本不足时的对冲延迟（秒），0 表示样本不足时不对冲"
+                ),
+                "min_delay": ConfigField(
+                    type=float,
+                    default=1.0,
+                    description="对冲延迟下限（秒）"
+                ),
+                "budget_ratio": ConfigField(
+                    type=float,
+                    default=0.1,
+                    description="补发请求占请求数的比例上限"
+                ),
+                "budget_burst": ConfigField(
+                    type=int,
+                    default=3,
+                    description="对冲额度的突发上限"
+                ),
+            },
+            "timeouts": {
+                "total": ConfigField(
+                    type=float,
+                    default=180.0,
+                    description="一次自拍请求（生图+下载+发送）的总截止时间（秒），0 表示不限"
+                ),
+                "connect": ConfigField(
+                    type=float,
+                    default=10.0,
+                    description="建立连接超时（秒）"
+                ),
+                "first_byte": ConfigField(
+                    type=float,
+                    default=0.0,
+                    description="等待响应头/读取间隔超时（秒），0 表示只受 api.timeout 约束"
+                ),
+                "body_read": ConfigField(
+                    type=float,
+                    default=60.0,
+                    description="读取响应体超时（秒）"
+                ),
+                "send": ConfigField(
+                    type=float,
+                    default=30.0,
+                    description="发送图片到群超时（秒）"
+                ),
+                "min_attempt": ConfigField(
+                    type=float,
+                    default=10.0,
+                    description="剩余时间少于此值时不再重试（秒）"
+                ),
+                "adaptive": ConfigField(
+                    type=bool,
+                    default=False,
+                    description="按近期延迟分布自动设置单次尝试超时（替代固定的 api.timeout）"
+                ),
+                "adaptive_quantile": ConfigField(
+                    type=float,
+                    default=0.99,
+                    description="自适应超时取近期延迟的分位数"
+                ),
+                "adaptive_multiplier": ConfigField(
+                    type=float,
+                    default=2.0,
+                    description="自适应超时 = 分位数 × 该倍数"
+                ),
+                "adaptive_min": ConfigField(
+                    type=float,
+                    default=15.0,
+                    description="自适应超时下限（秒）"
+                ),
+                "adaptive_max": ConfigField(
+                    type=float,
+                    default=0.0,
+                    description="自适应超时上限（秒），0 表示取 api.timeout"
+                ),
+                "adaptive_min_samples": ConfigField(
+                    type=int,
+                    default=20,
+                    description="样本少于此数时仍使用 api.timeout"
+                ),
+                "latency_window": ConfigField(
+                    type=float,
+                    default=1800.0,
+                    description="延迟统计的滚动窗口（秒），自适应超时和请求对冲共用"
+                ),
+            },
+            "scheduler": {
+                "max_concurrent": ConfigField(
+                    type=int,
+                    default=4,
+                    description="同时生图的请求数上限，0 表示不限"
+                ),
+                "interactive_concurrency": ConfigField(
+                    type=int,
+                    default=0,
+                    description="LLM 工具调用的并发上限，0 表示只受 max_concurrent 限制"
+                ),
+                "debug_concurrency": ConfigField(
+                    type=int,
+                    default=1,
+                    description="调试命令的并发上限，0 表示只受 max_concurrent 限制"
+                ),
+                "background_concurrency": ConfigField(
+                    type=int,
+                    default=1,
+                    description="活动触发的并发上限，0 表示只受 max_concurrent 限制"
+                ),
+                "debug_priority": ConfigField(
+                    type=int,
+                    default=1,
+                    description="调试命令的优先级（数值小的优先；工具调用为 0，活动触发为 2）"
+                ),
+                "max_queue": ConfigField(
+                    type=int,
+                    default=8,
+                    description="排队数上限：达到后丢弃活动触发，工具调用/调试命令挤出低优先级请求；0 表示不限"
+                ),
+                "background_max_wait": ConfigField(
+                    type=float,
+                    default=60.0,
+                    description="活动触发最多排队多久（秒），超过则跳过本次拍照"
+                ),
+            },
+            "journal": {
+                "enabled": ConfigField(
+                    type=bool,
+                    default=True,
+                    description="记录每次拍照任务的状态，重启后补发已生成未发送的图片"
+                ),
+                "path": ConfigField(
+                    type=str,
+                    default="",
+                    description="任务日志数据库路径（留空使用插件 data 目录）"
+                ),
+                "deliver_generated": ConfigField(
+                    type=bool,
+                    default=True,
+                    description="重启后补发已生成但没发出去的图片（不会再次生图）"
+                ),
+                "resume_enqueued": ConfigField(
+                    type=bool,
+                    default=False,
+                    description="重启后重新生成还没生成完的任务（会再次消耗生图额度），关闭时放弃"
+                ),
+                "max_age": ConfigField(
+                    type=float,
+                    default=1800.0,
+                    description="超过这个时长（秒）的未完成任务一律放弃，0 表示不限"
+                ),
+                "retention_days": ConfigField(
+                    type=int,
+                    default=7,
+                    description="任务日志保留天数，0 表示永久保留"
+                ),
+            },
+            "shared_state": {
+                "enabled": ConfigField(
+                    type=bool,
+                    default=False,
+                    description="多个机器人进程共用每日计数、冷却和限流令牌（预占是原子的，不会超发）"
+                ),
+                "path": ConfigField(
+                    type=str,
+                    default="",
+                    description="共享状态库路径，各进程必须指向同一个文件（留空使用插件 data 目录）"
+                ),
+                "busy_timeout": ConfigField(
+                    type=float,
+                    default=5.0,
+                    description="等待其他进程释放写锁的最长时间（秒）"
+                ),
+            },
+            "worker": {
+                "enabled": ConfigField(
+                    type=bool,
+                    default=False,
+                    description="在独立子进程中生图，图片经共享内存交回（仅 Linux/macOS）"
+                ),
+                "start_timeout": ConfigField(
+                    type=float,
+                    default=20.0,
+                    description="等待子进程启动就绪的最长时间（秒）"
+                ),
+                "restart_interval": ConfigField(
+                    type=float,
+                    default=30.0,
+                    description="子进程退出或启动失败后，至少间隔多久（秒）再重启；期间在本进程内生图"
+                ),
+            },
+            "cassette": {
+                "mode": ConfigField(
+                    type=str,
+                    default="off",
+                    description="off 关闭 / record 录制生图请求和图片下载 / replay 从磁带回放（不访问接口）"
+                ),
+                "path": ConfigField(
+                    type=str,
+                    default="",
+                    description="磁带文件路径（gzip 压缩的 JSON Lines，留空使用插件 data/cassette.jsonl.gz）"
+                ),
+                "speed": ConfigField(
+                    type=float,
+                    default=1.0,
+                    description="回放速度：1 按录制时的延迟，10 快十倍，0 立即返回"
+                ),
+                "cycle": ConfigField(
+                    type=bool,
+                    default=True,
+                    description="磁带放完后从头再来（关闭时返回 404）"
+                ),
+            },
+            "refusal": {
+                "enabled": ConfigField(
+                    type=bool,
+                    default=True,
+                    description="响应里没有图片时识别拒绝、安全拦截和纯文字回答，识别出来就不再重试"
+                ),
+                "retry_text_only": ConfigField(
+                    type=bool,
+                    default=False,
+                    description="模型只回复了文字（没有拒绝话术）时仍按 max_retries 重试"
+                ),
+                "cache_seconds": ConfigField(
+                    type=float,
+                    default=600.0,
+                    description="被拒的提示词在多少秒内不再请求，直接返回上次的原因（0 不缓存）"
+                ),
+                "cache_size": ConfigField(
+                    type=int,
+                    default=256,
+                    description="每个人设最多记住多少条被拒的提示词"
+                ),
+            },
+            "persona": {
+                "default": ConfigField(
+                    type=str,
+                    default="",
+                    description="未映射到人设的群使用的人设名（留空使用全局配置）"
+                ),
+            },
         },
     }
 
@@ -217,13 +785,9 @@ class SelfiePlugin(BasePlugin):
         """初始化插件"""
         super().__init__(*args, **kwargs)
 
-        # 确保用户配置存在并与默认配置合并
-        plugin_dir = Path(__file__).parent
-        try:
-            config_manager = ConfigManager(plugin_dir)
-            config_manager.ensure_user_config()
-        except Exception as e:
-            logger.warning(f"配置合并失败，使用默认配置: {e}")
+        # 配置合并（TOML 读写）、运行时构建、参考图编码和连接池创建都放到后台预热，
+        # 不占用宿主的启动路径；此时没有事件循环则由 ON_START 事件触发
+        schedule_warmup()
 
         logger.info("麦麦自拍插件初始化完成")
 
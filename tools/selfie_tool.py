@@ -4,30 +4,23 @@
 // "We shape the void."
 """
 
-from typing import Any, Dict, List
+from typing import Any, Dict
 from src.plugin_system import BaseTool, ToolParamType
 from src.plugin_system.apis import send_api
 from src.common.logger import get_logger
 
-from ..core import (
-    SelfieGenerator, SelfiePromptBuilder, TargetSelector, SelfieStyle, PhotoPerspective,
-    set_debug_mode, debug_log, is_stream_in_list, get_stream_id_info, is_debug_mode,
-)
-from ..core.utils import normalize_stream_id
+# 生成器/运行时（及 aiohttp 等依赖）在首次调用时才导入，见 execute()
+from ..core.utils import debug_log, get_stream_id_info, get_trigger_user_id
+from ..core.metrics import SEND_SECONDS, record_outcome
+from ..core.tracing import Trace, span, start_trace
+from ..core.deadline import PhaseTimeout, deadline_scope, run_phase
+from ..core.scheduler import PRIORITY_INTERACTIVE
+from ..core.debug_reporter import DebugReporter
+from ..core.warmup import ensure_warm
 
 logger = get_logger("selfie_plugin.tool")
 
 
-async def send_to_debug_groups(debug_groups: List[str], message: str):
-    """发送消息到所有 debug 群"""
-    for group_id in debug_groups:
-        try:
-            stream_id = normalize_stream_id(group_id)
-            await send_api.text_to_stream(message, stream_id)
-        except Exception as e:
-            logger.debug(f"发送到 debug 群 {group_id} 失败: {e}")
-
-
 class TakeSelfiePhotoTool(BaseTool):
     """
     拍照工具 - 供LLM调用
@@ -47,52 +40,78 @@ class TakeSelfiePhotoTool(BaseTool):
     available_for_llm = True
 
     async def execute(self, function_args: Dict[str, Any]) -> Dict[str, Any]:
+        """执行拍照（整个请求在一个 trace 内）"""
+        from ..core.runtime import get_runtime
+
+        await ensure_warm()
+        runtime = get_runtime()
+        cfg = runtime.config
+        reporter = runtime.debug_reporter(cfg)
+        try:
+            with start_trace("tool", stream_id=self.chat_id) as trace, deadline_scope(cfg.timeouts.total):
+                return await self._execute(function_args, trace, reporter)
+        finally:
+            # 本次请求的所有调试事件合并为每个调试群一条消息，后台发送
+            reporter.close()
+
+    async def _execute(self, function_args: Dict[str, Any], trace: Trace, reporter: DebugReporter) -> Dict[str, Any]:
         """执行拍照"""
+        from ..core.runtime import get_runtime
+        from ..core.selfie_generator import SelfieStyle, PhotoPerspective
+
+        runtime = get_runtime()
+        cfg = runtime.config
+
         # 检查插件是否启用
-        if not self.get_config("plugin.enabled", True):
+        if not cfg.plugin.enabled:
             return {"name": self.name, "content": "自拍插件已禁用"}
 
-        if not self.get_config("selfie.trigger.enable_llm_tool", True):
+        if not cfg.trigger.enable_llm_tool:
             return {"name": self.name, "content": "LLM工具调用已禁用"}
 
+        rate_key = None
+        job = None
+        group = None
         try:
-            # 初始化调试模式
-            debug_mode = self.get_config("plugin.debug_mode", False)
-            set_debug_mode(debug_mode)
-
-            # 获取selfie配置
-            selfie_config = self.get_config("selfie", {})
-
             # 权限检查：检查当前群是否在白名单中（强制检查，无论 chat_id 是否存在）
             # 注意：stream_id 从 self.chat_id 获取，不是 function_args
             stream_id = self.chat_id
-            permission_cfg = selfie_config.get("permission", {})
-            allow_all = permission_cfg.get("allow_all", False)
-            allowed_groups = permission_cfg.get("allowed_groups", [])
+            permission_cfg = cfg.permission
 
             debug_log(f"LLM工具调用 - stream_id={stream_id}, {get_stream_id_info(stream_id) if stream_id else 'None'}")
-            debug_log(f"权限配置: allow_all={allow_all}, allowed_groups={allowed_groups}")
+            debug_log(f"权限配置: allow_all={permission_cfg.allow_all}, allowed_groups={list(permission_cfg.allowed_groups)}")
 
             # 权限判断逻辑：
             # 1. 如果 allow_all=True，允许所有
             # 2. 如果 stream_id 为 None，拒绝（无法确定来源群）
             # 3. 如果 stream_id 不在白名单中，拒绝
-            if not allow_all:
+            with span("permission_check"):
+                allowed = permission_cfg.is_allowed(stream_id)
+            if not allowed:
                 if not stream_id:
                     logger.info(f"[权限拒绝] stream_id 为空，无法确定来源群，已静默拒绝")
+                    record_outcome("tool", "denied")
                     return {"name": self.name, "content": ""}
-                if not is_stream_in_list(stream_id, allowed_groups):
-                    logger.info(f"[权限拒绝] 群 {stream_id} 没有开启自拍权限，已静默拒绝 (配置格式提示: 使用 qq:群号 或直接填 hash)")
-                    return {"name": self.name, "content": ""}
+                logger.info(f"[权限拒绝] 群 {stream_id} 没有开启自拍权限，已静默拒绝 (配置格式提示: 使用 qq:群号 或直接填 hash)")
+                record_outcome("tool", "denied")
+                return {"name": self.name, "content": ""}
 
-            # 初始化组件
-            generator = SelfieGenerator(selfie_config)
-            prompt_builder = SelfiePromptBuilder(selfie_config)
-            target_selector = TargetSelector(selfie_config)
+            # 获取目标群（先于生图确定，便于按群选人设、检查限制）
+            # 优先使用当前对话的stream_id，否则自动选择
+            target_stream_id = self.chat_id or runtime.target_selector.get_target_stream_id()
+            if not target_stream_id:
+                record_outcome("tool", "no_target")
+                return {"name": self.name, "content": "没有可发送的目标群"}
+
+            # 该群人设的组件（冷却和每日计数跨调用保留）
+            persona = runtime.persona_for(target_stream_id)
+            generator = persona.generator
+            prompt_builder = persona.prompt_builder
 
             # 检查是否可以拍照（冷却+每日上限）
-            can_take, reason = generator.can_take_selfie()
+            can_take, reason = await generator.can_take_selfie()
             if not can_take:
+                record_outcome("tool", "limited")
                 return {"name": self.name, "content": f"现在不能拍照: {reason}"}
 
             # 获取参数
@@ -117,80 +136,98 @@ class TakeSelfiePhotoTool(BaseTool):
             else:
                 perspective = generator.select_perspective()
 
-            logger.info(f"开始生成照片: activity={activity}, style={style.value}, perspective={perspective.value}")
+            # 按群检查冷却/每日上限/当天重复活动并预占，生图期间同群的其他请求不会一起通过
+            group, reason = runtime.reserve_group(target_stream_id, activity)
+            if group is None:
+                record_outcome("tool", "limited")
+                return {"name": self.name, "content": f"现在不能拍照: {reason}"}
+
+            # 令牌桶限流（全局/群/触发用户），没发出照片时归还
+            rate_key = (target_stream_id, get_trigger_user_id(self))
+            can_take, reason = await runtime.acquire_rate(*rate_key)
+            if not can_take:
+                rate_key = None
+                record_outcome("tool", "limited")
+                return {"name": self.name, "content": f"现在不能拍照: {reason}"}
+
+            logger.info(
+                f"开始生成照片: activity={activity}, style={style.value}, perspective={perspective.value}"
+                + (f", persona={persona.name}" if persona.name else "")
+            )
 
             # 构建prompt
             prompt = prompt_builder.build_prompt(activity, style, perspective, context)
 
-            # debug 模式下，发送调试信息到 debug 群
-            if debug_mode:
-                debug_groups = permission_cfg.get("debug_groups", [])
-                if debug_groups:
-                    # 获取 API 配置用于显示
-                    api_cfg = selfie_config.get("api", {})
-                    model = api_cfg.get("model", "unknown")
+            # 登记到任务日志（重启后补发已生成未发送的图片）
+            job = runtime.open_job("tool", target_stream_id, activity, prompt, style.value, perspective.value)
 
-                    perspective_name = "自拍" if perspective == PhotoPerspective.SELFIE else "POV"
-                    style_name = "精美" if style == SelfieStyle.PROFESSIONAL else "随手拍"
+            # debug 模式下，记录调试信息（请求结束时统一发送到 debug 群）
+            if reporter.enabled:
+                perspective_name = "自拍" if perspective == PhotoPerspective.SELFIE else "POV"
+                style_name = "精美" if style == SelfieStyle.PROFESSIONAL else "随手拍"
 
-                    debug_info = f"""[DEBUG] LLM Tool 调用自拍
+                reporter.add(f"""[DEBUG] LLM Tool 调用自拍
 ━━━━━━━━━━━━━━━━━━━━
 触发来源: {stream_id or 'None'}
 activity: {activity}
 perspective: {perspective.value} ({perspective_name})
 style: {style.value} ({style_name})
-model: {model}
+persona: {persona.name or '(全局)'}
+model: {generator.model}
 reason: {context or '(无)'}
 ━━━━━━━━━━━━━━━━━━━━
-正在生成..."""
-                    await send_to_debug_groups(debug_groups, debug_info)
+正在生成...""")
 
-                    # 发送完整 prompt
-                    prompt_msg = f"""[DEBUG] 完整 Prompt
+                reporter.add(f"""[DEBUG] 完整 Prompt
 ━━━━━━━━━━━━━━━━━━━━
 {prompt}
-━━━━━━━━━━━━━━━━━━━━"""
-                    await send_to_debug_groups(debug_groups, prompt_msg)
+━━━━━━━━━━━━━━━━━━━━""")
 
             # 生成图片
-            image_base64, error = await generator.generate_selfie(prompt)
+            image_base64, error = await generator.generate_selfie(prompt, PRIORITY_INTERACTIVE)
             if error:
                 logger.error(f"生成照片失败: {error}")
-                # debug 模式下，发送错误信息到 debug 群
-                if debug_mode:
-                    debug_groups = permission_cfg.get("debug_groups", [])
-                    if debug_groups:
-                        error_msg = f"""[DEBUG] 生成失败
+                if reporter.enabled:
+                    reporter.add(f"""[DEBUG] 生成失败
 ━━━━━━━━━━━━━━━━━━━━
 error: {error}
-━━━━━━━━━━━━━━━━━━━━"""
-                        await send_to_debug_groups(debug_groups, error_msg)
+━━━━━━━━━━━━━━━━━━━━
+{trace.format_breakdown()}""")
+                await runtime.refund_rate(*rate_key)
+                job.fail(error)
+                record_outcome("tool", "generate_failed")
                 return {"name": self.name, "content": f"生成失败: {error}"}
 
-            # 获取目标群
-            # 优先使用当前对话的stream_id，否则自动选择
-            target_stream_id = self.chat_id or target_selector.get_target_stream_id()
-            if not target_stream_id:
-                return {"name": self.name, "content": "没有可发送的目标群"}
+            job.generated(image_base64)
 
             # 发送图片
-            success = await send_api.image_to_stream(image_base64, target_stream_id)
+            with SEND_SECONDS.time(source="tool"), span("send", bytes=len(image_base64)):
+                try:
+                    success = await run_phase(
+                        "send", send_api.image_to_stream(image_base64, target_stream_id), cfg.timeouts.send,
+                    )
+                except PhaseTimeout as e:
+                    logger.warning(f"发送图片超时: {e}")
+                    success = False
+            runtime.record_send(
+                "tool", "success" if success else "send_failed", target_stream_id, activity,
+                style=style.value, perspective=perspective.value, image_base64=image_base64,
+            )
+            job.finish(success)
             if success:
+                record_outcome("tool", "success")
                 style_name = "精美" if style == SelfieStyle.PROFESSIONAL else "随手拍"
                 perspective_name = "自拍" if perspective == PhotoPerspective.SELFIE else "POV"
                 logger.info(f"照片发送成功: stream={target_stream_id}, style={style_name}, perspective={perspective_name}")
 
-                # debug 模式下，发送成功信息到 debug 群
-                if debug_mode:
-                    debug_groups = permission_cfg.get("debug_groups", [])
-                    if debug_groups:
-                        success_msg = f"""[DEBUG] 生成完成
+                if reporter.enabled:
+                    reporter.add(f"""[DEBUG] 生成完成
 ━━━━━━━━━━━━━━━━━━━━
 success: True
 target_stream: {target_stream_id}
 image_size: {len(image_base64)} bytes (base64)
-━━━━━━━━━━━━━━━━━━━━"""
-                        await send_to_debug_groups(debug_groups, success_msg)
+━━━━━━━━━━━━━━━━━━━━
+{trace.format_breakdown()}""")
 
                 return {
                     "name": self.name,
@@ -198,18 +235,25 @@ image_size: {len(image_base64)} bytes (base64)
                 }
             else:
                 logger.error(f"发送图片失败: stream={target_stream_id}")
-                # debug 模式下，发送失败信息到 debug 群
-                if debug_mode:
-                    debug_groups = permission_cfg.get("debug_groups", [])
-                    if debug_groups:
-                        fail_msg = f"""[DEBUG] 发送失败
+                await runtime.refund_rate(*rate_key)
+                record_outcome("tool", "send_failed")
+                if reporter.enabled:
+                    reporter.add(f"""[DEBUG] 发送失败
 ━━━━━━━━━━━━━━━━━━━━
 target_stream: {target_stream_id}
 error: 发送图片到群失败
-━━━━━━━━━━━━━━━━━━━━"""
-                        await send_to_debug_groups(debug_groups, fail_msg)
+━━━━━━━━━━━━━━━━━━━━
+{trace.format_breakdown()}""")
                 return {"name": self.name, "content": "发送失败"}
 
         except Exception as e:
             logger.error(f"拍照工具执行失败: {e}", exc_info=True)
+            if rate_key:
+                await runtime.refund_rate(*rate_key)
+            if job:
+                job.fail(str(e))
+            record_outcome("tool", "error")
             return {"name": self.name, "content": f"出错了: {str(e)}"}
+        finally:
+            if group is not None:
+                group.release()